@@ -0,0 +1,252 @@
+from __future__ import division
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+import glob
+import json
+import os
+import queue
+import shutil
+import threading
+import numpy as np
+
+"""
+This file implements asynchronous checkpointing in a compact array format.
+
+A checkpoint is a directory holding one .npy file per array (or a single
+compressed arrays.npz) and a small manifest.json with everything else:
+
+  <prefix>_iter_00001200/
+    manifest.json
+    params.W1.npy
+    optim.W1.m.npy
+    ...
+
+The .npy files can be memory-mapped when the checkpoint is loaded, so
+loading costs nothing for arrays that are never read.
+
+CheckpointWriter.save() takes a copy of the arrays on the calling thread
+(a plain memory copy, so that training can keep updating them) and hands it
+to a background thread, which writes the checkpoint into a temporary
+directory, renames it into place once it is complete and deletes the oldest
+checkpoints of the same prefix beyond the last keep. The training loop only
+ever waits for the copy.
+"""
+
+
+_MANIFEST = 'manifest.json'
+_BUNDLE = 'arrays.npz'
+
+
+def checkpoint_path(prefix, iteration):
+    """
+    Returns the directory of the checkpoint of the given iteration.
+    """
+    return '%s_iter_%08d' % (prefix, iteration)
+
+
+def list_checkpoints(prefix):
+    """
+    Returns the complete checkpoint directories of a prefix, oldest first.
+    """
+    paths = glob.glob(glob.escape(prefix) + '_iter_' + '[0-9]' * 8)
+    return sorted(p for p in paths
+                  if os.path.isfile(os.path.join(p, _MANIFEST)))
+
+
+def latest_checkpoint(prefix):
+    """
+    Returns the newest complete checkpoint directory of a prefix, or None.
+    """
+    paths = list_checkpoints(prefix)
+    return paths[-1] if paths else None
+
+
+def write_checkpoint(path, arrays, meta, compress=False):
+    """
+    Write a checkpoint directory synchronously.
+
+    Inputs:
+    - path: Directory to create; replaced if it exists
+    - arrays: Dictionary mapping names to arrays
+    - meta: JSON serializable dictionary stored in the manifest
+    - compress: If True, store all arrays in one compressed .npz file
+      instead of one .npy file per array
+    """
+    tmp = path + '.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    manifest = {'meta': meta, 'compressed': compress, 'arrays': {}}
+    for name, a in arrays.items():
+        manifest['arrays'][name] = {'shape': list(a.shape),
+                                    'dtype': a.dtype.str}
+    if compress:
+        np.savez_compressed(os.path.join(tmp, _BUNDLE), **arrays)
+    else:
+        for name, a in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), a)
+    with open(os.path.join(tmp, _MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+
+def load_checkpoint(path, mmap=True):
+    """
+    Load a checkpoint directory.
+
+    Inputs:
+    - path: Checkpoint directory
+    - mmap: If True, memory-map the .npy files instead of reading them
+
+    Returns a tuple of:
+    - arrays: Dictionary mapping names to arrays (read-only memory maps if
+      mmap is True and the checkpoint is not compressed)
+    - meta: The meta dictionary given to write_checkpoint
+    """
+    with open(os.path.join(path, _MANIFEST)) as f:
+        manifest = json.load(f)
+    arrays = {}
+    if manifest['compressed']:
+        with np.load(os.path.join(path, _BUNDLE)) as bundle:
+            for name in manifest['arrays']:
+                arrays[name] = bundle[name]
+    else:
+        mmap_mode = 'r' if mmap else None
+        for name in manifest['arrays']:
+            arrays[name] = np.load(os.path.join(path, name + '.npy'),
+                                   mmap_mode=mmap_mode)
+    return arrays, manifest['meta']
+
+
+class CheckpointWriter(object):
+    """
+    Writes checkpoints in a background thread and keeps the newest few.
+    """
+
+    def __init__(self, prefix, keep=3, compress=False):
+        """
+        Inputs:
+        - prefix: Path prefix of the checkpoint directories
+        - keep: Number of checkpoints of the prefix to keep; None keeps all
+        - compress: See write_checkpoint
+        """
+        self.prefix = prefix
+        self.keep = keep
+        self.compress = compress
+        parent = os.path.dirname(prefix)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                path, arrays, meta = job
+                write_checkpoint(path, arrays, meta, self.compress)
+                if self.keep is not None:
+                    for old in list_checkpoints(self.prefix)[:-self.keep]:
+                        shutil.rmtree(old, ignore_errors=True)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+    def save(self, iteration, arrays, meta):
+        """
+        Snapshot arrays and queue the checkpoint of an iteration for writing.
+
+        Inputs:
+        - iteration: Iteration number, used in the directory name
+        - arrays: Dictionary mapping names to arrays; copied before returning
+        - meta: JSON serializable dictionary; serialized before returning
+
+        Returns:
+        - path: The directory the checkpoint will be written to
+        """
+        self._check()
+        snapshot = {name: np.array(a, copy=True) for name, a in arrays.items()}
+        meta = json.loads(json.dumps(meta))
+        path = checkpoint_path(self.prefix, iteration)
+        self._queue.put((path, snapshot, meta))
+        return path
+
+
+    def flush(self):
+        """
+        Wait until all queued checkpoints are written.
+        """
+        self._queue.join()
+        self._check()
+
+
+    def close(self):
+        """
+        Write the queued checkpoints and stop the background thread.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._check()
+
+
+class ArrayHistory(object):
+    """
+    A list-like history that starts from a (possibly memory-mapped) array.
+
+    Resuming from a checkpoint wraps the saved loss history in an
+    ArrayHistory instead of converting it into a list, so that resuming
+    does not read the whole history; new values are appended to a list.
+    """
+
+    def __init__(self, base):
+        self.base = base
+        self.tail = []
+
+    def append(self, value):
+        self.tail.append(value)
+
+    def __len__(self):
+        return len(self.base) + len(self.tail)
+
+    def __iter__(self):
+        for value in self.base:
+            yield value
+        for value in self.tail:
+            yield value
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return np.asarray(self)[i]
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('history index out of range')
+        if i < len(self.base):
+            return self.base[i]
+        return self.tail[i - len(self.base)]
+
+    def __array__(self, dtype=None, copy=None):
+        tail = np.asarray(self.tail, dtype=self.base.dtype)
+        out = np.concatenate([self.base, tail])
+        return out if dtype is None else out.astype(dtype)
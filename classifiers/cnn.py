@@ -4,6 +4,7 @@ import numpy as np
 from cs231n.layers import *
 from cs231n.fast_layers import *
 from cs231n.layer_utils import *
+from cs231n.grad_checkpoint import Checkpointer, CheckpointReport
 
 
 class ThreeLayerConvNet(object):
@@ -38,6 +39,10 @@ class ThreeLayerConvNet(object):
         self.reg = reg
         self.dtype = dtype
 
+        # Predicted labels of the last training minibatch, set by loss(X, y)
+        self.train_predictions = None
+        self.input_dim = tuple(input_dim)
+
         ############################################################################
         # TODO: Initialize weights and biases for the three-layer convolutional    #
         # network. Weights should be initialized from a Gaussian centered at 0.0   #
@@ -112,12 +117,12 @@ class ThreeLayerConvNet(object):
         ############################################################################
         X, conv_cache = conv_forward_fast(X, W1, b1, conv_param)
         X, max_pool_cache = max_pool_forward_fast(X, pool_param)
-        X, affine_relu_cache = affine_relu_forward(X, W2, b2)
-        scores, affine_cache = affine_forward(X, W3, b3)
+        X, affine_relu_cache = affine_relu_forward(X, W2, b2, inplace=True)
         ############################################################################
         #                             END OF YOUR CODE                             #
         ############################################################################
         if y is None:
+            scores, _ = affine_forward(X, W3, b3)
             return scores
 
         loss, grads = 0, {}
@@ -132,12 +137,15 @@ class ThreeLayerConvNet(object):
         # of 0.5 to simplify the expression for the gradient.                      #
         ############################################################################
         reg = self.reg
-        data_loss, dscores = softmax_loss(scores, y)
+        # final affine layer and softmax loss, fused
+        self.train_predictions = np.empty(X.shape[0], dtype=np.intp)
+        data_loss, affine_softmax_cache = affine_softmax_loss_forward(
+            X, W3, b3, y, pred_out=self.train_predictions)
         reg_loss = 0.5*reg*(np.sum(W1*W1) + np.sum(W2*W2) + np.sum(W3*W3))
         loss = data_loss + reg_loss
 
-        dx, dW3, db3 = affine_backward(dscores, affine_cache)
-        dx, dW2, db2 = affine_relu_backward(dx, affine_relu_cache)
+        dx, dW3, db3 = affine_softmax_loss_backward(affine_softmax_cache)
+        dx, dW2, db2 = affine_relu_backward(dx, affine_relu_cache, inplace=True)
         dx = max_pool_backward_fast(dx, max_pool_cache)
         dx, dW1, db1 = conv_backward_fast(dx, conv_cache)
 
@@ -153,3 +161,320 @@ class ThreeLayerConvNet(object):
         ############################################################################
 
         return loss, grads
+
+
+class DeepConvNet(object):
+    """
+    A convolutional network with an arbitrary number of conv blocks followed
+    by fully-connected layers:
+
+    {conv - [spatial batchnorm] - relu - [max pool]} x N
+        - {affine - relu} x M - affine - softmax
+
+    Each conv block is described by a dictionary (see __init__), so that the
+    same class covers small CIFAR-10 networks as well as deeper stacks on
+    larger inputs such as 64x64 Tiny-ImageNet images. The spatial size is
+    tracked through the blocks, so the first affine layer always has the
+    right input dimension.
+
+    The fastest available conv and pool implementations are picked once per
+    block when the network is built: convolutions use the stride-trick
+    im2col (conv_forward_strides), and pooling uses the reshape method when
+    the pooling regions tile the input and the im2col method otherwise.
+
+    Learnable parameters are stored in self.params: W1, b1, ..., WN, bN for
+    the conv blocks, followed by the weights and biases of the affine layers,
+    and gamma{i} / beta{i} for blocks i that use batch normalization.
+    """
+
+    def __init__(self, blocks, input_dim=(3, 32, 32), hidden_dims=(100,),
+                 num_classes=10, weight_scale=1e-3, reg=0.0, dtype=np.float32,
+                 checkpoint_every=None):
+        """
+        Initialize a new network.
+
+        Inputs:
+        - blocks: List of dictionaries, one per conv block, with the keys
+          - num_filters: Number of filters of the conv layer; required
+          - filter_size: Width/height of the filters; default 3
+          - stride: Stride of the convolution; default 1
+          - pad: Zero padding; default (filter_size - 1) // 2, which preserves
+            the spatial size for stride 1
+          - pool: Size of a square max pool, or None (the default) for no
+            pooling
+          - pool_stride: Stride of the max pool; default equal to pool
+          - norm: 'batchnorm' for spatial batch normalization after the conv,
+            or None (the default)
+        - input_dim: Tuple (C, H, W) giving size of input data
+        - hidden_dims: List of sizes of the fully-connected hidden layers
+        - num_classes: Number of scores to produce from the final affine layer.
+        - weight_scale: Scalar giving standard deviation for random
+          initialization of weights, or None to use He initialization
+          (standard deviation sqrt(2 / fan_in)), which trains much better for
+          deep stacks.
+        - reg: Scalar giving L2 regularization strength
+        - dtype: numpy datatype to use for computation.
+        - checkpoint_every: If not None, train with activation recomputation
+          (see grad_checkpoint.py), keeping only the input of every
+          checkpoint_every-th layer during the forward pass. Can be changed
+          later with set_checkpointing.
+        """
+        self.params = {}
+        self.reg = reg
+        self.dtype = dtype
+
+        # Predicted labels of the last training minibatch, set by loss(X, y)
+        self.train_predictions = None
+        self.input_dim = tuple(input_dim)
+        self.bn_params = []
+
+        def init_weights(shape, fan_in):
+            std = np.sqrt(2.0 / fan_in) if weight_scale is None else weight_scale
+            return std * np.random.randn(*shape)
+
+        # Precomputed per-block settings used by loss():
+        # (W key, b key, conv_param, gamma key, beta key, bn_param,
+        #  pool forward, pool backward, pool_param)
+        self._blocks = []
+        C, H, W = input_dim
+        layer = 0
+        for i, block in enumerate(blocks):
+            layer += 1
+            F = block['num_filters']
+            HH = block.get('filter_size', 3)
+            stride = block.get('stride', 1)
+            pad = block.get('pad')
+            if pad is None:
+                pad = (HH - 1) // 2
+            if H + 2 * pad < HH or W + 2 * pad < HH:
+                raise ValueError('Conv block %d does not fit its %dx%d input'
+                                 % (i + 1, H, W))
+
+            w_key, b_key = 'W%d' % layer, 'b%d' % layer
+            self.params[w_key] = init_weights((F, C, HH, HH), C * HH * HH)
+            self.params[b_key] = np.zeros(F)
+            conv_param = {'stride': stride, 'pad': pad}
+            C = F
+            H = (H + 2 * pad - HH) // stride + 1
+            W = (W + 2 * pad - HH) // stride + 1
+
+            gamma_key = beta_key = bn_param = None
+            norm = block.get('norm')
+            if norm == 'batchnorm':
+                gamma_key, beta_key = 'gamma%d' % layer, 'beta%d' % layer
+                self.params[gamma_key] = np.ones(C)
+                self.params[beta_key] = np.zeros(C)
+                bn_param = {'mode': 'train'}
+                self.bn_params.append(bn_param)
+            elif norm is not None:
+                raise ValueError('Invalid norm "%s"' % norm)
+
+            pool_forward = pool_backward = pool_param = None
+            pool = block.get('pool')
+            if pool is not None:
+                pool_stride = block.get('pool_stride', pool)
+                if H < pool or W < pool or (H - pool) % pool_stride != 0 or \
+                   (W - pool) % pool_stride != 0:
+                    raise ValueError('Pool of block %d does not fit its %dx%d '
+                                     'input' % (i + 1, H, W))
+                pool_param = {'pool_height': pool, 'pool_width': pool,
+                              'stride': pool_stride}
+                if pool_stride == pool and H % pool == 0 and W % pool == 0:
+                    pool_forward = max_pool_forward_reshape
+                    pool_backward = max_pool_backward_reshape
+                else:
+                    pool_forward = max_pool_forward_im2col
+                    pool_backward = max_pool_backward_im2col
+                H = (H - pool) // pool_stride + 1
+                W = (W - pool) // pool_stride + 1
+
+            self._blocks.append((w_key, b_key, conv_param, gamma_key, beta_key,
+                                 bn_param, pool_forward, pool_backward,
+                                 pool_param))
+
+        # Fully-connected layers; the first one takes the flattened output of
+        # the last conv block
+        self._affine_keys = []
+        dims = [C * H * W] + list(hidden_dims) + [num_classes]
+        for i in range(len(dims) - 1):
+            layer += 1
+            w_key, b_key = 'W%d' % layer, 'b%d' % layer
+            self.params[w_key] = init_weights((dims[i], dims[i + 1]), dims[i])
+            self.params[b_key] = np.zeros(dims[i + 1])
+            self._affine_keys.append((w_key, b_key))
+        self.num_layers = layer
+        self._weight_keys = ['W%d' % i for i in range(1, layer + 1)]
+
+        for k, v in self.params.items():
+            self.params[k] = v.astype(dtype)
+
+        self.set_checkpointing(checkpoint_every)
+
+
+    def set_checkpointing(self, every):
+        """
+        Turn activation recomputation on (every is the number of layers per
+        segment, counting each conv block and each hidden affine layer as one
+        layer) or off (every=None).
+        """
+        self.checkpoint = None
+        if every is not None:
+            self.checkpoint = Checkpointer(every, bn_params=self.bn_params)
+
+
+    def checkpoint_report(self, batch_size, every):
+        """
+        Estimate the memory saved and the extra FLOPs of checkpointing every
+        every layers for training passes with the given batch size.
+
+        Returns:
+        - report: A CheckpointReport
+        """
+        N = batch_size
+        itemsize = np.dtype(self.dtype).itemsize
+        cache_bytes, input_bytes, flops = [], [], []
+        C, H, W = self.input_dim
+        for (w_key, _, conv_param, _, _, bn_param, pool_forward, _,
+             pool_param) in self._blocks:
+            F, _, HH, WW = self.params[w_key].shape
+            stride, pad = conv_param['stride'], conv_param['pad']
+            H_out = (H + 2 * pad - HH) // stride + 1
+            W_out = (W + 2 * pad - WW) // stride + 1
+            x_size = N * C * H * W
+            out_size = N * F * H_out * W_out
+            # The conv cache holds the input and its im2col matrix, the relu
+            # its output
+            size = x_size + C * HH * WW * out_size // F + out_size
+            flop = 2 * out_size * C * HH * WW + out_size
+            if bn_param is not None:
+                size += 2 * out_size
+                flop += 8 * out_size
+            if pool_forward is not None:
+                pool, pool_stride = pool_param['pool_height'], pool_param['stride']
+                H_out = (H_out - pool) // pool_stride + 1
+                W_out = (W_out - pool) // pool_stride + 1
+                pooled = N * F * H_out * W_out
+                size += pooled
+                if pool_forward is max_pool_forward_im2col:
+                    size += (pool * pool + 1) * pooled
+                flop += pool * pool * pooled
+            cache_bytes.append(size * itemsize)
+            input_bytes.append(x_size * itemsize)
+            flops.append(flop)
+            C, H, W = F, H_out, W_out
+
+        for w_key, _ in self._affine_keys[:-1]:
+            D, M = self.params[w_key].shape
+            cache_bytes.append((N * D + N * M) * itemsize)
+            input_bytes.append(N * D * itemsize)
+            flops.append(2 * N * D * M + N * M)
+        D, M = self.params[self._affine_keys[-1][0]].shape
+        return CheckpointReport(every, cache_bytes, input_bytes, flops,
+                                other_flops=2 * N * D * M)
+
+
+    def _unit_forward(self, j, x):
+        """
+        Forward pass of layer j: conv block j for j < len(self._blocks), and
+        the corresponding hidden affine-relu layer after that.
+        """
+        params = self.params
+        if j >= len(self._blocks):
+            w_key, b_key = self._affine_keys[j - len(self._blocks)]
+            return affine_relu_forward(x, params[w_key], params[b_key],
+                                       inplace=True)
+
+        (w_key, b_key, conv_param, gamma_key, beta_key, bn_param,
+         pool_forward, _, pool_param) = self._blocks[j]
+        out, conv_cache = conv_forward_strides(x, params[w_key], params[b_key],
+                                               conv_param)
+        bn_cache = pool_cache = None
+        if bn_param is not None:
+            out, bn_cache = spatial_batchnorm_forward(
+                out, params[gamma_key], params[beta_key], bn_param)
+        out, relu_cache = relu_forward_inplace(out, keep=bn_cache)
+        if pool_forward is not None:
+            out, pool_cache = pool_forward(out, pool_param)
+        return out, (conv_cache, bn_cache, relu_cache, pool_cache)
+
+
+    def _unit_backward(self, j, dout, cache, grads):
+        """
+        Backward pass of layer j, storing its gradients in grads.
+        """
+        if j >= len(self._blocks):
+            w_key, b_key = self._affine_keys[j - len(self._blocks)]
+            dout, grads[w_key], grads[b_key] = affine_relu_backward(
+                dout, cache, inplace=True)
+            return dout
+
+        (w_key, b_key, _, gamma_key, beta_key, bn_param, _, pool_backward,
+         _) = self._blocks[j]
+        conv_cache, bn_cache, relu_cache, pool_cache = cache
+        if pool_backward is not None:
+            dout = pool_backward(dout, pool_cache)
+        dout = relu_backward_inplace(dout, relu_cache)
+        if bn_param is not None:
+            dout, grads[gamma_key], grads[beta_key] = \
+                spatial_batchnorm_backward(dout, bn_cache)
+        dout, grads[w_key], grads[b_key] = conv_backward_strides(dout,
+                                                                 conv_cache)
+        return dout
+
+
+    def loss(self, X, y=None):
+        """
+        Evaluate loss and gradient for the deep convolutional network.
+
+        Input / output: Same API as TwoLayerNet in fc_net.py.
+        """
+        X = X.astype(self.dtype, copy=False)
+        mode = 'test' if y is None else 'train'
+        for bn_param in self.bn_params:
+            bn_param['mode'] = mode
+        params = self.params
+        num_units = len(self._blocks) + len(self._affine_keys) - 1
+
+        # Forward pass through the conv blocks and the hidden affine layers
+        if self.checkpoint is not None and mode == 'train':
+            out, checkpoint_state = self.checkpoint.forward(
+                self._unit_forward, num_units, X)
+        else:
+            caches = []
+            out = X
+            for j in range(num_units):
+                out, cache = self._unit_forward(j, out)
+                caches.append(cache)
+
+        w_key, b_key = self._affine_keys[-1]
+        if y is None:
+            scores, _ = affine_forward(out, params[w_key], params[b_key])
+            return scores
+
+        reg = self.reg
+        grads = {}
+        self.train_predictions = np.empty(X.shape[0], dtype=np.intp)
+        data_loss, cache = affine_softmax_loss_forward(
+            out, params[w_key], params[b_key], y,
+            pred_out=self.train_predictions)
+        reg_loss = 0
+        for k in self._weight_keys:
+            reg_loss += 0.5 * reg * np.sum(params[k] * params[k])
+        loss = data_loss + reg_loss
+
+        # Backward pass through the layers
+        dout, grads[w_key], grads[b_key] = affine_softmax_loss_backward(cache)
+        unit_backward = lambda j, dout, cache: self._unit_backward(
+            j, dout, cache, grads)
+        if self.checkpoint is not None:
+            self.checkpoint.backward(self._unit_forward, unit_backward,
+                                     num_units, dout, checkpoint_state)
+        else:
+            for j in range(num_units - 1, -1, -1):
+                dout = unit_backward(j, dout, caches.pop())
+
+        # add regularization gradient contribution
+        for k in self._weight_keys:
+            grads[k] += reg * params[k]
+
+        return loss, grads
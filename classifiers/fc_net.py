@@ -4,6 +4,9 @@ import numpy as np
 
 from cs231n.layers import *
 from cs231n.layer_utils import *
+from cs231n.dropout_rng import make_dropout_streams
+from cs231n.memory_planner import MemoryPlanner
+from cs231n.grad_checkpoint import Checkpointer, CheckpointReport
 
 class TwoLayerNet(object):
     """
@@ -37,6 +40,9 @@ class TwoLayerNet(object):
         self.params = {}
         self.reg = reg
 
+        # Predicted labels of the last training minibatch, set by loss(X, y)
+        self.train_predictions = None
+
         ############################################################################
         # TODO: Initialize the weights and biases of the two-layer net. Weights    #
         # should be initialized from a Gaussian centered at 0.0 with               #
@@ -83,8 +89,7 @@ class TwoLayerNet(object):
         W1, b1 = self.params['W1'], self.params['b1']
         W2, b2 = self.params['W2'], self.params['b2']
 
-        h, affine_relu_cache = affine_relu_forward(X, W1, b1)
-        scores, affine_cache = affine_forward(h, W2, b2)
+        h, affine_relu_cache = affine_relu_forward(X, W1, b1, inplace=True)
 
         ############################################################################
         #                             END OF YOUR CODE                             #
@@ -92,6 +97,7 @@ class TwoLayerNet(object):
 
         # If y is None then we are in test mode so just return scores
         if y is None:
+            scores, _ = affine_forward(h, W2, b2)
             return scores
 
         loss, grads = 0, {}
@@ -106,13 +112,16 @@ class TwoLayerNet(object):
         # of 0.5 to simplify the expression for the gradient.                      #
         ############################################################################
         reg = self.reg
-        data_loss, dscores = softmax_loss(scores, y)
+        # final affine layer and softmax loss, fused
+        self.train_predictions = np.empty(X.shape[0], dtype=np.intp)
+        data_loss, affine_softmax_cache = affine_softmax_loss_forward(
+            h, W2, b2, y, pred_out=self.train_predictions)
 
         reg_loss = 0.5 * reg * np.sum(W1*W1) + 0.5 * reg * np.sum(W2*W2)
         loss = data_loss + reg_loss
 
-        dh, dW2, db2 = affine_backward(dscores, affine_cache)
-        dx, dW1, db1 = affine_relu_backward(dh, affine_relu_cache)
+        dh, dW2, db2 = affine_softmax_loss_backward(affine_softmax_cache)
+        dx, dW1, db1 = affine_relu_backward(dh, affine_relu_cache, inplace=True)
 
         # add regularization gradient contribution
         dW1 +=  reg * W1
@@ -145,7 +154,9 @@ class FullyConnectedNet(object):
 
     def __init__(self, hidden_dims, input_dim=3*32*32, num_classes=10,
                  dropout=1, normalization=None, reg=0.0,
-                 weight_scale=1e-2, dtype=np.float32, seed=None):
+                 weight_scale=1e-2, dtype=np.float32, seed=None,
+                 dropout_rng='global', regenerate_dropout_masks=False,
+                 checkpoint_every=None, activation_dtype=None):
         """
         Initialize a new FullyConnectedNet.
 
@@ -166,12 +177,28 @@ class FullyConnectedNet(object):
         - seed: If not None, then pass this random seed to the dropout layers. This
           will make the dropout layers deteriminstic so we can gradient check the
           model.
+        - dropout_rng: Where dropout masks come from. 'global' uses the global
+          np.random state (reseeded with seed on every forward pass if seed is
+          given). 'philox' gives every dropout layer its own counter-based
+          DropoutStream seeded with seed; masks then change from step to step
+          but are reproducible independently of the order the layers run in.
+        - regenerate_dropout_masks: With dropout_rng='philox', do not keep the
+          dropout masks in the cache but regenerate them in the backward pass.
+        - checkpoint_every: If not None, train with activation recomputation
+          (see grad_checkpoint.py), keeping only the input of every
+          checkpoint_every-th hidden layer during the forward pass. Can be
+          changed later with set_checkpointing.
+        - activation_dtype: If not None, a datatype such as np.float16 to store
+          the activations and the caches of the layers in (mixed precision).
+          Every layer still computes in dtype, and gradients are computed in
+          dtype too. By default activations use dtype.
         """
         self.normalization = normalization
         self.use_dropout = dropout != 1
         self.reg = reg
         self.num_layers = 1 + len(hidden_dims)
         self.dtype = dtype
+        self.activation_dtype = dtype if activation_dtype is None else activation_dtype
         self.params = {}
 
         ############################################################################
@@ -203,10 +230,22 @@ class FullyConnectedNet(object):
         # dropout layer so that the layer knows the dropout probability and the mode
         # (train / test). You can pass the same dropout_param to each dropout layer.
         self.dropout_param = {}
+        self.dropout_params = []
         if self.use_dropout:
             self.dropout_param = {'mode': 'train', 'p': dropout}
-            if seed is not None:
-                self.dropout_param['seed'] = seed
+            if dropout_rng == 'global':
+                if seed is not None:
+                    self.dropout_param['seed'] = seed
+                self.dropout_params = [self.dropout_param] * (self.num_layers - 1)
+            elif dropout_rng == 'philox':
+                # Each dropout layer gets its own param dict holding its stream
+                streams = make_dropout_streams(self.num_layers - 1, seed)
+                for stream in streams:
+                    param = dict(self.dropout_param, stream=stream)
+                    param['regenerate_mask'] = regenerate_dropout_masks
+                    self.dropout_params.append(param)
+            else:
+                raise ValueError('Invalid dropout_rng "%s"' % dropout_rng)
 
         # With batch normalization we need to keep track of running means and
         # variances, so we need to pass a special bn_param object to each batch
@@ -232,6 +271,251 @@ class FullyConnectedNet(object):
         for k, v in self.params.items():
             self.params[k] = v.astype(dtype)
 
+        # Buffer plan for training passes, see plan_memory
+        self.memory_plan = None
+
+        # The gradients returned by loss are multiplied by loss_scale; the
+        # Solver sets this for dynamic loss scaling
+        self.loss_scale = 1.0
+
+        # Predicted labels of the last training minibatch, set by loss(X, y)
+        self.train_predictions = None
+        self.set_checkpointing(checkpoint_every)
+
+
+    def set_checkpointing(self, every):
+        """
+        Turn activation recomputation on (every is the number of hidden layers
+        per segment) or off (every=None). A memory plan is not used for
+        training passes while checkpointing is on.
+        """
+        self.checkpoint = None
+        if every is not None:
+            self.checkpoint = Checkpointer(every, self.dropout_params,
+                                           self.bn_params)
+
+
+    def checkpoint_report(self, batch_size, every):
+        """
+        Estimate the memory saved and the extra FLOPs of checkpointing every
+        every hidden layers for training passes with the given batch size.
+
+        Returns:
+        - report: A CheckpointReport
+        """
+        N = batch_size
+        itemsize = np.dtype(self.activation_dtype).itemsize
+        cache_bytes, input_bytes, flops = [], [], []
+        for i in range(1, self.num_layers):
+            D, M = self.params['W%d' % i].shape
+            # The affine layer keeps its input, the relu its output
+            size = N * D + N * M
+            flop = 2 * N * D * M + N * M
+            if self.normalization is not None:
+                size += 2 * N * M
+                flop += 8 * N * M
+            if self.use_dropout:
+                size += N * M
+                flop += 2 * N * M
+            cache_bytes.append(size * itemsize)
+            input_bytes.append(N * D * itemsize)
+            flops.append(flop)
+        D, M = self.params['W%d' % self.num_layers].shape
+        return CheckpointReport(every, cache_bytes, input_bytes, flops,
+                                other_flops=2 * N * D * M)
+
+
+    def plan_memory(self, batch_size):
+        """
+        Plan the activation memory of training passes with the given batch
+        size (see memory_planner.py).
+
+        This does a shape dry-run of the forward and backward pass of loss()
+        and assigns the activations and activation gradients to a pool of
+        reusable buffers. Training passes with this batch size then write into
+        the pool instead of allocating new arrays; the parameter gradients
+        returned by loss() are still freshly allocated. Set
+        self.memory_plan = None to go back to allocating everything.
+
+        Inputs:
+        - batch_size: Number of examples in the training minibatches
+
+        Returns:
+        - plan: The MemoryPlan, also stored in self.memory_plan; its report()
+          method summarizes the planned peak memory
+        """
+        if np.dtype(self.activation_dtype) != np.dtype(self.dtype):
+            raise ValueError('Memory planning needs activation_dtype == dtype')
+        N = batch_size
+        L = self.num_layers
+        planner = MemoryPlanner(self.dtype)
+        dims = [self.params['W%d' % i].shape[0] for i in range(1, L + 1)]
+        dims.append(self.params['W%d' % L].shape[1])
+        if self.use_dropout:
+            stream = self.dropout_params[0].get('stream')
+            if stream is None:
+                mask_dtype = np.float64
+            elif self.dropout_params[0].get('regenerate_mask'):
+                mask_dtype = None
+            else:
+                mask_dtype = np.bool_
+
+        # Forward pass. hidden is the name of the current hidden activation,
+        # relu is the tensor the in-place ReLU was applied to.
+        planner.define('x', (N, dims[0]))
+        hidden, relu = 'x', {}
+        for i in range(1, L):
+            planner.tick()
+            planner.define('affine%d' % i, (N, dims[i]))
+            planner.use(hidden)
+            hidden = 'affine%d' % i
+            if self.normalization in ('batchnorm', 'layernorm'):
+                planner.tick()
+                planner.define('norm%d' % i, (N, dims[i]))
+                planner.define('norm_cache%d' % i, (2, N, dims[i]),
+                               planned=False)
+                planner.use(hidden)
+                hidden = 'norm%d' % i
+            planner.tick()
+            planner.use(hidden)
+            relu[i] = hidden
+            if self.use_dropout:
+                planner.tick()
+                planner.define('dropout%d' % i, (N, dims[i]))
+                if mask_dtype is not None:
+                    planner.define('dropout_mask%d' % i, (N, dims[i]),
+                                   planned=False, dtype=mask_dtype)
+                planner.use(hidden)
+                hidden = 'dropout%d' % i
+        planner.tick()
+        planner.define('scores', (N, dims[L]))
+        planner.use(hidden)
+
+        # Backward pass; affine caches and the relu outputs are read here
+        planner.tick()
+        planner.define('dhidden%d' % (L - 1), (N, dims[L - 1]))
+        planner.use('scores', hidden)
+        for i in range(L - 1, 0, -1):
+            dhidden = 'dhidden%d' % i
+            if self.use_dropout:
+                planner.tick()
+                planner.use(dhidden)
+                if mask_dtype is not None:
+                    planner.use('dropout_mask%d' % i)
+            planner.tick()
+            planner.use(dhidden, relu[i])
+            if self.normalization in ('batchnorm', 'layernorm'):
+                planner.tick()
+                planner.define('dnorm%d' % i, (N, dims[i]))
+                planner.use(dhidden, 'norm_cache%d' % i)
+                dhidden = 'dnorm%d' % i
+            planner.tick()
+            planner.define('dhidden%d' % (i - 1), (N, dims[i - 1]))
+            if i == 1:
+                planner.use(dhidden, 'x')
+            elif self.use_dropout:
+                planner.use(dhidden, 'dropout%d' % (i - 1))
+            else:
+                planner.use(dhidden, relu[i - 1])
+
+        self.memory_plan = planner.plan(batch_size)
+        return self.memory_plan
+
+
+
+    def _hidden_forward(self, i, X, caches, buffers):
+        """
+        Forward pass of hidden layer i, storing its caches in caches.
+        """
+        # Affine forward
+        Wi = self.params["W{}".format(i)]
+        bi = self.params["b{}".format(i)]
+        X, cache = affine_forward(X, Wi, bi,
+                                  out=buffers.get('affine%d' % i))
+        caches["affine_forward{}".format(i)] = cache
+
+        # Batchnorm forward (optional)
+        if self.normalization=='batchnorm':
+            gamma_i = self.params['gamma{}'.format(i)]
+            beta_i = self.params['beta{}'.format(i)]
+            X, cache = batchnorm_forward(X, gamma_i, beta_i, self.bn_params[i-1],
+                                         out=buffers.get('norm%d' % i))
+            caches['batchnorm_forward{}'.format(i)] = cache
+
+        # Layernorm forward (optional)
+        if self.normalization=='layernorm':
+            gamma_i = self.params['gamma{}'.format(i)]
+            beta_i = self.params['beta{}'.format(i)]
+            X, cache = layernorm_forward(X, gamma_i, beta_i, self.ln_params[i-1],
+                                         out=buffers.get('norm%d' % i))
+            caches['layernorm_forward{}'.format(i)] = cache
+
+        # Store the activation in reduced precision (mixed precision)
+        if X.dtype != self.activation_dtype:
+            X = X.astype(self.activation_dtype)
+
+        # Relu forward (in place; X is a fresh output of the layer above)
+        X, cache = relu_forward_inplace(X, keep=cache)
+        caches["relu_forward{}".format(i)] = cache
+
+        # Dropout forward (optional)
+        if self.use_dropout:
+            X, cache = dropout_forward(X, self.dropout_params[i-1],
+                                       out=buffers.get('dropout%d' % i))
+            caches["dropout_forward{}".format(i)] = cache
+
+        return X
+
+
+    def _hidden_backward(self, i, dout, caches, grads, buffers):
+        """
+        Backward pass of hidden layer i, storing its gradients in grads.
+        """
+        if self.use_dropout:
+            # backprop dropout
+            cache = caches['dropout_forward{}'.format(i)]
+            dout = dropout_backward_inplace(dout, cache)
+
+        # backprop ReLu (in place; dout is a fresh gradient array)
+        cache = caches["relu_forward{}".format(i)]
+        dx = relu_backward_inplace(dout, cache)
+
+        if self.normalization=='batchnorm':
+            # backprop Batchnorm
+            cache = caches['batchnorm_forward{}'.format(i)]
+            dx, dgamma, dbeta = batchnorm_backward(
+                dx, cache, dx_out=buffers.get('dnorm%d' % i))
+            grads["gamma{}".format(i)] = dgamma
+            grads["beta{}".format(i)] = dbeta
+
+        if self.normalization=='layernorm':
+            # backprop layernorm
+            cache = caches['layernorm_forward{}'.format(i)]
+            dx, dgamma, dbeta = layernorm_backward(
+                dx, cache, dx_out=buffers.get('dnorm%d' % i))
+            grads["gamma{}".format(i)] = dgamma
+            grads["beta{}".format(i)] = dbeta
+
+        # backprop affine
+        cache = caches["affine_forward{}".format(i)]
+        dout, dWi, dbi = affine_backward(
+            dx, cache, dx_out=buffers.get('dhidden%d' % (i - 1)))
+
+        # store gradient of parameters
+        grads["W{}".format(i)] = dWi
+        grads["b{}".format(i)] = dbi
+
+        return dout
+
+
+    def _checkpoint_forward(self, j, X):
+        """
+        Forward pass of hidden layer j + 1 as a unit of self.checkpoint.
+        """
+        layer_caches = {}
+        X = self._hidden_forward(j + 1, X, layer_caches, {})
+        return X, layer_caches
+
 
     def loss(self, X, y=None):
         """
@@ -239,13 +523,26 @@ class FullyConnectedNet(object):
 
         Input / output: Same as TwoLayerNet above.
         """
-        X = X.astype(self.dtype)
         mode = 'test' if y is None else 'train'
 
+        # Planned buffers for this pass; get() returns None for tensors that
+        # should be allocated as usual
+        buffers = {}
+        if mode == 'train' and self.memory_plan is not None and \
+           self.checkpoint is None:
+            buffers = self.memory_plan.buffers_for(X.shape[0])
+        if 'x' in buffers:
+            np.copyto(buffers['x'], X.reshape(X.shape[0], -1))
+            X = buffers['x']
+        else:
+            X = X.astype(self.activation_dtype)
+
         # Set train/test mode for batchnorm params and dropout param since they
         # behave differently during training and testing.
         if self.use_dropout:
             self.dropout_param['mode'] = mode
+            for dropout_param in self.dropout_params:
+                dropout_param['mode'] = mode
         if self.normalization=='batchnorm':
             for bn_param in self.bn_params:
                 bn_param['mode'] = mode
@@ -267,41 +564,17 @@ class FullyConnectedNet(object):
 
         caches = {}  #caches[i] = cache for backprop of layer i
 
-        for i in range(1, self.num_layers):
-
-            # Affine forward
-            Wi = self.params["W{}".format(i)]
-            bi = self.params["b{}".format(i)]
-            X, cache = affine_forward(X, Wi, bi)
-            caches["affine_forward{}".format(i)] = cache
-
-            # Batchnorm forward (optional)
-            if self.normalization=='batchnorm':
-                gamma_i = self.params['gamma{}'.format(i)]
-                beta_i = self.params['beta{}'.format(i)]
-                X, cache = batchnorm_forward(X, gamma_i, beta_i, self.bn_params[i-1])
-                caches['batchnorm_forward{}'.format(i)] = cache
-
-            # Layernorm forward (optional)
-            if self.normalization=='layernorm':
-                gamma_i = self.params['gamma{}'.format(i)]
-                beta_i = self.params['beta{}'.format(i)]
-                X, cache = layernorm_forward(X, gamma_i, beta_i, self.ln_params[i-1])
-                caches['layernorm_forward{}'.format(i)] = cache
-
-            # Relu forward
-            X, cache = relu_forward(X)
-            caches["relu_forward{}".format(i)] = cache
-
-            # Dropout forward (optional)
-            if self.use_dropout:
-                X, cache = dropout_forward(X, self.dropout_param)
-                caches["dropout_forward{}".format(i)] = cache
+        if self.checkpoint is not None and mode == 'train':
+            X, checkpoint_state = self.checkpoint.forward(
+                self._checkpoint_forward, self.num_layers - 1, X)
+        else:
+            for i in range(1, self.num_layers):
+                X = self._hidden_forward(i, X, caches, buffers)
 
-        # Final layer forward
-        scores, cache = affine_forward(X, self.params["W{}".format(i+1)],
-                               self.params["b{}".format(i+1)])
-        caches["affine_forward{}".format(i+1)] = cache
+        # Final layer forward. At training time it is fused with the softmax
+        # loss below.
+        W_final = self.params["W{}".format(self.num_layers)]
+        b_final = self.params["b{}".format(self.num_layers)]
 
         ############################################################################
         #                             END OF YOUR CODE                             #
@@ -309,6 +582,7 @@ class FullyConnectedNet(object):
 
         # If test mode return early
         if mode == 'test':
+            scores, _ = affine_forward(X, W_final, b_final)
             return scores
 
         loss, grads = 0.0, {}
@@ -328,7 +602,15 @@ class FullyConnectedNet(object):
         loss, grads = 0, {}
 
         reg = self.reg
-        data_loss, dscores = softmax_loss(scores, y)
+        self.train_predictions = np.empty(X.shape[0], dtype=np.intp)
+        data_loss, cache = affine_softmax_loss_forward(
+            X, W_final, b_final, y, out=buffers.get('scores'),
+            pred_out=self.train_predictions)
+        if self.loss_scale != 1:
+            # Scale the gradient on the scores, and so all gradients
+            dscores = cache[2]
+            dscores *= self.loss_scale
+        caches["affine_forward{}".format(self.num_layers)] = cache
 
         # add regularization loss
         reg_loss = 0
@@ -339,9 +621,10 @@ class FullyConnectedNet(object):
         loss = data_loss + reg_loss
 
 
-        #backprob of final affine forward (no ReLu)
-        dfinal_hidden_layer, dW, db = affine_backward(dscores,
-                      caches["affine_forward{}".format(self.num_layers)])
+        #backprob of softmax loss and final affine forward (no ReLu)
+        dfinal_hidden_layer, dW, db = affine_softmax_loss_backward(
+                      caches["affine_forward{}".format(self.num_layers)],
+                      dx_out=buffers.get('dhidden%d' % (self.num_layers - 1)))
 
         grads["W{}".format(self.num_layers)] = dW
         grads["b{}".format(self.num_layers)] = db
@@ -351,43 +634,20 @@ class FullyConnectedNet(object):
         # in the file cs231n/layer_utils.py. If you decide to do so, do it in the file
         # cs231n/classifiers/fc_net.py.
         dout = dfinal_hidden_layer
-        for i in range(self.num_layers - 1, 0, -1):
-
-            if self.use_dropout:
-                # backprop dropout
-                cache = caches['dropout_forward{}'.format(i)]
-                dout = dropout_backward(dout, cache)
-
-            # backprop ReLu
-            cache = caches["relu_forward{}".format(i)]
-            dx = relu_backward(dout, cache)
-
-            if self.normalization=='batchnorm':
-                # backprop Batchnorm
-                cache = caches['batchnorm_forward{}'.format(i)]
-                dx, dgamma, dbeta = batchnorm_backward(dx, cache)
-                grads["gamma{}".format(i)] = dgamma
-                grads["beta{}".format(i)] = dbeta
-
-            if self.normalization=='layernorm':
-                # backprop layernorm
-                cache = caches['layernorm_forward{}'.format(i)]
-                dx, dgamma, dbeta = layernorm_backward(dx, cache)
-                grads["gamma{}".format(i)] = dgamma
-                grads["beta{}".format(i)] = dbeta
-
-            # backprop affine
-            cache = caches["affine_forward{}".format(i)]
-            dout, dWi, dbi = affine_backward(dx, cache)
-
-            # store gradient of parameters
-            grads["W{}".format(i)] = dWi
-            grads["b{}".format(i)] = dbi
+        if self.checkpoint is not None:
+            dout = self.checkpoint.backward(
+                self._checkpoint_forward,
+                lambda j, dout, layer_caches: self._hidden_backward(
+                    j + 1, dout, layer_caches, grads, buffers),
+                self.num_layers - 1, dout, checkpoint_state)
+        else:
+            for i in range(self.num_layers - 1, 0, -1):
+                dout = self._hidden_backward(i, dout, caches, grads, buffers)
 
         # add regularization gradient contribution
         for i in range(1, self.num_layers + 1):
             Wi = self.params["W{}".format(i)]
-            grads["W{}".format(i)] += reg * Wi
+            grads["W{}".format(i)] += reg * self.loss_scale * Wi
 
         ############################################################################
         #                             END OF YOUR CODE                             #
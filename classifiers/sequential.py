@@ -0,0 +1,412 @@
+from builtins import object
+import numpy as np
+
+from cs231n.layers import *
+from cs231n.fast_layers import *
+from cs231n.dropout_rng import DropoutStream
+
+
+class Layer(object):
+    """
+    Base class of the layer objects used by Sequential.
+
+    A layer object holds its own parameters, gradients and cache. Layers with
+    parameters look them up in the model's params dictionary by the names
+    they were given in build(), so that the Solver can keep replacing the
+    arrays in model.params between steps.
+
+    Subclasses set the class attribute counter to the name of the sequence
+    they are numbered in ('weight' for W/b, 'norm' for gamma/beta, 'dropout'
+    for dropout streams), and override the methods below as needed.
+    """
+    __slots__ = ()
+    counter = None
+
+    def build(self, input_shape, index, weight_scale):
+        """
+        Set up the layer for inputs of shape input_shape (without the batch
+        dimension). index is the 1-based position of the layer in its counter
+        sequence.
+
+        Returns a tuple of:
+        - params: Dictionary of initial parameter arrays of this layer
+        - output_shape: Shape of the layer output, without the batch dimension
+        """
+        return {}, input_shape
+
+    def bind(self, params):
+        """
+        Fetch the current parameter arrays of this layer from params.
+        """
+        pass
+
+    def grads(self):
+        """
+        Returns a tuple of (name, gradient) pairs from the last backward pass.
+        """
+        return ()
+
+    def forward(self, x):
+        raise NotImplementedError
+
+    def backward(self, dout):
+        raise NotImplementedError
+
+
+class Affine(Layer):
+    """
+    Fully-connected layer with parameters W{k} and b{k}.
+    """
+    __slots__ = ('output_dim', 'w_key', 'b_key', 'w', 'b', 'dw', 'db', 'cache')
+    counter = 'weight'
+
+    def __init__(self, output_dim):
+        self.output_dim = output_dim
+        self.w_key = self.b_key = None
+        self.w = self.b = self.dw = self.db = self.cache = None
+
+    def build(self, input_shape, index, weight_scale):
+        self.w_key, self.b_key = 'W%d' % index, 'b%d' % index
+        D = int(np.prod(input_shape))
+        params = {
+          self.w_key: weight_scale * np.random.randn(D, self.output_dim),
+          self.b_key: np.zeros(self.output_dim),
+        }
+        return params, (self.output_dim,)
+
+    def bind(self, params):
+        self.w = params[self.w_key]
+        self.b = params[self.b_key]
+
+    def grads(self):
+        return ((self.w_key, self.dw), (self.b_key, self.db))
+
+    def forward(self, x):
+        out, self.cache = affine_forward(x, self.w, self.b)
+        return out
+
+    def backward(self, dout):
+        dx, self.dw, self.db = affine_backward(dout, self.cache)
+        self.cache = None
+        return dx
+
+
+class Conv(Layer):
+    """
+    Convolutional layer with parameters W{k} and b{k}, using the fast conv
+    implementation. By default the padding preserves the spatial size for
+    stride 1.
+    """
+    __slots__ = ('num_filters', 'filter_size', 'conv_param', 'w_key', 'b_key',
+                 'w', 'b', 'dw', 'db', 'cache')
+    counter = 'weight'
+
+    def __init__(self, num_filters, filter_size=3, stride=1, pad=None):
+        if pad is None:
+            pad = (filter_size - 1) // 2
+        self.num_filters = num_filters
+        self.filter_size = filter_size
+        self.conv_param = {'stride': stride, 'pad': pad}
+        self.w_key = self.b_key = None
+        self.w = self.b = self.dw = self.db = self.cache = None
+
+    def build(self, input_shape, index, weight_scale):
+        C, H, W = input_shape
+        F, HH = self.num_filters, self.filter_size
+        stride, pad = self.conv_param['stride'], self.conv_param['pad']
+        self.w_key, self.b_key = 'W%d' % index, 'b%d' % index
+        params = {
+          self.w_key: weight_scale * np.random.randn(F, C, HH, HH),
+          self.b_key: np.zeros(F),
+        }
+        H_out = (H + 2 * pad - HH) // stride + 1
+        W_out = (W + 2 * pad - HH) // stride + 1
+        return params, (F, H_out, W_out)
+
+    def bind(self, params):
+        self.w = params[self.w_key]
+        self.b = params[self.b_key]
+
+    def grads(self):
+        return ((self.w_key, self.dw), (self.b_key, self.db))
+
+    def forward(self, x):
+        out, self.cache = conv_forward_fast(x, self.w, self.b, self.conv_param)
+        return out
+
+    def backward(self, dout):
+        dx, self.dw, self.db = conv_backward_fast(dout, self.cache)
+        self.cache = None
+        return dx
+
+
+class Pool(Layer):
+    """
+    Max pooling layer, using the fast pooling implementation.
+    """
+    __slots__ = ('pool_param', 'cache')
+
+    def __init__(self, pool_size=2, stride=None):
+        if stride is None:
+            stride = pool_size
+        self.pool_param = {'pool_height': pool_size, 'pool_width': pool_size,
+                           'stride': stride}
+        self.cache = None
+
+    def build(self, input_shape, index, weight_scale):
+        C, H, W = input_shape
+        size, stride = self.pool_param['pool_height'], self.pool_param['stride']
+        return {}, (C, (H - size) // stride + 1, (W - size) // stride + 1)
+
+    def forward(self, x):
+        out, self.cache = max_pool_forward_fast(x, self.pool_param)
+        return out
+
+    def backward(self, dout):
+        dx = max_pool_backward_fast(dout, self.cache)
+        self.cache = None
+        return dx
+
+
+class BatchNorm(Layer):
+    """
+    Batch normalization with parameters gamma{k} and beta{k}. Spatial batch
+    normalization is used automatically for (C, H, W) inputs.
+    """
+    __slots__ = ('param', 'forward_fn', 'backward_fn', 'gamma_key', 'beta_key',
+                 'gamma', 'beta', 'dgamma', 'dbeta', 'cache')
+    counter = 'norm'
+
+    def __init__(self, momentum=0.9, eps=1e-5):
+        self.param = {'mode': 'train', 'momentum': momentum, 'eps': eps}
+        self.forward_fn = batchnorm_forward
+        self.backward_fn = batchnorm_backward_alt
+        self.gamma_key = self.beta_key = None
+        self.gamma = self.beta = self.dgamma = self.dbeta = self.cache = None
+
+    def build(self, input_shape, index, weight_scale):
+        if len(input_shape) == 3:
+            self.forward_fn = spatial_batchnorm_forward
+            self.backward_fn = spatial_batchnorm_backward
+        D = input_shape[0]
+        self.gamma_key, self.beta_key = 'gamma%d' % index, 'beta%d' % index
+        params = {self.gamma_key: np.ones(D), self.beta_key: np.zeros(D)}
+        return params, input_shape
+
+    def bind(self, params):
+        self.gamma = params[self.gamma_key]
+        self.beta = params[self.beta_key]
+
+    def grads(self):
+        return ((self.gamma_key, self.dgamma), (self.beta_key, self.dbeta))
+
+    def forward(self, x):
+        out, self.cache = self.forward_fn(x, self.gamma, self.beta, self.param)
+        return out
+
+    def backward(self, dout):
+        dx, self.dgamma, self.dbeta = self.backward_fn(dout, self.cache)
+        self.cache = None
+        return dx
+
+
+class ReLU(Layer):
+    """
+    ReLU layer. Sequential switches it to work in place when the layer before
+    it does not keep its output in its cache.
+    """
+    __slots__ = ('forward_fn', 'cache')
+
+    def __init__(self):
+        self.forward_fn = relu_forward
+        self.cache = None
+
+    def forward(self, x):
+        out, self.cache = self.forward_fn(x)
+        return out
+
+    def backward(self, dout):
+        # Every backward pass hands down a freshly allocated gradient
+        dx = relu_backward_inplace(dout, self.cache)
+        self.cache = None
+        return dx
+
+
+class Dropout(Layer):
+    """
+    Inverted dropout layer that keeps each unit with probability p. Every
+    Dropout layer of a model draws its masks from its own DropoutStream.
+    """
+    __slots__ = ('param', 'seed', 'cache')
+    counter = 'dropout'
+
+    def __init__(self, p, seed=None, regenerate_mask=False):
+        self.param = {'mode': 'train', 'p': p,
+                      'regenerate_mask': regenerate_mask}
+        self.seed = seed
+        self.cache = None
+
+    def build(self, input_shape, index, weight_scale):
+        self.param['stream'] = DropoutStream(self.seed, index - 1)
+        return {}, input_shape
+
+    def forward(self, x):
+        out, self.cache = dropout_forward(x, self.param)
+        return out
+
+    def backward(self, dout):
+        dx = dropout_backward_inplace(dout, self.cache)
+        self.cache = None
+        return dx
+
+
+class SoftmaxLoss(Layer):
+    """
+    Softmax cross-entropy loss; must be the last layer of a Sequential.
+    """
+    __slots__ = ('cache',)
+
+    def __init__(self):
+        self.cache = None
+
+    def forward(self, scores, y):
+        """
+        Returns the data loss and keeps the gradient on the scores.
+        """
+        loss, self.cache = softmax_loss(scores, y)
+        return loss
+
+    def backward(self, dout=None):
+        dscores, self.cache = self.cache, None
+        return dscores
+
+
+class Sequential(object):
+    """
+    A network built from a list of layer objects, for example
+
+    model = Sequential([Conv(32, 5), BatchNorm(), ReLU(), Pool(2),
+                        Affine(100), ReLU(), Dropout(0.5),
+                        Affine(10), SoftmaxLoss()],
+                       input_dim=(3, 32, 32))
+
+    Weights and biases of the Affine and Conv layers are stored in
+    self.params as W1, b1, W2, b2, ... in layer order, and the scale and
+    shift of the BatchNorm layers as gamma1, beta1, ..., which matches the
+    naming used by FullyConnectedNet. The model follows the Solver API:
+    model.params maps names to arrays and model.loss(X, y) returns scores or
+    (loss, grads).
+
+    The forward and backward passes are compiled once into lists of bound
+    layer methods, so a call to loss does no per-layer branching or string
+    formatting.
+    """
+
+    def __init__(self, layers, input_dim=3*32*32, weight_scale=1e-2, reg=0.0,
+                 dtype=np.float32):
+        """
+        Initialize a new Sequential model.
+
+        Inputs:
+        - layers: List of layer objects; the last one must be a SoftmaxLoss.
+        - input_dim: Integer or tuple (C, H, W) giving the size of the input.
+        - weight_scale: Scalar giving the standard deviation for random
+          initialization of the weights.
+        - reg: Scalar giving L2 regularization strength of Affine and Conv
+          weights.
+        - dtype: A numpy datatype object; all computations will be performed
+          using this datatype.
+        """
+        if len(layers) == 0 or not isinstance(layers[-1], SoftmaxLoss):
+            raise ValueError('The last layer must be a SoftmaxLoss')
+        self.layers = list(layers)
+        self.reg = reg
+        self.dtype = dtype
+
+        # Predicted labels of the last training minibatch, set by loss(X, y)
+        self.train_predictions = None
+        self.params = {}
+
+        shape = tuple(input_dim) if np.ndim(input_dim) else (input_dim,)
+        counts = {}
+        prev = None
+        for layer in self.layers[:-1]:
+            index = counts[layer.counter] = counts.get(layer.counter, 0) + 1
+            params, shape = layer.build(shape, index, weight_scale)
+            self.params.update(params)
+
+            # Affine, Conv and BatchNorm outputs are fresh arrays that their
+            # caches do not reference, so a ReLU after them can overwrite them
+            if isinstance(layer, ReLU) and isinstance(prev, (Affine, Conv,
+                                                             BatchNorm)):
+                layer.forward_fn = relu_forward_inplace
+            prev = layer
+
+        for k, v in self.params.items():
+            self.params[k] = v.astype(dtype)
+
+        self._compile()
+
+
+    def _compile(self):
+        """
+        Precompute the forward and backward plans. Don't call this manually.
+        """
+        hidden = self.layers[:-1]
+        param_layers = [layer for layer in hidden if layer.counter in
+                        ('weight', 'norm')]
+        self._hidden = hidden
+        self._loss_layer = self.layers[-1]
+        self._forward_plan = [layer.forward for layer in hidden]
+        self._backward_plan = [layer.backward for layer in reversed(hidden)]
+        self._bind_plan = [layer.bind for layer in param_layers]
+        self._grad_plan = [layer.grads for layer in param_layers]
+        self._weight_layers = [layer for layer in hidden
+                               if layer.counter == 'weight']
+        self._mode_params = [layer.param for layer in hidden
+                             if isinstance(layer, (BatchNorm, Dropout))]
+        self.bn_params = [layer.param for layer in hidden
+                          if isinstance(layer, BatchNorm)]
+        self.dropout_params = [layer.param for layer in hidden
+                               if isinstance(layer, Dropout)]
+
+
+    def loss(self, X, y=None):
+        """
+        Compute loss and gradient for a minibatch of data.
+
+        Input / output: Same as TwoLayerNet in fc_net.py.
+        """
+        X = X.astype(self.dtype)
+        mode = 'test' if y is None else 'train'
+        for param in self._mode_params:
+            param['mode'] = mode
+        for bind in self._bind_plan:
+            bind(self.params)
+
+        out = X
+        for forward in self._forward_plan:
+            out = forward(out)
+
+        if mode == 'test':
+            for layer in self._hidden:
+                layer.cache = None
+            return out
+
+        reg = self.reg
+        self.train_predictions = np.argmax(out, axis=1)
+        loss = self._loss_layer.forward(out, y)
+        for layer in self._weight_layers:
+            loss += 0.5 * reg * np.sum(layer.w * layer.w)
+
+        dout = self._loss_layer.backward()
+        for backward in self._backward_plan:
+            dout = backward(dout)
+
+        grads = {}
+        for layer_grads in self._grad_plan:
+            grads.update(layer_grads())
+        for layer in self._weight_layers:
+            layer.dw += reg * layer.w
+
+        return loss, grads
@@ -0,0 +1,314 @@
+from __future__ import division
+from builtins import range
+from builtins import object
+import copy
+import mmap
+import multiprocessing
+import threading
+import traceback
+import numpy as np
+
+from cs231n.flat_params import flatten_params
+
+"""
+This file implements synchronous data-parallel training for the Solver.
+
+With data_parallel=K the training process runs one replica of the model and
+forks K - 1 worker processes, each holding another replica. At every step
+the minibatch is split into K contiguous shards, every replica computes the
+loss and the gradient of its shard, and the gradients are summed with an
+all-reduce through shared memory:
+
+- model.params lives in one flat buffer (see flat_params.py) in shared
+  memory, so all replicas read the same parameters and an update needs no
+  broadcast;
+- every replica writes its gradient, weighted by the size of its shard, into
+  its own row of a shared (K, P) array, P being the number of parameters;
+- after a barrier, replica r adds up column block r of the K rows into row 0
+  (a reduce-scatter: the K replicas each sum 1/K of the parameters, in
+  parallel), and after another barrier row 0, which is FlatParams.grad of
+  the training process, holds the gradient of the whole minibatch.
+
+The training process then applies the update rule once to the flat buffer,
+as with flat_params=True, while the workers wait for the next minibatch.
+Batchnorm running averages are combined as if the whole minibatch had been
+normalized at once and are handed to the workers with the next minibatch.
+
+The shared arrays are anonymous shared memory mapped before the workers are
+forked, so they need no names and are freed with the Solver. Workers seed
+np.random from a seed, the step number and their rank at every step, and use
+their own DropoutStream replicas, so dropout differs between shards and a
+run is reproducible for a given K. Every process runs its own BLAS threads;
+with C cores, limiting them to about C / K (e.g. with OMP_NUM_THREADS)
+avoids oversubscription.
+"""
+
+
+_STEP, _STOP = 1, 2
+
+
+def _shared_array(shape, dtype):
+    """
+    Returns a zero-filled array in anonymous shared memory, which processes
+    forked afterwards share with this one.
+    """
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape))
+    buf = mmap.mmap(-1, max(count * dtype.itemsize, 1))
+    return np.frombuffer(buf, dtype=dtype, count=count).reshape(shape)
+
+
+class DataParallel(object):
+    """
+    Computes the loss and gradient of minibatches with K model replicas in
+    K processes.
+    """
+
+    def __init__(self, model, num_replicas, batch_size, X, y):
+        """
+        Move model.params into shared memory and allocate the buffers of the
+        all-reduce. No process is forked until start().
+
+        Inputs:
+        - model: A model following the Solver API
+        - num_replicas: Number of replicas K, including the calling process
+        - batch_size: Largest minibatch size
+        - X, y: Training data and labels, for the shapes and dtypes of the
+          minibatches
+        """
+        if num_replicas < 2:
+            raise ValueError('Invalid number of replicas %d' % num_replicas)
+        if batch_size < num_replicas:
+            raise ValueError('Batch size %d is smaller than the number of '
+                             'replicas' % batch_size)
+        self.model = model
+        self.num_replicas = K = num_replicas
+        params = model.params
+        dtype = np.result_type(*params.values())
+        P = sum(w.size for w in params.values())
+        self._grads = _shared_array((K, P), dtype)
+        self.flat = flatten_params(model, data=_shared_array(P, dtype),
+                                   grad=self._grads[0])
+        self._chunks = np.linspace(0, P, K + 1).astype(int)
+
+        X_dtype = np.result_type(X.dtype, getattr(model, 'dtype', X.dtype))
+        self._X = _shared_array((batch_size,) + X.shape[1:], X_dtype)
+        self._y = _shared_array(batch_size, y.dtype)
+        self._preds = _shared_array(batch_size, np.intp)
+        self._losses = _shared_array(K, np.float64)
+        # step or stop, iteration, seed, batch size, loss scale, ignore
+        # overflows
+        self._ctrl = _shared_array(6, np.float64)
+        self._bn = []
+        self._workers = []
+        self._barrier = None
+        self._errors = None
+
+
+    def _setup_batchnorm(self):
+        """
+        Allocate the shared running averages of the batchnorm layers: one
+        array each for the averages handed to the workers, and one row per
+        replica for the averages updated by the replicas.
+        """
+        bn_params = getattr(self.model, 'bn_params', [])
+        if any('running_mean' not in p for p in bn_params):
+            # The first training pass creates the running averages; make them
+            # now with a pass of a copy of the model
+            probe = copy.deepcopy(self.model)
+            probe.loss(self._X[:2], self._y[:2])
+            for p, q in zip(bn_params, probe.bn_params):
+                for k in ('running_mean', 'running_var'):
+                    if k not in p:
+                        p[k] = np.zeros_like(q[k])
+        self._bn = []
+        for p in bn_params:
+            mean, var = p['running_mean'], p['running_var']
+            self._bn.append((p, _shared_array(mean.shape, mean.dtype),
+                             _shared_array(var.shape, var.dtype),
+                             _shared_array((self.num_replicas,) + mean.shape,
+                                           mean.dtype),
+                             _shared_array((self.num_replicas,) + var.shape,
+                                           var.dtype)))
+
+
+    def start(self):
+        """
+        Fork the worker processes, unless they are running. The workers copy
+        the state of the model (except the parameters, which are shared)
+        when they are forked.
+        """
+        if self._workers and not self._barrier.broken:
+            return
+        self.stop()
+        self._setup_batchnorm()
+        context = multiprocessing.get_context('fork')
+        self._barrier = context.Barrier(self.num_replicas)
+        self._errors = context.SimpleQueue()
+        for rank in range(1, self.num_replicas):
+            worker = context.Process(target=self._work, args=(rank,))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+
+    def stop(self):
+        """
+        Stop the worker processes.
+        """
+        if not self._workers:
+            return
+        if not self._barrier.broken:
+            self._ctrl[0] = _STOP
+            try:
+                self._barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+
+    def _work(self, rank):
+        """
+        Worker process: run steps until stopped.
+        """
+        model = self.model
+        for p in getattr(model, 'dropout_params', []):
+            if p.get('stream') is not None:
+                p['stream'] = p['stream'].for_replica(rank)
+        grads = self.flat.views(self._grads[rank])
+        try:
+            while True:
+                self._barrier.wait()
+                if self._ctrl[0] == _STOP:
+                    return
+                _, iteration, seed, N = self._ctrl[:4].astype(np.int64)
+                np.random.seed([seed, iteration, rank])
+                for p, mean, var, _, _ in self._bn:
+                    p['running_mean'], p['running_var'] = mean, var
+                self._compute(rank, self._X[:N], self._y[:N], grads)
+                self._barrier.wait()
+                self._reduce(rank)
+                self._barrier.wait()
+        except threading.BrokenBarrierError:
+            return
+        except Exception:
+            self._errors.put(traceback.format_exc())
+            self._barrier.abort()
+
+
+    def _compute(self, rank, X, y, grads):
+        """
+        Compute the loss and gradient of the shard of replica rank of the
+        minibatch (X, y) and write them, weighted, into the shared arrays.
+        """
+        N = X.shape[0]
+        bounds = np.linspace(0, N, self.num_replicas + 1).astype(int)
+        start, end = bounds[rank], bounds[rank + 1]
+        weight = (end - start) / N
+        model = self.model
+        if hasattr(model, 'loss_scale'):
+            model.loss_scale = self._ctrl[4]
+        if self._ctrl[5]:
+            with np.errstate(over='ignore', invalid='ignore'):
+                loss, shard_grads = model.loss(X[start:end], y[start:end])
+        else:
+            loss, shard_grads = model.loss(X[start:end], y[start:end])
+        for k, dw in grads.items():
+            np.multiply(shard_grads[k], weight, out=dw)
+        self._losses[rank] = weight * loss
+        for p, _, _, means, variances in self._bn:
+            means[rank] = p['running_mean']
+            variances[rank] = p['running_var']
+        y_pred = getattr(model, 'train_predictions', None)
+        if y_pred is not None:
+            self._preds[start:end] = y_pred
+
+
+    def _reduce(self, rank):
+        """
+        Add column block rank of the gradients of all replicas into row 0.
+        """
+        lo, hi = self._chunks[rank], self._chunks[rank + 1]
+        total = self._grads[0, lo:hi]
+        for r in range(1, self.num_replicas):
+            total += self._grads[r, lo:hi]
+
+
+    def _combine_batchnorm(self, saved, weights):
+        """
+        Set the running averages of the model from the averages updated by
+        the replicas, recovering the mean and variance of every shard from
+        running = momentum * old + (1 - momentum) * shard statistic.
+        """
+        weights = np.asarray(weights)[:, None]
+        for (p, _, _, means, variances), (old_mean, old_var) in zip(self._bn,
+                                                                    saved):
+            momentum = p.get('momentum', 0.9)
+            shard_means = (means - momentum * old_mean) / (1 - momentum)
+            shard_vars = (variances - momentum * old_var) / (1 - momentum)
+            mean = np.sum(weights * shard_means, axis=0)
+            var = np.sum(weights * (shard_vars + (shard_means - mean) ** 2),
+                         axis=0)
+            p['running_mean'] = (momentum * old_mean +
+                                 (1 - momentum) * mean).astype(old_mean.dtype)
+            p['running_var'] = (momentum * old_var +
+                                (1 - momentum) * var).astype(old_var.dtype)
+
+
+    def _wait(self):
+        try:
+            self._barrier.wait()
+        except threading.BrokenBarrierError:
+            error = 'a worker stopped'
+            if not self._errors.empty():
+                error = self._errors.get()
+            raise RuntimeError('Data-parallel worker failed:\n%s' % error)
+
+
+    def loss(self, X_batch, y_batch, iteration, seed):
+        """
+        Compute the loss and gradient of a minibatch across the replicas.
+
+        Inputs:
+        - X_batch, y_batch: The minibatch
+        - iteration: Number of the step, which seeds the workers' random
+          state together with seed
+        - seed: Integer seed of the run
+
+        Returns a tuple of:
+        - loss: Loss of the minibatch
+        - grads: Dictionary of views of FlatParams.grad holding the gradient
+          of the minibatch; model.train_predictions holds the predictions of
+          the whole minibatch if the model sets it
+        """
+        N = X_batch.shape[0]
+        bounds = np.linspace(0, N, self.num_replicas + 1).astype(int)
+        self._X[bounds[1]:N] = X_batch[bounds[1]:]
+        self._y[bounds[1]:N] = y_batch[bounds[1]:]
+        loss_scale = getattr(self.model, 'loss_scale', 1.0)
+        ignore = np.geterr()['over'] == 'ignore'
+        self._ctrl[:] = (_STEP, iteration, seed, N, loss_scale, ignore)
+        saved = []
+        for p, mean, var, _, _ in self._bn:
+            np.copyto(mean, p['running_mean'])
+            np.copyto(var, p['running_var'])
+            saved.append((p['running_mean'], p['running_var']))
+
+        # Any error on the way stops the workers, so that they never wait
+        # at another barrier than this process
+        self._wait()
+        try:
+            self._compute(0, X_batch, y_batch, self.flat.grads)
+            self._wait()
+            self._reduce(0)
+            self._wait()
+        except BaseException:
+            self._barrier.abort()
+            raise
+
+        self._combine_batchnorm(saved, np.diff(bounds) / N)
+        if getattr(self.model, 'train_predictions', None) is not None:
+            self.model.train_predictions = self._preds[:N]
+        return float(np.sum(self._losses)), self.flat.grads
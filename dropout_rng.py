@@ -0,0 +1,122 @@
+from builtins import object
+import numpy as np
+
+"""
+This file implements counter-based random streams for dropout layers.
+
+The legacy dropout path draws its masks from the global np.random state, which
+is slow (float64 uniforms from MT19937) and makes the masks depend on the order
+in which layers consume random numbers. A DropoutStream instead derives the
+uniforms for its k-th mask purely from (seed, stream_id, k) using the Philox
+counter-based generator, so:
+
+- every dropout layer can own an independent stream (one stream_id per layer);
+- the masks are reproducible no matter how layers are scheduled across
+  threads, since no state is shared between streams;
+- a mask can be regenerated later from its counter alone, so the backward
+  pass does not need to keep the mask alive in the cache.
+
+To use a stream, put it in the dropout_param dictionary passed to
+dropout_forward under the key 'stream'. Set 'regenerate_mask' to True to cache
+only the counter and recompute the mask in dropout_backward.
+"""
+
+
+class DropoutStream(object):
+    """
+    An independent, counter-based source of dropout masks for one layer.
+    """
+
+    def __init__(self, seed=None, stream_id=0, replica=0):
+        """
+        Construct a new stream.
+
+        Inputs:
+        - seed: Integer seed shared by all streams of a model. If None, fresh
+          entropy is drawn from the operating system.
+        - stream_id: Integer identifying this stream among the streams that
+          share the same seed; typically the index of the dropout layer.
+        - replica: Index of the data-parallel replica of the model the stream
+          belongs to (see data_parallel.py); the streams of different
+          replicas are independent. Replica 0 is the stream of the model
+          itself.
+        """
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+        self.stream_id = stream_id
+        self.replica = replica
+        self.counter = 0
+
+        # Philox takes a 128 bit key; mix seed and stream_id into it with a
+        # SeedSequence so that neighbouring streams are well separated.
+        spawn_key = (stream_id,) if replica == 0 else (stream_id, replica)
+        seed_seq = np.random.SeedSequence(seed, spawn_key=spawn_key)
+        self._key = seed_seq.generate_state(2, np.uint64)
+
+    def for_replica(self, replica):
+        """
+        Returns the stream of the same layer in another data-parallel replica,
+        starting from the current counter.
+        """
+        stream = DropoutStream(self.seed, self.stream_id, replica)
+        stream.counter = self.counter
+        return stream
+
+    def advance(self):
+        """
+        Reserve the next counter value of this stream and return it.
+        """
+        counter = self.counter
+        self.counter += 1
+        return counter
+
+    def uniform(self, shape, counter, dtype=np.float32):
+        """
+        Uniform samples in [0, 1) for the given counter value.
+
+        The same (seed, stream_id, counter) always gives the same samples. The
+        counter is placed in the most significant word of the Philox counter,
+        so the samples drawn for different counters never overlap.
+
+        Inputs:
+        - shape: Shape of the array of samples
+        - counter: Non-negative integer, usually obtained from advance()
+        - dtype: np.float32 (the default, fastest) or np.float64
+
+        Returns:
+        - u: Array of the given shape and dtype
+        """
+        bit_generator = np.random.Philox(key=self._key,
+                                         counter=[0, 0, 0, counter])
+        return np.random.Generator(bit_generator).random(shape, dtype=dtype)
+
+    def keep_mask(self, shape, p, counter):
+        """
+        Boolean dropout mask for the given counter value.
+
+        Inputs:
+        - shape: Shape of the mask
+        - p: Probability of keeping each unit
+        - counter: Counter value the mask belongs to
+
+        Returns:
+        - keep: Boolean array of the given shape that is True for kept units
+        """
+        return self.uniform(shape, counter) < p
+
+
+def make_dropout_streams(num_streams, seed=None):
+    """
+    Create independent streams for the dropout layers of one model.
+
+    Inputs:
+    - num_streams: Number of dropout layers
+    - seed: Integer seed shared by the streams, or None for fresh entropy
+
+    Returns:
+    - streams: List of DropoutStream with stream ids 0, ..., num_streams - 1
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    return [DropoutStream(seed, i) for i in range(num_streams)]
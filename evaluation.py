@@ -0,0 +1,445 @@
+from __future__ import division
+from builtins import range
+from builtins import object
+import copy
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+from cs231n.inference import Predictor, can_predict
+
+"""
+This file implements the accuracy evaluation engine of the Solver.
+
+An Evaluator computes the accuracy of a model on one or more datasets, each
+given as (X, y, index) where index selects the rows to evaluate (None for
+all of them). It runs the compiled cache-free forward pass of inference.py
+when the model supports it (model.loss(X) otherwise), in batches of
+batch_size; a subsample is gathered one batch at a time into a reused
+buffer instead of being copied out of X as a whole.
+
+It can evaluate in three ways:
+
+- serially in the calling thread (num_workers=0, background=False);
+- in a background thread (num_workers=0, background=True), on a replica of
+  the model that is loaded with a snapshot of the parameters, so that
+  training can keep updating the model meanwhile;
+- in a pool of num_workers processes, each holding a replica of the model.
+  Every dataset is split into one contiguous shard per worker. The workers
+  read their shards from shared memory: arrays listed in shared (such as
+  X_val) are copied into shared memory once when the pool starts, and the
+  selected rows of any other array (such as a subsample of X_train) are
+  gathered into a shared staging buffer for every evaluation. The
+  parameters and batchnorm statistics are copied into one shared buffer per
+  evaluation. With background=False submit() returns once the evaluation is
+  queued and result() waits for it; with background=True the caller is
+  expected to collect the result later.
+
+Arrays in shared are read while an evaluation runs and must not be
+modified by the caller in the meantime; every other array is only read
+during submit(). At most one evaluation is in flight: submit() waits for the
+previous one.
+"""
+
+
+_RUNNING_STATS = ('running_mean', 'running_var')
+
+
+def _align(offset):
+    return (offset + 63) // 64 * 64
+
+
+class _Segment(object):
+    """
+    A block of shared memory of at least size bytes.
+    """
+
+    def __init__(self, size):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.size = self.shm.size
+
+    def array(self, shape, dtype, offset=0):
+        return np.ndarray(shape, dtype, buffer=self.shm.buf, offset=offset)
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class _Replica(object):
+    """
+    A model and its forward pass, as used by one evaluation thread or
+    worker process.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.predictor = Predictor(model) if can_predict(model) else None
+        self._gather = None
+        self._segments = {}
+        self._version = None
+
+
+    def set_state(self, params, bn_stats):
+        """
+        Load parameters and a list of batchnorm running statistics (one
+        dictionary per entry of model.bn_params) into the model.
+        """
+        self.model.params = params
+        for bn_param, stats in zip(getattr(self.model, 'bn_params', []),
+                                   bn_stats):
+            for k in _RUNNING_STATS:
+                if k in stats:
+                    bn_param[k] = stats[k]
+                else:
+                    bn_param.pop(k, None)
+
+
+    def _view(self, spec):
+        name, offset, shape, dtype = spec
+        if name not in self._segments:
+            self._segments[name] = shared_memory.SharedMemory(name=name)
+        return np.ndarray(shape, dtype, buffer=self._segments[name].buf,
+                          offset=offset)
+
+
+    def load_shared(self, version, state_spec):
+        """
+        Load the parameters of evaluation version from shared memory, unless
+        they are already loaded.
+        """
+        if version == self._version:
+            return
+        param_specs, bn_specs = state_spec
+        params = {k: self._view(spec) for k, spec in param_specs.items()}
+        bn_stats = [{k: self._view(spec) for k, spec in stats.items()}
+                    for stats in bn_specs]
+        self.set_state(params, bn_stats)
+        self._version = version
+
+
+    def predict(self, X, index=None, batch_size=1000):
+        """
+        Predict the labels of X, or of X[index], batch_size rows at a time.
+        """
+        N = X.shape[0] if index is None else len(index)
+        y_pred = np.empty(N, dtype=np.intp)
+        for start in range(0, N, batch_size):
+            end = min(start + batch_size, N)
+            if index is None:
+                X_batch = X[start:end]
+            else:
+                shape = (batch_size,) + X.shape[1:]
+                if self._gather is None or self._gather.dtype != X.dtype or \
+                   self._gather.shape != shape:
+                    self._gather = np.empty(shape, dtype=X.dtype)
+                X_batch = self._gather[:end - start]
+                np.take(X, index[start:end], axis=0, out=X_batch, mode='clip')
+            if self.predictor is not None:
+                self.predictor.batch_size = batch_size
+                y_pred[start:end] = self.predictor.predict(X_batch)
+            else:
+                scores = self.model.loss(X_batch)
+                np.argmax(scores, axis=1, out=y_pred[start:end])
+        return y_pred
+
+
+# The replica of a worker process, set up by _init_worker
+_worker_replica = None
+
+
+def _init_worker(model):
+    global _worker_replica
+    _worker_replica = _Replica(model)
+
+
+def _predict_shard(task):
+    """
+    Worker process: predict the labels of one shard of a dataset.
+    """
+    version, state_spec, source_spec, index, start, end, batch_size = task
+    replica = _worker_replica
+    replica.load_shared(version, state_spec)
+    X = replica._view(source_spec)
+    if index is None:
+        return replica.predict(X[start:end], batch_size=batch_size)
+    return replica.predict(X, index, batch_size)
+
+
+class Evaluation(object):
+    """
+    The pending result of Evaluator.submit().
+    """
+
+    def __init__(self, labels, fetch):
+        self._labels = labels
+        self._fetch = fetch
+        self._accs = None
+
+
+    def result(self):
+        """
+        Wait for the evaluation and return a list with the accuracy of every
+        dataset.
+        """
+        if self._accs is None:
+            y_preds = self._fetch()
+            self._accs = [np.mean(y_pred == y)
+                          for y_pred, y in zip(y_preds, self._labels)]
+            self._fetch = None
+        return self._accs
+
+
+class Evaluator(object):
+    """
+    Computes classification accuracies, optionally in worker processes or in
+    the background.
+
+    Example usage:
+
+    evaluator = Evaluator(model, batch_size=1000, num_workers=4,
+                          shared=[X_val])
+    val_acc, = evaluator.submit([(X_val, y_val, None)]).result()
+    evaluator.close()
+    """
+
+    def __init__(self, model, batch_size=1000, num_workers=0, background=False,
+                 shared=()):
+        """
+        Inputs:
+        - model: The model to evaluate; its parameters and batchnorm running
+          statistics are read at every submit()
+        - batch_size: Number of examples to run through the network at once
+        - num_workers: Number of worker processes; 0 evaluates in this process
+        - background: If True, evaluate in a background thread (or in the
+          worker processes) on a snapshot of the parameters
+        - shared: Arrays read in place during an evaluation; with
+          num_workers > 0 they are copied into shared memory once
+        """
+        if num_workers < 0:
+            raise ValueError('Invalid num_workers %d' % num_workers)
+        self.model = model
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.background = background
+        self._shared_ids = set(id(X) for X in shared)
+        self._shared = list(shared)
+        self._local = None
+        self._executor = None
+        self._pool = None
+        self._segments = {}
+        self._staging = []
+        self._state_segment = None
+        self._version = 0
+        self._pending = None
+
+
+    def _start_pool(self):
+        # Shared memory is created before the workers start, so that they
+        # share the resource tracker of this process
+        for X in self._shared:
+            segment = _Segment(X.nbytes)
+            np.copyto(segment.array(X.shape, X.dtype), X)
+            self._segments[id(X)] = (segment, X.shape, X.dtype.str)
+        self._pool = multiprocessing.Pool(self.num_workers,
+                                          initializer=_init_worker,
+                                          initargs=(self.model,))
+
+
+    def _bn_stats(self):
+        return [{k: np.array(bn_param[k]) for k in _RUNNING_STATS
+                 if k in bn_param}
+                for bn_param in getattr(self.model, 'bn_params', [])]
+
+
+    def _share_state(self, params, bn_stats):
+        """
+        Copy parameters and batchnorm statistics into the shared state buffer
+        and return the specs the workers load them from.
+        """
+        arrays = [params] + bn_stats
+        size = 0
+        for group in arrays:
+            for a in group.values():
+                size = _align(size) + a.nbytes
+        if self._state_segment is None or self._state_segment.size < size:
+            if self._state_segment is not None:
+                self._state_segment.close()
+            self._state_segment = _Segment(size)
+        segment = self._state_segment
+
+        specs = []
+        offset = 0
+        for group in arrays:
+            spec = {}
+            for k, a in group.items():
+                offset = _align(offset)
+                a = np.asarray(a)
+                np.copyto(segment.array(a.shape, a.dtype, offset), a)
+                spec[k] = (segment.shm.name, offset, a.shape, a.dtype.str)
+                offset += a.nbytes
+            specs.append(spec)
+        return specs[0], specs[1:]
+
+
+    def _stage(self, slot, X, index):
+        """
+        Gather X[index] into shared staging buffer slot and return its spec.
+        """
+        n = X.shape[0] if index is None else len(index)
+        shape = (n,) + X.shape[1:]
+        nbytes = int(np.prod(shape)) * X.dtype.itemsize
+        while len(self._staging) <= slot:
+            self._staging.append(None)
+        segment = self._staging[slot]
+        if segment is None or segment.size < nbytes:
+            if segment is not None:
+                segment.close()
+            segment = self._staging[slot] = _Segment(nbytes)
+        out = segment.array(shape, X.dtype)
+        if index is None:
+            np.copyto(out, X)
+        else:
+            np.take(X, index, axis=0, out=out, mode='clip')
+        return (segment.shm.name, 0, shape, X.dtype.str)
+
+
+    def _submit_pool(self, datasets, params, batch_size):
+        if self._pool is None:
+            self._start_pool()
+        self._version += 1
+        state_spec = self._share_state(params, self._bn_stats())
+        results = []
+        for slot, (X, y, index) in enumerate(datasets):
+            if id(X) in self._segments:
+                segment, shape, dtype = self._segments[id(X)]
+                source_spec = (segment.shm.name, 0, shape, dtype)
+                shard_index = index
+            else:
+                source_spec = self._stage(slot, X, index)
+                shard_index = None
+            N = X.shape[0] if index is None else len(index)
+            shard = -(-N // self.num_workers)
+            tasks = []
+            for start in range(0, N, shard):
+                end = min(start + shard, N)
+                if shard_index is None:
+                    tasks.append((self._version, state_spec, source_spec,
+                                  None, start, end, batch_size))
+                else:
+                    tasks.append((self._version, state_spec, source_spec,
+                                  shard_index[start:end], 0, 0, batch_size))
+            results.append(self._pool.map_async(_predict_shard, tasks))
+
+        def fetch():
+            y_preds = []
+            for r in results:
+                shards = r.get()
+                y_preds.append(np.concatenate(shards) if shards
+                               else np.empty(0, dtype=np.intp))
+            return y_preds
+        return fetch
+
+
+    def _submit_thread(self, datasets, params, batch_size):
+        if self._executor is None:
+            self._local = _Replica(copy.deepcopy(self.model))
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        # Arrays that are not shared may change once submit() returns
+        local = []
+        for X, _, index in datasets:
+            if id(X) in self._shared_ids:
+                local.append((X, index))
+            else:
+                local.append((X.copy() if index is None else X[index], None))
+        bn_stats = self._bn_stats()
+        replica = self._local
+
+        def run():
+            replica.set_state(params, bn_stats)
+            return [replica.predict(X, index, batch_size)
+                    for X, index in local]
+        return self._executor.submit(run).result
+
+
+    def submit(self, datasets, params=None, batch_size=None):
+        """
+        Start the evaluation of datasets.
+
+        Inputs:
+        - datasets: List of tuples (X, y, index), where index is an array of
+          the rows of X and y to evaluate, or None for all rows
+        - params: Parameters to evaluate, keyed like model.params; default is
+          the current model.params. In background mode they must not be
+          modified until the evaluation is done.
+        - batch_size: Overrides the batch size of the Evaluator
+
+        Returns:
+        - evaluation: An Evaluation; evaluation.result() returns the list of
+          accuracies, one per dataset
+        """
+        self.wait()
+        if batch_size is None:
+            batch_size = self.batch_size
+        labels = [y if index is None else y[index] for _, y, index in datasets]
+
+        if self.num_workers > 0:
+            if params is None:
+                params = self.model.params
+            fetch = self._submit_pool(datasets, params, batch_size)
+        elif self.background:
+            if params is None:
+                params = {k: v.copy() for k, v in self.model.params.items()}
+            fetch = self._submit_thread(datasets, params, batch_size)
+        else:
+            if self._local is None or self._local.model is not self.model:
+                self._local = _Replica(self.model)
+            live = self.model.params
+            if params is not None:
+                self.model.params = params
+            try:
+                y_preds = [self._local.predict(X, index, batch_size)
+                           for X, _, index in datasets]
+            finally:
+                self.model.params = live
+            fetch = lambda: y_preds
+
+        self._pending = Evaluation(labels, fetch)
+        return self._pending
+
+
+    def wait(self):
+        """
+        Wait for the evaluation in flight, if any.
+        """
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+
+    def close(self):
+        """
+        Wait for the evaluation in flight, stop the workers and free the
+        shared memory. The Evaluator can be used again afterwards.
+        """
+        try:
+            self.wait()
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+                self._local = None
+            segments = [s for s, _, _ in self._segments.values()]
+            segments += [s for s in self._staging if s is not None]
+            if self._state_segment is not None:
+                segments.append(self._state_segment)
+            for segment in segments:
+                segment.close()
+            self._segments = {}
+            self._staging = []
+            self._state_segment = None
@@ -9,12 +9,16 @@ except ImportError:
     print('You may also need to restart your iPython kernel')
 
 from cs231n.im2col import *
+from cs231n.layers import _store
 
 
-def conv_forward_im2col(x, w, b, conv_param):
+def conv_forward_im2col(x, w, b, conv_param, out=None):
     """
     A fast implementation of the forward pass for a convolutional layer
     based on im2col and col2im.
+
+    Like all functions in this file, it accepts optional preallocated output
+    buffers; see the note at the top of layers.py.
     """
     N, C, H, W = x.shape
     num_filters, _, filter_height, filter_width = w.shape
@@ -27,20 +31,19 @@ def conv_forward_im2col(x, w, b, conv_param):
     # Create output
     out_height = (H + 2 * pad - filter_height) // stride + 1
     out_width = (W + 2 * pad - filter_width) // stride + 1
-    out = np.zeros((N, num_filters, out_height, out_width), dtype=x.dtype)
 
     # x_cols = im2col_indices(x, w.shape[2], w.shape[3], pad, stride)
     x_cols = im2col_cython(x, w.shape[2], w.shape[3], pad, stride)
     res = w.reshape((w.shape[0], -1)).dot(x_cols) + b.reshape(-1, 1)
 
-    out = res.reshape(w.shape[0], out.shape[2], out.shape[3], x.shape[0])
-    out = out.transpose(3, 0, 1, 2)
+    res = res.reshape(w.shape[0], out_height, out_width, x.shape[0])
+    out = _store(res.transpose(3, 0, 1, 2), out)
 
     cache = (x, w, b, conv_param, x_cols)
     return out, cache
 
 
-def conv_forward_strides(x, w, b, conv_param):
+def conv_forward_strides(x, w, b, conv_param, out=None):
     N, C, H, W = x.shape
     F, _, HH, WW = w.shape
     stride, pad = conv_param['stride'], conv_param['pad']
@@ -69,11 +72,12 @@ def conv_forward_strides(x, w, b, conv_param):
     x_cols.shape = (C * HH * WW, N * out_h * out_w)
 
     # Now all our convolutions are a big matrix multiply
-    res = w.reshape(F, -1).dot(x_cols) + b.reshape(-1, 1)
+    res = w.reshape(F, -1).dot(x_cols)
+    res += b.reshape(-1, 1)
 
     # Reshape the output
     res.shape = (F, N, out_h, out_w)
-    out = res.transpose(1, 0, 2, 3)
+    out = _store(res.transpose(1, 0, 2, 3), out)
 
     # Be nice and return a contiguous array
     # The old version of conv_forward_fast doesn't do this, so for a fair
@@ -84,7 +88,7 @@ def conv_forward_strides(x, w, b, conv_param):
     return out, cache
 
 
-def conv_backward_strides(dout, cache):
+def conv_backward_strides(dout, cache, dx_out=None, dw_out=None, db_out=None):
     x, w, b, conv_param, x_cols = cache
     stride, pad = conv_param['stride'], conv_param['pad']
 
@@ -92,19 +96,24 @@ def conv_backward_strides(dout, cache):
     F, _, HH, WW = w.shape
     _, _, out_h, out_w = dout.shape
 
-    db = np.sum(dout, axis=(0, 2, 3))
+    db = np.sum(dout, axis=(0, 2, 3), out=db_out)
 
     dout_reshaped = dout.transpose(1, 0, 2, 3).reshape(F, -1)
-    dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+    if dw_out is None:
+        dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+    else:
+        dw = dw_out
+        np.dot(dout_reshaped, x_cols.T, out=dw.reshape(F, -1))
 
     dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
     dx_cols.shape = (C, HH, WW, N, out_h, out_w)
-    dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
+    dx = _store(col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride),
+                dx_out)
 
     return dx, dw, db
 
 
-def conv_backward_im2col(dout, cache):
+def conv_backward_im2col(dout, cache, dx_out=None, dw_out=None, db_out=None):
     """
     A fast implementation of the backward pass for a convolutional layer
     based on im2col and col2im.
@@ -112,16 +121,21 @@ def conv_backward_im2col(dout, cache):
     x, w, b, conv_param, x_cols = cache
     stride, pad = conv_param['stride'], conv_param['pad']
 
-    db = np.sum(dout, axis=(0, 2, 3))
+    db = np.sum(dout, axis=(0, 2, 3), out=db_out)
 
     num_filters, _, filter_height, filter_width = w.shape
     dout_reshaped = dout.transpose(1, 2, 3, 0).reshape(num_filters, -1)
-    dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+    if dw_out is None:
+        dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+    else:
+        dw = dw_out
+        np.dot(dout_reshaped, x_cols.T, out=dw.reshape(num_filters, -1))
 
     dx_cols = w.reshape(num_filters, -1).T.dot(dout_reshaped)
     # dx = col2im_indices(dx_cols, x.shape, filter_height, filter_width, pad, stride)
     dx = col2im_cython(dx_cols, x.shape[0], x.shape[1], x.shape[2], x.shape[3],
                        filter_height, filter_width, pad, stride)
+    dx = _store(dx, dx_out)
 
     return dx, dw, db
 
@@ -130,7 +144,7 @@ conv_forward_fast = conv_forward_strides
 conv_backward_fast = conv_backward_strides
 
 
-def max_pool_forward_fast(x, pool_param):
+def max_pool_forward_fast(x, pool_param, out=None):
     """
     A fast implementation of the forward pass for a max pooling layer.
 
@@ -146,15 +160,15 @@ def max_pool_forward_fast(x, pool_param):
     same_size = pool_height == pool_width == stride
     tiles = H % pool_height == 0 and W % pool_width == 0
     if same_size and tiles:
-        out, reshape_cache = max_pool_forward_reshape(x, pool_param)
+        out, reshape_cache = max_pool_forward_reshape(x, pool_param, out=out)
         cache = ('reshape', reshape_cache)
     else:
-        out, im2col_cache = max_pool_forward_im2col(x, pool_param)
+        out, im2col_cache = max_pool_forward_im2col(x, pool_param, out=out)
         cache = ('im2col', im2col_cache)
     return out, cache
 
 
-def max_pool_backward_fast(dout, cache):
+def max_pool_backward_fast(dout, cache, dx_out=None):
     """
     A fast implementation of the backward pass for a max pooling layer.
 
@@ -163,14 +177,14 @@ def max_pool_backward_fast(dout, cache):
     """
     method, real_cache = cache
     if method == 'reshape':
-        return max_pool_backward_reshape(dout, real_cache)
+        return max_pool_backward_reshape(dout, real_cache, dx_out=dx_out)
     elif method == 'im2col':
-        return max_pool_backward_im2col(dout, real_cache)
+        return max_pool_backward_im2col(dout, real_cache, dx_out=dx_out)
     else:
         raise ValueError('Unrecognized method "%s"' % method)
 
 
-def max_pool_forward_reshape(x, pool_param):
+def max_pool_forward_reshape(x, pool_param, out=None):
     """
     A fast implementation of the forward pass for the max pooling layer that uses
     some clever reshaping.
@@ -185,13 +199,13 @@ def max_pool_forward_reshape(x, pool_param):
     assert W % pool_height == 0
     x_reshaped = x.reshape(N, C, H // pool_height, pool_height,
                            W // pool_width, pool_width)
-    out = x_reshaped.max(axis=3).max(axis=4)
+    out = x_reshaped.max(axis=3).max(axis=4, out=out)
 
     cache = (x, x_reshaped, out)
     return out, cache
 
 
-def max_pool_backward_reshape(dout, cache):
+def max_pool_backward_reshape(dout, cache, dx_out=None):
     """
     A fast implementation of the backward pass for the max pooling layer that
     uses some clever broadcasting and reshaping.
@@ -210,19 +224,23 @@ def max_pool_backward_reshape(dout, cache):
     """
     x, x_reshaped, out = cache
 
-    dx_reshaped = np.zeros_like(x_reshaped)
+    if dx_out is None:
+        dx_reshaped = np.zeros_like(x_reshaped)
+    else:
+        dx_reshaped = dx_out.reshape(x_reshaped.shape)
+        dx_reshaped.fill(0)
     out_newaxis = out[:, :, :, np.newaxis, :, np.newaxis]
     mask = (x_reshaped == out_newaxis)
     dout_newaxis = dout[:, :, :, np.newaxis, :, np.newaxis]
     dout_broadcast, _ = np.broadcast_arrays(dout_newaxis, dx_reshaped)
     dx_reshaped[mask] = dout_broadcast[mask]
     dx_reshaped /= np.sum(mask, axis=(3, 5), keepdims=True)
-    dx = dx_reshaped.reshape(x.shape)
+    dx = dx_reshaped.reshape(x.shape) if dx_out is None else dx_out
 
     return dx
 
 
-def max_pool_forward_im2col(x, pool_param):
+def max_pool_forward_im2col(x, pool_param, out=None):
     """
     An implementation of the forward pass for max pooling based on im2col.
 
@@ -240,16 +258,17 @@ def max_pool_forward_im2col(x, pool_param):
     out_width = (W - pool_width) // stride + 1
 
     x_split = x.reshape(N * C, 1, H, W)
-    x_cols = im2col(x_split, pool_height, pool_width, padding=0, stride=stride)
+    x_cols = im2col_indices(x_split, pool_height, pool_width, padding=0, stride=stride)
     x_cols_argmax = np.argmax(x_cols, axis=0)
     x_cols_max = x_cols[x_cols_argmax, np.arange(x_cols.shape[1])]
-    out = x_cols_max.reshape(out_height, out_width, N, C).transpose(2, 3, 0, 1)
+    out = _store(x_cols_max.reshape(out_height, out_width, N, C)
+                 .transpose(2, 3, 0, 1), out)
 
     cache = (x, x_cols, x_cols_argmax, pool_param)
     return out, cache
 
 
-def max_pool_backward_im2col(dout, cache):
+def max_pool_backward_im2col(dout, cache, dx_out=None):
     """
     An implementation of the backward pass for max pooling based on im2col.
 
@@ -266,6 +285,6 @@ def max_pool_backward_im2col(dout, cache):
     dx_cols[x_cols_argmax, np.arange(dx_cols.shape[1])] = dout_reshaped
     dx = col2im_indices(dx_cols, (N * C, 1, H, W), pool_height, pool_width,
                 padding=0, stride=stride)
-    dx = dx.reshape(x.shape)
+    dx = _store(dx.reshape(x.shape), dx_out)
 
     return dx
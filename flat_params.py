@@ -0,0 +1,107 @@
+from builtins import object
+import numpy as np
+
+"""
+This file implements flat, contiguous storage for model parameters.
+
+Normally model.params maps each name to its own separately allocated array,
+so every operation on the whole model (an update rule, gradient clipping,
+weight decay, a reduction across processes) has to loop over the dictionary
+in Python. A FlatParams object instead keeps all parameters in one 1-D array
+and replaces the entries of model.params with views into it, and keeps a
+gradient array with the same layout. An operation on the whole model is then
+a single vectorized operation on FlatParams.data or FlatParams.grad.
+
+Models keep working unchanged, because they read their parameters from
+model.params on every call. Code that updates parameters must write into the
+views (or into data) instead of replacing the dictionary entries, or the
+entries will stop being part of the flat buffer.
+"""
+
+
+class FlatParams(object):
+    """
+    One contiguous buffer for a dictionary of parameters and their gradients.
+
+    Attributes:
+    - keys: Parameter names in the order they are laid out in the buffer
+    - data: 1-D array holding all parameter values
+    - grad: 1-D array with the same layout holding the gradients
+    - params: Dictionary mapping names to views of data
+    - grads: Dictionary mapping names to views of grad
+    """
+
+    def __init__(self, params, dtype=None, data=None, grad=None):
+        """
+        Copy params into a new flat buffer.
+
+        Inputs:
+        - params: Dictionary mapping names to arrays
+        - dtype: dtype of the buffer; by default the dtype of data if given,
+          else the common dtype of params
+        - data, grad: Optional preallocated 1-D arrays, with as many elements
+          as params together, to use as the buffers, e.g. in shared memory
+        """
+        self.keys = sorted(params)
+        if dtype is None and data is not None:
+            dtype = data.dtype
+        if dtype is None:
+            dtype = np.result_type(*[params[k] for k in self.keys])
+        sizes = [params[k].size for k in self.keys]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(int)
+        self.shapes = [params[k].shape for k in self.keys]
+
+        size = self.offsets[-1]
+        for buf in (data, grad):
+            if buf is not None and (buf.shape != (size,) or buf.dtype != dtype):
+                raise ValueError('Flat buffers must have shape (%d,) and '
+                                 'dtype %s' % (size, np.dtype(dtype)))
+        self.data = np.empty(size, dtype=dtype) if data is None else data
+        self.grad = np.zeros(size, dtype=dtype) if grad is None else grad
+        self.params = self.views(self.data)
+        self.grads = self.views(self.grad)
+        for k in self.keys:
+            self.params[k][...] = params[k]
+
+
+    def views(self, flat):
+        """
+        Returns a dictionary mapping each parameter name to a view of the
+        array flat, which must have the layout of self.data.
+        """
+        views = {}
+        for i, k in enumerate(self.keys):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            views[k] = flat[start:end].reshape(self.shapes[i])
+        return views
+
+
+    def gather_grads(self, grads):
+        """
+        Copy a dictionary of gradients into self.grad and return it.
+        Gradients that already are views of self.grad are not copied.
+        """
+        for k in self.keys:
+            view = self.grads[k]
+            if grads[k] is not view:
+                view[...] = grads[k]
+        return self.grad
+
+
+def flatten_params(model, dtype=None, data=None, grad=None):
+    """
+    Move the parameters of model into one flat buffer.
+
+    The entries of model.params are replaced by views into the buffer.
+
+    Inputs:
+    - model: A model following the Solver API
+    - dtype: Optional dtype for the buffer
+    - data, grad: Optional preallocated buffers, see FlatParams
+
+    Returns:
+    - flat: The FlatParams object that owns the buffer
+    """
+    flat = FlatParams(model.params, dtype=dtype, data=data, grad=grad)
+    model.params = flat.params
+    return flat
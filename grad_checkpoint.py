@@ -0,0 +1,184 @@
+from builtins import range
+from builtins import object
+import numpy as np
+
+"""
+This file implements activation recomputation (gradient checkpointing).
+
+A normal training pass keeps the cache of every layer alive from the forward
+pass until the backward pass has consumed it, so the memory of a step grows
+with the depth of the network. With checkpointing, the layers of a network
+are split into segments of `every` consecutive layers. During the forward
+pass only the input of each segment is kept and the caches inside the
+segment are dropped as soon as the next layer has run; during the backward
+pass each segment is run forward again from its saved input to rebuild its
+caches right before they are needed. The last segment keeps its caches, as
+its backward pass starts right after the forward pass.
+
+The price is one extra forward pass through every segment except the last.
+A recomputed forward pass has to see the same randomness and must not count
+twice in the batchnorm running averages, so the Checkpointer saves the
+global numpy random state and the counters of the dropout streams at the
+start of each segment and restores them for the recomputation, and it puts
+back the running mean and variance of the batchnorm layers afterwards.
+
+A model uses a Checkpointer by expressing its layers as units with two
+functions:
+- forward_fn(j, x) -> (out, cache) runs unit j;
+- backward_fn(j, dout, cache) -> dx backpropagates through unit j and
+  stores the parameter gradients of the unit.
+"""
+
+
+def _last_segment_start(num_units, every):
+    return max(num_units - 1, 0) // every * every
+
+
+class Checkpointer(object):
+    """
+    Runs the forward and backward pass of a stack of units with activation
+    recomputation.
+    """
+
+    def __init__(self, every, dropout_params=(), bn_params=()):
+        """
+        Inputs:
+        - every: Number of units per segment
+        - dropout_params: dropout_param dictionaries used by the units
+        - bn_params: bn_param dictionaries used by the units
+        """
+        if every < 1:
+            raise ValueError('Invalid checkpoint interval %d' % every)
+        self.every = every
+        self.dropout_params = list(dropout_params)
+        self.bn_params = list(bn_params)
+        self._streams = [p['stream'] for p in self.dropout_params
+                         if p.get('stream') is not None]
+        self._uses_global_rng = len(self._streams) < len(self.dropout_params)
+
+
+    def _random_state(self):
+        global_state = None
+        if self._uses_global_rng:
+            global_state = np.random.get_state()
+        return global_state, [stream.counter for stream in self._streams]
+
+
+    def _set_random_state(self, state):
+        global_state, counters = state
+        if global_state is not None:
+            np.random.set_state(global_state)
+        for stream, counter in zip(self._streams, counters):
+            stream.counter = counter
+
+
+    def forward(self, forward_fn, num_units, x):
+        """
+        Forward pass through num_units units, keeping only the segment inputs.
+
+        Returns a tuple of:
+        - out: Output of the last unit
+        - state: Object to give to backward()
+        """
+        last_start = _last_segment_start(num_units, self.every)
+        saved = []
+        caches = []
+        for j in range(num_units):
+            if j % self.every == 0 and j < last_start:
+                saved.append((j, x, self._random_state()))
+            x, cache = forward_fn(j, x)
+            if j >= last_start:
+                caches.append(cache)
+        return x, (saved, caches)
+
+
+    def backward(self, forward_fn, backward_fn, num_units, dout, state):
+        """
+        Backward pass through the units, recomputing the dropped caches one
+        segment at a time.
+
+        Returns:
+        - dx: Gradient with respect to the input of the first unit
+        """
+        saved, caches = state
+        last_start = _last_segment_start(num_units, self.every)
+        for j in range(num_units - 1, last_start - 1, -1):
+            dout = backward_fn(j, dout, caches.pop())
+
+        for start, x, random_state in reversed(saved):
+            # Replay the forward pass of the segment with the same randomness
+            # and without touching the batchnorm running averages
+            current_state = self._random_state()
+            running = [(p.get('running_mean'), p.get('running_var'))
+                       for p in self.bn_params]
+            self._set_random_state(random_state)
+            for j in range(start, start + self.every):
+                x, cache = forward_fn(j, x)
+                caches.append(cache)
+            self._set_random_state(current_state)
+            for p, (mean, var) in zip(self.bn_params, running):
+                p['running_mean'], p['running_var'] = mean, var
+
+            for j in range(start + self.every - 1, start - 1, -1):
+                dout = backward_fn(j, dout, caches.pop())
+        return dout
+
+
+class CheckpointReport(object):
+    """
+    Estimated memory and compute of a training pass with and without
+    checkpointing.
+
+    Attributes:
+    - every: Number of units per segment
+    - full_bytes: Bytes of the caches kept by a normal training pass
+    - checkpoint_bytes: Peak bytes of the saved segment inputs plus the
+      caches of one segment with checkpointing
+    - saved_bytes: full_bytes - checkpoint_bytes
+    - step_flops: FLOPs of a normal training step, counting the backward
+      pass as twice the forward pass
+    - extra_flops: FLOPs of the recomputed forward passes
+    """
+
+    def __init__(self, every, cache_bytes, input_bytes, flops, other_flops=0):
+        """
+        Inputs:
+        - every: Number of units per segment
+        - cache_bytes: List giving the bytes of the cache of each unit,
+          including the input it references
+        - input_bytes: List giving the bytes of the input of each unit
+        - flops: List giving the forward FLOPs of each unit
+        - other_flops: Forward FLOPs of the layers outside the units, such as
+          the final layer and the loss
+        """
+        num_units = len(cache_bytes)
+        last_start = _last_segment_start(num_units, every)
+        starts = range(0, last_start, every)
+        segment_bytes = [sum(cache_bytes[s:s + every])
+                         for s in range(0, num_units, every)]
+
+        self.every = every
+        self.full_bytes = sum(cache_bytes)
+        self.checkpoint_bytes = (sum(input_bytes[s] for s in starts) +
+                                 max(segment_bytes + [0]))
+        self.saved_bytes = self.full_bytes - self.checkpoint_bytes
+        self.step_flops = 3 * (sum(flops) + other_flops)
+        self.extra_flops = sum(flops[:last_start])
+
+
+    def report(self):
+        """
+        Returns a human readable summary.
+        """
+        mb = 1024.0 ** 2
+        lines = [
+          'Checkpointing every %d layers' % self.every,
+          '  caches without checkpointing: %8.2f MB' % (self.full_bytes / mb),
+          '  caches with checkpointing:    %8.2f MB' % (
+              self.checkpoint_bytes / mb),
+          '  memory saved:                 %8.2f MB' % (self.saved_bytes / mb),
+          '  extra FLOPs per step:         %8.2f GFLOP (%.1f%%)' % (
+              self.extra_flops / 1e9,
+              100.0 * self.extra_flops / max(self.step_flops, 1)),
+        ]
+        return '\n'.join(lines)
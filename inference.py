@@ -0,0 +1,316 @@
+from __future__ import division
+from builtins import range
+from builtins import object
+import numpy as np
+
+from cs231n.layers import *
+from cs231n.fast_layers import *
+from cs231n.classifiers.fc_net import TwoLayerNet, FullyConnectedNet
+from cs231n.classifiers.cnn import ThreeLayerConvNet, DeepConvNet
+from cs231n.classifiers import sequential
+
+"""
+This file implements a cache-free inference engine for trained models.
+
+Calling model.loss(X) at test time runs the same layer functions as training,
+so every layer builds a backward cache (for conv layers this includes the
+full im2col matrix) that is thrown away right after. A Predictor instead
+compiles the test-time forward pass of a model once into a list of ops that
+keep no caches, work in place where possible and write their outputs into
+two activation buffers that the layers take turns on. The buffers are
+allocated for the first batch and reused for every later batch and call.
+
+Parameters and batchnorm running statistics are read from the model on every
+call, so a Predictor stays valid while a Solver keeps training the model.
+
+Each op is a tuple (kind, fn):
+- ('inplace', fn): fn(x, params) overwrites the activation x;
+- ('out', fn, shape_fn): fn(x, params, out) writes into out, which has shape
+  shape_fn(x.shape, params).
+"""
+
+
+def _weight(params, key, dtype):
+    # Update rules may have promoted the weights to another dtype than the
+    # activations, e.g. float32 weights to float64
+    return params[key].astype(dtype, copy=False)
+
+
+def _affine_op(w_key, b_key):
+    def fn(x, params, out):
+        np.dot(x.reshape(x.shape[0], -1), _weight(params, w_key, out.dtype),
+               out=out)
+        out += params[b_key]
+
+    def shape_fn(shape, params):
+        return (shape[0], params[w_key].shape[1])
+
+    return ('out', fn, shape_fn)
+
+
+def _relu_op():
+    def fn(x, params):
+        np.maximum(x, 0, out=x)
+
+    return ('inplace', fn)
+
+
+def _batchnorm_op(gamma_key, beta_key, bn_param, spatial=False):
+    # Same arithmetic as the test-time branch of batchnorm_forward, folded
+    # into one scale and one shift per feature
+    def fn(x, params):
+        eps = bn_param.get('eps', 1e-5)
+        D = params[gamma_key].shape[0]
+        running_mean = bn_param.get('running_mean', np.zeros(D, dtype=x.dtype))
+        running_var = bn_param.get('running_var', np.zeros(D, dtype=x.dtype))
+        scale = params[gamma_key] / (np.sqrt(running_var) + eps)
+        shift = params[beta_key] - running_mean * scale
+        if spatial:
+            scale = scale.reshape(-1, 1, 1)
+            shift = shift.reshape(-1, 1, 1)
+        x *= scale.astype(x.dtype, copy=False)
+        x += shift.astype(x.dtype, copy=False)
+
+    return ('inplace', fn)
+
+
+def _layernorm_op(gamma_key, beta_key, ln_param):
+    def fn(x, params):
+        eps = ln_param.get('eps', 1e-5)
+        x -= np.mean(x, axis=1, keepdims=True)
+        x /= np.sqrt(np.mean(x * x, axis=1, keepdims=True) + eps)
+        x *= params[gamma_key]
+        x += params[beta_key]
+
+    return ('inplace', fn)
+
+
+def _conv_op(w_key, b_key, conv_param):
+    def fn(x, params, out):
+        conv_forward_strides(x, _weight(params, w_key, out.dtype),
+                             params[b_key], conv_param, out=out)
+
+    def shape_fn(shape, params):
+        N, _, H, W = shape
+        F, _, HH, WW = params[w_key].shape
+        stride, pad = conv_param['stride'], conv_param['pad']
+        return (N, F, (H + 2 * pad - HH) // stride + 1,
+                (W + 2 * pad - WW) // stride + 1)
+
+    return ('out', fn, shape_fn)
+
+
+def _pool_op(pool_param, pool_forward=max_pool_forward_fast):
+    def fn(x, params, out):
+        pool_forward(x, pool_param, out=out)
+
+    def shape_fn(shape, params):
+        N, C, H, W = shape
+        size, stride = pool_param['pool_height'], pool_param['stride']
+        return (N, C, (H - size) // stride + 1, (W - size) // stride + 1)
+
+    return ('out', fn, shape_fn)
+
+
+def _two_layer_net_ops(model):
+    return [_affine_op('W1', 'b1'), _relu_op(), _affine_op('W2', 'b2')]
+
+
+def _fc_net_ops(model):
+    ops = []
+    for i in range(1, model.num_layers):
+        ops.append(_affine_op('W%d' % i, 'b%d' % i))
+        if model.normalization == 'batchnorm':
+            ops.append(_batchnorm_op('gamma%d' % i, 'beta%d' % i,
+                                     model.bn_params[i - 1]))
+        elif model.normalization == 'layernorm':
+            ops.append(_layernorm_op('gamma%d' % i, 'beta%d' % i,
+                                     model.ln_params[i - 1]))
+        ops.append(_relu_op())
+    L = model.num_layers
+    ops.append(_affine_op('W%d' % L, 'b%d' % L))
+    return ops
+
+
+def _three_layer_conv_net_ops(model):
+    filter_size = model.params['W1'].shape[2]
+    conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2}
+    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+    return [_conv_op('W1', 'b1', conv_param), _pool_op(pool_param),
+            _affine_op('W2', 'b2'), _relu_op(), _affine_op('W3', 'b3')]
+
+
+def _deep_conv_net_ops(model):
+    ops = []
+    for (w_key, b_key, conv_param, gamma_key, beta_key, bn_param,
+         pool_forward, _, pool_param) in model._blocks:
+        ops.append(_conv_op(w_key, b_key, conv_param))
+        if bn_param is not None:
+            ops.append(_batchnorm_op(gamma_key, beta_key, bn_param,
+                                     spatial=True))
+        ops.append(_relu_op())
+        if pool_forward is not None:
+            ops.append(_pool_op(pool_param, pool_forward))
+    for w_key, b_key in model._affine_keys[:-1]:
+        ops.append(_affine_op(w_key, b_key))
+        ops.append(_relu_op())
+    ops.append(_affine_op(*model._affine_keys[-1]))
+    return ops
+
+
+def _sequential_ops(model):
+    ops = []
+    for layer in model.layers[:-1]:
+        if isinstance(layer, sequential.Affine):
+            ops.append(_affine_op(layer.w_key, layer.b_key))
+        elif isinstance(layer, sequential.Conv):
+            ops.append(_conv_op(layer.w_key, layer.b_key, layer.conv_param))
+        elif isinstance(layer, sequential.Pool):
+            ops.append(_pool_op(layer.pool_param))
+        elif isinstance(layer, sequential.BatchNorm):
+            spatial = layer.forward_fn is spatial_batchnorm_forward
+            ops.append(_batchnorm_op(layer.gamma_key, layer.beta_key,
+                                     layer.param, spatial=spatial))
+        elif isinstance(layer, sequential.ReLU):
+            ops.append(_relu_op())
+        elif not isinstance(layer, sequential.Dropout):
+            raise ValueError('Unsupported layer %s' % type(layer).__name__)
+    return ops
+
+
+_OP_BUILDERS = [
+  (TwoLayerNet, _two_layer_net_ops),
+  (FullyConnectedNet, _fc_net_ops),
+  (ThreeLayerConvNet, _three_layer_conv_net_ops),
+  (DeepConvNet, _deep_conv_net_ops),
+  (sequential.Sequential, _sequential_ops),
+]
+
+
+def _find_builder(model):
+    # Exact type match: a subclass may have changed what loss() computes
+    for cls, build_ops in _OP_BUILDERS:
+        if type(model) is cls:
+            return build_ops
+    return None
+
+
+def can_predict(model):
+    """
+    Returns True if a Predictor can be compiled for model.
+    """
+    return _find_builder(model) is not None
+
+
+class Predictor(object):
+    """
+    A compiled, cache-free test-time forward pass of a model.
+
+    Example usage:
+
+    predictor = Predictor(model, batch_size=1000)
+    scores = predictor.scores(X_test)
+    y_pred = predictor.predict(X_test)
+    """
+
+    def __init__(self, model, batch_size=1000):
+        """
+        Compile the forward pass of model.
+
+        Inputs:
+        - model: A TwoLayerNet, FullyConnectedNet, ThreeLayerConvNet,
+          DeepConvNet or Sequential instance
+        - batch_size: Number of examples to run through the network at once
+        """
+        build_ops = _find_builder(model)
+        if build_ops is None:
+            raise ValueError('Cannot compile a predictor for %s'
+                             % type(model).__name__)
+        self.model = model
+        self.batch_size = batch_size
+        self.dtype = getattr(model, 'dtype', np.float64)
+        self._ops = build_ops(model)
+        self._buffers = [np.empty(0, dtype=self.dtype),
+                         np.empty(0, dtype=self.dtype)]
+
+
+    def _buffer(self, slot, shape):
+        """
+        Returns a C-contiguous array of the given shape backed by activation
+        buffer slot, growing the buffer if needed.
+        """
+        size = int(np.prod(shape))
+        if self._buffers[slot].size < size:
+            self._buffers[slot] = np.empty(size, dtype=self.dtype)
+        return self._buffers[slot][:size].reshape(shape)
+
+
+    def _forward(self, X):
+        """
+        Run one batch through the ops and return a view of the scores; the
+        view is only valid until the next call.
+        """
+        params = self.model.params
+        x = X.astype(self.dtype, copy=False)
+        slot = 0
+        for op in self._ops:
+            if op[0] == 'inplace':
+                if x is X:
+                    # Never overwrite the caller's data
+                    x = self._buffer(slot, X.shape)
+                    np.copyto(x, X)
+                    slot ^= 1
+                op[1](x, params)
+            else:
+                _, fn, shape_fn = op
+                out = self._buffer(slot, shape_fn(x.shape, params))
+                fn(x, params, out)
+                x = out
+                slot ^= 1
+        return x
+
+
+    def _output_shape(self, shape):
+        """
+        Shape of the scores of a batch of input shape, without running it.
+        """
+        params = self.model.params
+        for op in self._ops:
+            if op[0] == 'out':
+                shape = op[2](shape, params)
+        return shape
+
+
+    def scores(self, X):
+        """
+        Compute classification scores for X.
+
+        Inputs:
+        - X: Array of input data of shape (N, d_1, ..., d_k)
+
+        Returns:
+        - scores: Array of shape (N, C) with the same values as model.loss(X)
+        """
+        scores = np.empty(self._output_shape(X.shape), dtype=self.dtype)
+        for start in range(0, X.shape[0], self.batch_size):
+            batch_scores = self._forward(X[start:start + self.batch_size])
+            scores[start:start + batch_scores.shape[0]] = batch_scores
+        return scores
+
+
+    def predict(self, X):
+        """
+        Predict labels for X.
+
+        Inputs:
+        - X: Array of input data of shape (N, d_1, ..., d_k)
+
+        Returns:
+        - y_pred: Array of shape (N,) giving the predicted class of each input
+        """
+        y_pred = np.empty(X.shape[0], dtype=np.intp)
+        for start in range(0, X.shape[0], self.batch_size):
+            batch_scores = self._forward(X[start:start + self.batch_size])
+            np.argmax(batch_scores, axis=1,
+                      out=y_pred[start:start + batch_scores.shape[0]])
+        return y_pred
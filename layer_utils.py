@@ -1,35 +1,123 @@
 pass
+import numpy as np
+
 from cs231n.layers import *
 from cs231n.fast_layers import *
 
 
-def affine_relu_forward(x, w, b):
+def affine_relu_forward(x, w, b, inplace=False, out=None):
     """
     Convenience layer that perorms an affine transform followed by a ReLU
 
     Inputs:
     - x: Input to the affine layer
     - w, b: Weights for the affine layer
+    - inplace: If True, apply the ReLU in place on the affine output instead
+      of allocating a second activation-sized array. The returned out then
+      also lives in the cache, so it must not be modified before the backward
+      pass.
+    - out: Optional preallocated output buffer; implies inplace
 
     Returns a tuple of:
     - out: Output from the ReLU
     - cache: Object to give to the backward pass
     """
-    a, fc_cache = affine_forward(x, w, b)
-    out, relu_cache = relu_forward(a)
+    a, fc_cache = affine_forward(x, w, b, out=out)
+    if inplace or out is not None:
+        out, relu_cache = relu_forward_inplace(a, keep=fc_cache)
+    else:
+        out, relu_cache = relu_forward(a)
     cache = (fc_cache, relu_cache)  #  = ((x, w, b), a)
     return out, cache
 
 
-def affine_relu_backward(dout, cache):
+def affine_relu_backward(dout, cache, inplace=False, dx_out=None, dw_out=None,
+                         db_out=None):
     """
     Backward pass for the affine-relu convenience layer
+
+    If inplace is True, dout is overwritten with the gradient of the ReLU.
+    dx_out, dw_out and db_out are optional preallocated buffers for the
+    results.
     """
     fc_cache, relu_cache = cache
-    da = relu_backward(dout, relu_cache)
-    dx, dw, db = affine_backward(da, fc_cache)
+    if inplace:
+        da = relu_backward_inplace(dout, relu_cache, keep=fc_cache)
+    else:
+        da = relu_backward(dout, relu_cache)
+    dx, dw, db = affine_backward(da, fc_cache, dx_out=dx_out, dw_out=dw_out,
+                                 db_out=db_out)
     return dx, dw, db
 
+
+def affine_softmax_loss_forward(x, w, b, y, out=None, pred_out=None):
+    """
+    Fused final affine layer and softmax cross-entropy loss.
+
+    This computes the same loss as affine_forward followed by softmax_loss,
+    but the scores, the probabilities and the gradient on the scores all live
+    in one (N, C) buffer that is updated in place. The computation runs in
+    the dtype of x and w, so float32 inputs stay in float32 throughout.
+
+    Inputs:
+    - x: Input to the affine layer, of shape (N, d_1, ..., d_k)
+    - w, b: Weights for the affine layer, of shapes (D, C) and (C,)
+    - y: Vector of labels, of shape (N,) where 0 <= y[i] < C
+    - out: Optional preallocated (N, C) buffer to work in; it is referenced
+      by the cache
+    - pred_out: Optional integer array of shape (N,) that receives the
+      predicted class of each input, the argmax of the scores
+
+    Returns a tuple of:
+    - loss: Scalar giving the data loss
+    - cache: Object to give to the backward pass; holds x, w and the
+      gradient of the loss with respect to the scores
+    """
+    N = x.shape[0]
+    rows = np.arange(N)
+
+    # scores
+    buf = np.dot(x.reshape(N, -1), w, out=out)
+    buf += b
+    if pred_out is not None:
+        np.argmax(buf, axis=1, out=pred_out)
+
+    # shifted logits, keeping the shifted correct-class logits for the loss
+    buf -= np.max(buf, axis=1, keepdims=True)
+    correct_logits = buf[rows, y]
+
+    # probabilities
+    np.exp(buf, out=buf)
+    Z = np.sum(buf, axis=1, keepdims=True)
+    buf /= Z
+    loss = np.mean(np.log(Z[:, 0]) - correct_logits)
+
+    # gradient on the scores
+    buf[rows, y] -= 1
+    buf /= N
+
+    cache = (x, w, buf)
+    return loss, cache
+
+
+def affine_softmax_loss_backward(cache, dx_out=None, dw_out=None, db_out=None):
+    """
+    Backward pass for the fused affine-softmax loss layer.
+
+    Inputs:
+    - cache: Cache from affine_softmax_loss_forward
+    - dx_out, dw_out, db_out: Optional preallocated buffers for dx, dw, db
+
+    Returns a tuple of:
+    - dx: Gradient with respect to x, of shape (N, d1, ..., d_k)
+    - dw: Gradient with respect to w, of shape (D, C)
+    - db: Gradient with respect to b, of shape (C,)
+    """
+    x, w, dscores = cache
+    return affine_backward(dscores, (x, w, None), dx_out=dx_out,
+                           dw_out=dw_out, db_out=db_out)
+
+
 def affine_batchnorm_relu_forward(dout, cache):
     """
     Maybe I will implement this for convenience. 
@@ -39,51 +127,57 @@ def affine_batchnorm_relu_forward(dout, cache):
 def affine_batchnorm_relu_backward(dout, cache):
     pass
 
-def conv_relu_forward(x, w, b, conv_param):
+def conv_relu_forward(x, w, b, conv_param, out=None):
     """
     A convenience layer that performs a convolution followed by a ReLU.
 
     Inputs:
     - x: Input to the convolutional layer
     - w, b, conv_param: Weights and parameters for the convolutional layer
+    - out: Optional preallocated output buffer
 
     Returns a tuple of:
     - out: Output from the ReLU
     - cache: Object to give to the backward pass
     """
-    a, conv_cache = conv_forward_fast(x, w, b, conv_param)
-    out, relu_cache = relu_forward(a)
+    a, conv_cache = conv_forward_fast(x, w, b, conv_param, out=out)
+    out, relu_cache = relu_forward_inplace(a, keep=conv_cache)
     cache = (conv_cache, relu_cache)
     return out, cache
 
 
-def conv_relu_backward(dout, cache):
+def conv_relu_backward(dout, cache, dx_out=None, dw_out=None, db_out=None):
     """
     Backward pass for the conv-relu convenience layer.
     """
     conv_cache, relu_cache = cache
     da = relu_backward(dout, relu_cache)
-    dx, dw, db = conv_backward_fast(da, conv_cache)
+    dx, dw, db = conv_backward_fast(da, conv_cache, dx_out=dx_out,
+                                    dw_out=dw_out, db_out=db_out)
     return dx, dw, db
 
 
-def conv_bn_relu_forward(x, w, b, gamma, beta, conv_param, bn_param):
+def conv_bn_relu_forward(x, w, b, gamma, beta, conv_param, bn_param, out=None):
     a, conv_cache = conv_forward_fast(x, w, b, conv_param)
-    an, bn_cache = spatial_batchnorm_forward(a, gamma, beta, bn_param)
-    out, relu_cache = relu_forward(an)
+    an, bn_cache = spatial_batchnorm_forward(a, gamma, beta, bn_param, out=out)
+    out, relu_cache = relu_forward_inplace(an, keep=bn_cache)
     cache = (conv_cache, bn_cache, relu_cache)
     return out, cache
 
 
-def conv_bn_relu_backward(dout, cache):
+def conv_bn_relu_backward(dout, cache, dx_out=None, dw_out=None, db_out=None,
+                          dgamma_out=None, dbeta_out=None):
     conv_cache, bn_cache, relu_cache = cache
     dan = relu_backward(dout, relu_cache)
-    da, dgamma, dbeta = spatial_batchnorm_backward(dan, bn_cache)
-    dx, dw, db = conv_backward_fast(da, conv_cache)
+    da, dgamma, dbeta = spatial_batchnorm_backward(dan, bn_cache,
+                                                   dgamma_out=dgamma_out,
+                                                   dbeta_out=dbeta_out)
+    dx, dw, db = conv_backward_fast(da, conv_cache, dx_out=dx_out,
+                                    dw_out=dw_out, db_out=db_out)
     return dx, dw, db, dgamma, dbeta
 
 
-def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
+def conv_relu_pool_forward(x, w, b, conv_param, pool_param, out=None):
     """
     Convenience layer that performs a convolution, a ReLU, and a pool.
 
@@ -91,24 +185,26 @@ def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
     - x: Input to the convolutional layer
     - w, b, conv_param: Weights and parameters for the convolutional layer
     - pool_param: Parameters for the pooling layer
+    - out: Optional preallocated output buffer for the pooling layer
 
     Returns a tuple of:
     - out: Output from the pooling layer
     - cache: Object to give to the backward pass
     """
     a, conv_cache = conv_forward_fast(x, w, b, conv_param)
-    s, relu_cache = relu_forward(a)
-    out, pool_cache = max_pool_forward_fast(s, pool_param)
+    s, relu_cache = relu_forward_inplace(a, keep=conv_cache)
+    out, pool_cache = max_pool_forward_fast(s, pool_param, out=out)
     cache = (conv_cache, relu_cache, pool_cache)
     return out, cache
 
 
-def conv_relu_pool_backward(dout, cache):
+def conv_relu_pool_backward(dout, cache, dx_out=None, dw_out=None, db_out=None):
     """
     Backward pass for the conv-relu-pool convenience layer
     """
     conv_cache, relu_cache, pool_cache = cache
     ds = max_pool_backward_fast(dout, pool_cache)
-    da = relu_backward(ds, relu_cache)
-    dx, dw, db = conv_backward_fast(da, conv_cache)
+    da = relu_backward_inplace(ds, relu_cache, keep=pool_cache[1])
+    dx, dw, db = conv_backward_fast(da, conv_cache, dx_out=dx_out,
+                                    dw_out=dw_out, db_out=db_out)
     return dx, dw, db
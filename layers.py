@@ -1,8 +1,34 @@
 from builtins import range
 import numpy as np
 
+"""
+Output buffers
 
-def affine_forward(x, w, b):
+Every forward function accepts an optional out= argument and every backward
+function accepts optional dx_out=, dw_out=, db_out= (or dgamma_out=,
+dbeta_out=) arguments. If a buffer is given, the corresponding result is
+written into it and the buffer itself is returned; if it is None, a new array
+is allocated as usual. Buffers must have the shape and dtype of the result
+they receive and be C-contiguous. This lets model code run a training step
+with a fixed set of arrays instead of allocating new ones on every call.
+
+Some caches keep a reference to the forward output (for example the ReLU and
+the reshape max pool), so a forward buffer must not be reused before the
+backward pass that consumes its cache has run.
+"""
+
+
+def _store(value, out):
+    """
+    Return value, copied into the preallocated buffer out if one is given.
+    """
+    if out is None:
+        return value
+    np.copyto(out, value)
+    return out
+
+
+def affine_forward(x, w, b, out=None):
     """
     Computes the forward pass for an affine (fully-connected) layer.
 
@@ -15,22 +41,23 @@ def affine_forward(x, w, b):
     - x: A numpy array containing input data, of shape (N, d_1, ..., d_k)
     - w: A numpy array of weights, of shape (D, M)
     - b: A numpy array of biases, of shape (M,)
+    - out: Optional preallocated output buffer of shape (N, M)
 
     Returns a tuple of:
     - out: output, of shape (N, M)
     - cache: (x, w, b)
     """
-    out = None
     ###########################################################################
     # TODO: Implement the affine forward pass. Store the result in out. You   #
     # will need to reshape the input into rows.                               #
     ###########################################################################
     x_reshaped = np.reshape(x, (x.shape[0], -1))  # new shape: N x D
-    out = np.dot(x_reshaped, w) + b
+    out = np.dot(x_reshaped, w, out=out)
+    out += b
     cache = x, w, b
     return out, cache
 
-def affine_backward(dout, cache):
+def affine_backward(dout, cache, dx_out=None, dw_out=None, db_out=None):
     """
     Computes the backward pass for an affine layer.
 
@@ -40,6 +67,7 @@ def affine_backward(dout, cache):
       - x: Input data, of shape (N, d_1, ... d_k)
       - w: Weights, of shape (D, M)
       - b: Biases, of shape (M,)
+    - dx_out, dw_out, db_out: Optional preallocated buffers for dx, dw, db
 
     Returns a tuple of:
     - dx: Gradient with respect to x, of shape (N, d1, ..., d_k)
@@ -51,49 +79,62 @@ def affine_backward(dout, cache):
     ###########################################################################
     # TODO: Implement the affine backward pass.                               #
     ###########################################################################
-    dx = np.dot(dout, w.T)
-    dx = dx.reshape(x.shape)
+    N = x.shape[0]
+    if dx_out is None:
+        dx = np.dot(dout, w.T)
+        dx = dx.reshape(x.shape)
+    else:
+        dx = dx_out
+        np.dot(dout, w.T, out=dx.reshape(N, -1))
 
-    x_reshaped = np.reshape(x, (x.shape[0], -1))
-    dw = np.dot(x_reshaped.T, dout)
+    x_reshaped = np.reshape(x, (N, -1))
+    dw = np.dot(x_reshaped.T, dout, out=dw_out)
 
-    db = np.sum(dout, axis=0)
+    db = np.sum(dout, axis=0, out=db_out)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
     return dx, dw, db
 
 
-def relu_forward(x):
+def relu_forward(x, out=None):
     """
     Computes the forward pass for a layer of rectified linear units (ReLUs).
 
     Input:
     - x: Inputs, of any shape
+    - out: Optional preallocated array of the same shape as x to write the
+      output into. Passing out=x computes the ReLU in place.
 
     Returns a tuple of:
     - out: Output, of the same shape as x
-    - cache: x
+    - cache: x, or out if a buffer was given (out > 0 exactly where x > 0, so
+      the backward pass works with either)
     """
-    out = None
     ###########################################################################
     # TODO: Implement the ReLU forward pass.                                  #
     ###########################################################################
-    out = np.maximum(0, x)
+    if out is None:
+        out = np.maximum(0, x)
+        cache = x
+    else:
+        np.maximum(x, 0, out=out)
+        cache = out
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
-    cache = x
     return out, cache
 
 
-def relu_backward(dout, cache):
+def relu_backward(dout, cache, dx_out=None):
     """
     Computes the backward pass for a layer of rectified linear units (ReLUs).
 
     Input:
     - dout: Upstream derivatives, of any shape
     - cache: Input x, of same shape as dout
+    - dx_out: Optional preallocated array of the same shape as dout to write
+      the gradient into. Passing dx_out=dout computes the gradient in place.
 
     Returns:
     - dx: Gradient with respect to x
@@ -102,14 +143,70 @@ def relu_backward(dout, cache):
     ###########################################################################
     # TODO: Implement the ReLU backward pass.                                 #
     ###########################################################################
-    dx = np.where(x>0, dout, 0)
+    if dx_out is None:
+        dx = np.where(x>0, dout, 0)
+    else:
+        dx = np.multiply(dout, x > 0, out=dx_out)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
     return dx
 
 
-def batchnorm_forward(x, gamma, beta, bn_param):
+def _check_inplace(x, keep):
+    """
+    Make sure that x may be overwritten by an in-place layer.
+
+    Inputs:
+    - x: The array that is about to be overwritten
+    - keep: Iterable of arrays that are still needed elsewhere, typically the
+      contents of a cache from an earlier layer. Entries that are not arrays
+      (and keep=None) are ignored.
+
+    Raises ValueError if x is read-only or shares memory with any array in
+    keep.
+    """
+    if not x.flags.writeable:
+        raise ValueError('Cannot overwrite a read-only array in place')
+    for arr in keep or ():
+        if isinstance(arr, np.ndarray) and np.may_share_memory(x, arr):
+            raise ValueError('Cannot overwrite an array in place that is '
+                             'still needed by another cache')
+
+
+def relu_forward_inplace(x, keep=()):
+    """
+    Forward pass for a ReLU layer that overwrites its input with the output.
+
+    Inputs:
+    - x: Inputs, of any shape; overwritten with the output
+    - keep: Arrays that must not be overwritten (see _check_inplace)
+
+    Returns a tuple of:
+    - out: Output; this is x itself
+    - cache: out
+    """
+    _check_inplace(x, keep)
+    return relu_forward(x, out=x)
+
+
+def relu_backward_inplace(dout, cache, keep=()):
+    """
+    Backward pass for a ReLU layer that overwrites dout with the gradient.
+
+    Inputs:
+    - dout: Upstream derivatives, of any shape; overwritten with dx
+    - cache: Cache from relu_forward or relu_forward_inplace
+    - keep: Arrays that must not be overwritten (see _check_inplace)
+
+    Returns:
+    - dx: Gradient with respect to x; this is dout itself
+    """
+    _check_inplace(dout, keep)
+    return relu_backward(dout, cache, dx_out=dout)
+
+
+def batchnorm_forward(x, gamma, beta, bn_param, out=None):
     """
     Forward pass for batch normalization.
 
@@ -142,6 +239,7 @@ def batchnorm_forward(x, gamma, beta, bn_param):
       - momentum: Constant for running mean / variance.
       - running_mean: Array of shape (D,) giving running mean of features
       - running_var Array of shape (D,) giving running variance of features
+    - out: Optional preallocated output buffer of shape (N, D)
 
     Returns a tuple of:
     - out: of shape (N, D)
@@ -155,7 +253,7 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     running_mean = bn_param.get('running_mean', np.zeros(D, dtype=x.dtype))
     running_var = bn_param.get('running_var', np.zeros(D, dtype=x.dtype))
 
-    out, cache = None, None
+    cache = None
     if mode == 'train':
         #######################################################################
         # TODO: Implement the training-time forward pass for batch norm.      #
@@ -201,10 +299,11 @@ def batchnorm_forward(x, gamma, beta, bn_param):
         xhat = xmu * ivar
 
         #step8: Nor the two transformation steps
-        gammax = gamma * xhat
+        gammax = np.multiply(gamma, xhat, out=out)
 
         #step9
-        out = gammax + beta
+        gammax += beta
+        out = gammax
 
         #store intermediate
         cache = (xhat,gamma,xmu,ivar,sqrtvar,var,eps)
@@ -224,7 +323,8 @@ def batchnorm_forward(x, gamma, beta, bn_param):
         # Store the result in the out variable.                               #
         #######################################################################
         x_normalized = (x - running_mean)/(np.sqrt(running_var) + eps)
-        x_scaled_and_shifted = gamma*x_normalized + beta
+        x_scaled_and_shifted = np.multiply(gamma, x_normalized, out=out)
+        x_scaled_and_shifted += beta
         out = x_scaled_and_shifted
 
         #######################################################################
@@ -240,7 +340,8 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     return out, cache
 
 
-def batchnorm_backward(dout, cache):
+def batchnorm_backward(dout, cache, dx_out=None, dgamma_out=None,
+                       dbeta_out=None):
     """
     Backward pass for batch normalization.
 
@@ -251,6 +352,8 @@ def batchnorm_backward(dout, cache):
     Inputs:
     - dout: Upstream derivatives, of shape (N, D)
     - cache: Variable of intermediates from batchnorm_forward.
+    - dx_out, dgamma_out, dbeta_out: Optional preallocated buffers for dx,
+      dgamma, dbeta
 
     Returns a tuple of:
     - dx: Gradient with respect to inputs x, of shape (N, D)
@@ -271,11 +374,11 @@ def batchnorm_backward(dout, cache):
     N,D = dout.shape
 
     #step9: out = gammax + beta
-    dbeta = np.sum(dout, axis=0)
+    dbeta = np.sum(dout, axis=0, out=dbeta_out)
     dgammax = dout
 
     #step8: gammax = gamma times x_hat
-    dgamma = np.sum(xhat*dgammax, axis=0)
+    dgamma = np.sum(xhat*dgammax, axis=0, out=dgamma_out)
     dxhat = gamma * dgammax
 
     #step7: xhat = xmu * ivar
@@ -289,7 +392,7 @@ def batchnorm_backward(dout, cache):
     dvar = 1/(2*np.sqrt(var + eps)) * dsqrtvar
 
     #step4: var = 1/N*(sum of sq's)
-    dsq = (1/N) * np.ones((N, D)) * dvar
+    dsq = (1/N) * np.ones((N, D), dtype=dout.dtype) * dvar
 
     #step3: sq = xmu**2
     dxmu2 = 2*xmu*dsq
@@ -301,10 +404,10 @@ def batchnorm_backward(dout, cache):
     dmu = - np.sum(dxmu, axis=0)  #(D,)
 
     #step1: mu = column mean of x
-    dx2 =  (1/N) * np.ones((N,D))*dmu
+    dx2 =  (1/N) * np.ones((N,D), dtype=dout.dtype)*dmu
 
     #step0
-    dx = dx1 + dx2
+    dx = np.add(dx1, dx2, out=dx_out)
 
     return dx, dgamma, dbeta
     ###########################################################################
@@ -312,7 +415,8 @@ def batchnorm_backward(dout, cache):
     ###########################################################################
 
 
-def batchnorm_backward_alt(dout, cache):
+def batchnorm_backward_alt(dout, cache, dx_out=None, dgamma_out=None,
+                           dbeta_out=None):
     """
     Alternative backward pass for batch normalization.
 
@@ -347,10 +451,10 @@ def batchnorm_backward_alt(dout, cache):
     dxhat = dout * gamma
 
     # final partial derivatives
-    dx = (1. / N) * inv_var * (N*dxhat - np.sum(dxhat, axis=0)
-    	- x_hat*np.sum(dxhat*x_hat, axis=0))
-    dbeta = np.sum(dout, axis=0)
-    dgamma = np.sum(x_hat*dout, axis=0)
+    dx = np.multiply((1. / N) * inv_var, N*dxhat - np.sum(dxhat, axis=0)
+    	- x_hat*np.sum(dxhat*x_hat, axis=0), out=dx_out)
+    dbeta = np.sum(dout, axis=0, out=dbeta_out)
+    dgamma = np.sum(x_hat*dout, axis=0, out=dgamma_out)
 
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -358,7 +462,7 @@ def batchnorm_backward_alt(dout, cache):
 
     return dx, dgamma, dbeta
 
-def layernorm_forward(x, gamma, beta, ln_param):
+def layernorm_forward(x, gamma, beta, ln_param, out=None):
     """
     Forward pass for layer normalization.
 
@@ -375,12 +479,13 @@ def layernorm_forward(x, gamma, beta, ln_param):
     - beta: Shift paremeter of shape (D,)
     - ln_param: Dictionary with the following keys:
         - eps: Constant for numeric stability
+    - out: Optional preallocated output buffer of shape (N, D)
 
     Returns a tuple of:
     - out: of shape (N, D)
     - cache: A tuple of values needed in the backward pass
     """
-    out, cache = None, None
+    cache = None
     eps = ln_param.get('eps', 1e-5)
 
     ###########################################################################
@@ -417,10 +522,11 @@ def layernorm_forward(x, gamma, beta, ln_param):
     xhat = xmu * ivar
 
     #step8: Nor the two transformation steps
-    gammax = gamma * xhat
+    gammax = np.multiply(gamma, xhat, out=out)
 
     #step9
-    out = gammax + beta
+    gammax += beta
+    out = gammax
 
     #store intermediate
     cache = (xhat,gamma,xmu,ivar,sqrtvar,var,eps)
@@ -432,7 +538,8 @@ def layernorm_forward(x, gamma, beta, ln_param):
     return out, cache
 
 
-def layernorm_backward(dout, cache):
+def layernorm_backward(dout, cache, dx_out=None, dgamma_out=None,
+                       dbeta_out=None):
     """
     Backward pass for layer normalization.
 
@@ -442,6 +549,8 @@ def layernorm_backward(dout, cache):
     Inputs:
     - dout: Upstream derivatives, of shape (N, D)
     - cache: Variable of intermediates from layernorm_forward.
+    - dx_out, dgamma_out, dbeta_out: Optional preallocated buffers for dx,
+      dgamma, dbeta
 
     Returns a tuple of:
     - dx: Gradient with respect to inputs x, of shape (N, D)
@@ -464,11 +573,11 @@ def layernorm_backward(dout, cache):
     N,D = dout.shape
 
     #step9: out = gammax + beta
-    dbeta = np.sum(dout, axis=0)
+    dbeta = np.sum(dout, axis=0, out=dbeta_out)
     dgammax = dout
 
     #step8: gammax = gamma times x_hat
-    dgamma = np.sum(xhat*dgammax, axis=0)
+    dgamma = np.sum(xhat*dgammax, axis=0, out=dgamma_out)
     dxhat = gamma * dgammax
 
     #step7: xhat = xmu * ivar
@@ -482,7 +591,7 @@ def layernorm_backward(dout, cache):
     dvar = 1/(2*np.sqrt(var + eps)) * dsqrtvar
 
     #step4: var = 1/D*(row sum of sq's)
-    dsq = (1/D) * np.ones((N, D)) * dvar
+    dsq = (1/D) * np.ones((N, D), dtype=dout.dtype) * dvar
 
     #step3: sq = xmu**2
     dxmu2 = 2*xmu*dsq
@@ -494,10 +603,10 @@ def layernorm_backward(dout, cache):
     dmu = - np.sum(dxmu, axis=1, keepdims = True)  #(D,)
 
     #step1: mu = row mean of x
-    dx2 =  (1/D) * np.ones((N,D))*dmu
+    dx2 =  (1/D) * np.ones((N,D), dtype=dout.dtype)*dmu
 
     #step0
-    dx = dx1 + dx2
+    dx = np.add(dx1, dx2, out=dx_out)
 
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -505,7 +614,7 @@ def layernorm_backward(dout, cache):
     return dx, dgamma, dbeta
 
 
-def dropout_forward(x, dropout_param):
+def dropout_forward(x, dropout_param, out=None):
     """
     Performs the forward pass for (inverted) dropout.
 
@@ -518,11 +627,21 @@ def dropout_forward(x, dropout_param):
       - seed: Seed for the random number generator. Passing seed makes this
         function deterministic, which is needed for gradient checking but not
         in real networks.
+      - stream: Optional DropoutStream (see dropout_rng.py). If given, the
+        mask is drawn from this stream instead of the global np.random state
+        and seed is ignored.
+      - regenerate_mask: Only used together with stream. If True, the cache
+        holds the stream counter instead of the mask and the mask is
+        regenerated in the backward pass.
+    - out: Optional preallocated array of the same shape and dtype as x to
+      write the output into. Passing out=x applies dropout in place.
 
     Outputs:
     - out: Array of the same shape as x.
     - cache: tuple (dropout_param, mask). In training mode, mask is the dropout
       mask that was used to multiply the input; in test mode, mask is None.
+      When a stream is used, mask is the boolean keep mask, or the stream
+      counter if regenerate_mask is set.
 
     NOTE: Please implement **inverted** dropout, not the vanilla version of dropout.
     See http://cs231n.github.io/neural-networks-2/#reg for more details.
@@ -532,19 +651,29 @@ def dropout_forward(x, dropout_param):
     as the probability of dropping a neuron output.
     """
     p, mode = dropout_param['p'], dropout_param['mode']
-    if 'seed' in dropout_param:
+    stream = dropout_param.get('stream')
+    if 'seed' in dropout_param and stream is None:
         np.random.seed(dropout_param['seed'])
 
     mask = None
-    out = None
 
     if mode == 'train':
         #######################################################################
         # TODO: Implement training phase forward pass for inverted dropout.   #
         # Store the dropout mask in the mask variable.                        #
         #######################################################################
-        mask = (np.random.rand(*x.shape) < p) / p #dropout mask. Notice /p!
-        out = x*mask
+        if stream is not None:
+            counter = stream.advance()
+            keep = stream.keep_mask(x.shape, p, counter)
+            out = np.multiply(x, keep, out=out)
+            out *= 1 / p
+            mask = counter if dropout_param.get('regenerate_mask') else keep
+        else:
+            mask = (np.random.rand(*x.shape) < p) / p #dropout mask. Notice /p!
+            if out is None:
+                out = x*mask
+            else:
+                np.multiply(x, mask, out=out)
         #######################################################################
         #                           END OF YOUR CODE                          #
         #######################################################################
@@ -552,7 +681,10 @@ def dropout_forward(x, dropout_param):
         #######################################################################
         # TODO: Implement the test phase forward pass for inverted dropout.   #
         #######################################################################
-        out = x
+        if out is None:
+            out = x
+        elif out is not x:
+            np.copyto(out, x)
         #######################################################################
         #                            END OF YOUR CODE                         #
         #######################################################################
@@ -563,13 +695,15 @@ def dropout_forward(x, dropout_param):
     return out, cache
 
 
-def dropout_backward(dout, cache):
+def dropout_backward(dout, cache, dx_out=None):
     """
     Perform the backward pass for (inverted) dropout.
 
     Inputs:
     - dout: Upstream derivatives, of any shape
     - cache: (dropout_param, mask) from dropout_forward.
+    - dx_out: Optional preallocated array of the same shape as dout to write
+      the gradient into. Passing dx_out=dout computes the gradient in place.
     """
     dropout_param, mask = cache
     mode = dropout_param['mode']
@@ -579,16 +713,59 @@ def dropout_backward(dout, cache):
         #######################################################################
         # TODO: Implement training phase backward pass for inverted dropout   #
         #######################################################################
-        dx = mask*dout
+        stream = dropout_param.get('stream')
+        if stream is not None:
+            keep = mask
+            if not isinstance(keep, np.ndarray):
+                keep = stream.keep_mask(dout.shape, dropout_param['p'], mask)
+            dx = np.multiply(dout, keep, out=dx_out)
+            dx *= 1 / dropout_param['p']
+        elif dx_out is None:
+            dx = mask*dout
+        else:
+            dx = np.multiply(dout, mask, out=dx_out)
         #######################################################################
         #                          END OF YOUR CODE                           #
         #######################################################################
     elif mode == 'test':
         dx = dout
+        if dx_out is not None and dx_out is not dout:
+            dx = dx_out
+            np.copyto(dx, dout)
     return dx
 
 
-def conv_forward_naive(x, w, b, conv_param):
+def dropout_forward_inplace(x, dropout_param, keep=()):
+    """
+    Forward pass for (inverted) dropout that overwrites x with the output.
+
+    Inputs:
+    - x: Input data, of any shape; overwritten with the output
+    - dropout_param: As in dropout_forward
+    - keep: Arrays that must not be overwritten (see _check_inplace)
+
+    Returns a tuple of:
+    - out: Output; this is x itself
+    - cache: (dropout_param, mask) as in dropout_forward
+    """
+    _check_inplace(x, keep)
+    return dropout_forward(x, dropout_param, out=x)
+
+
+def dropout_backward_inplace(dout, cache, keep=()):
+    """
+    Backward pass for (inverted) dropout that overwrites dout with dx.
+
+    Inputs:
+    - dout: Upstream derivatives, of any shape; overwritten with dx
+    - cache: (dropout_param, mask) from dropout_forward.
+    - keep: Arrays that must not be overwritten (see _check_inplace)
+    """
+    _check_inplace(dout, keep)
+    return dropout_backward(dout, cache, dx_out=dout)
+
+
+def conv_forward_naive(x, w, b, conv_param, out=None):
     """
     A naive implementation of the forward pass for a convolutional layer.
 
@@ -604,6 +781,7 @@ def conv_forward_naive(x, w, b, conv_param):
       - 'stride': The number of pixels between adjacent receptive fields in the
         horizontal and vertical directions.
       - 'pad': The number of pixels that will be used to zero-pad the input.
+    - out: Optional preallocated output buffer of shape (N, F, H', W')
 
 
     During padding, 'pad' zeros should be placed symmetrically (i.e equally on both sides)
@@ -616,7 +794,6 @@ def conv_forward_naive(x, w, b, conv_param):
       W' = 1 + (W + 2 * pad - WW) / stride
     - cache: (x, w, b, conv_param)
     """
-    out = None
     ###########################################################################
     # TODO: Implement the convolutional forward pass.                         #
     # Hint: you can use the function np.pad for padding.                      #
@@ -634,7 +811,8 @@ def conv_forward_naive(x, w, b, conv_param):
     # Create output
     H_out = int(1 + (H + 2 * pad - HH) / stride)
     W_out = int(1 + (W + 2 * pad - WW) / stride)
-    out = np.zeros((N, F, H_out, W_out))
+    if out is None:
+        out = np.zeros((N, F, H_out, W_out))
 
     # Zero pad x
     x_padded = np.pad(x, ((0,0),(0,0), (pad,pad), (pad,pad)), 'constant')
@@ -659,13 +837,14 @@ def conv_forward_naive(x, w, b, conv_param):
     return out, cache
 
 
-def conv_backward_naive(dout, cache):
+def conv_backward_naive(dout, cache, dx_out=None, dw_out=None, db_out=None):
     """
     A naive implementation of the backward pass for a convolutional layer.
 
     Inputs:
     - dout: Upstream derivatives.
     - cache: A tuple of (x, w, b, conv_param) as in conv_forward_naive
+    - dx_out, dw_out, db_out: Optional preallocated buffers for dx, dw, db
 
     Returns a tuple of:
     - dx: Gradient with respect to x
@@ -687,15 +866,18 @@ def conv_backward_naive(dout, cache):
     #####  backprop of b
     #  b is of shape (F, ) and db should be the same
     #  dout is of shape N x F x H' x W'
-    db = np.sum(dout, axis= (0, 2, 3))
+    db = np.sum(dout, axis= (0, 2, 3), out=db_out)
 
 
     ##### backprop of filter weights w and input data x
     # w is of shape (F, C, HH, WW) and dw should be the same
     # # x is of shape (N, C, H, W) and dx should be the same
 
-    dw = np.zeros_like(w)
-    dx = np.zeros_like(x)
+    if dw_out is None:
+        dw = np.zeros_like(w)
+    else:
+        dw = dw_out
+        dw.fill(0)
     dx_padded = np.zeros_like(x_padded)
 
     for filter_num in range(F):
@@ -718,7 +900,8 @@ def conv_backward_naive(dout, cache):
                                         stride*out_w : (WW + stride*out_w)]   \
                                += w_f* dout[sample_num,filter_num,out_h, out_w]
 
-    dx = dx_padded[:, :, pad:-pad, pad:-pad]
+    H, W = x.shape[2], x.shape[3]
+    dx = _store(dx_padded[:, :, pad:pad + H, pad:pad + W], dx_out)
 
     ###########################################################################
     #                             END OF YOUR CODE                            #
@@ -726,7 +909,7 @@ def conv_backward_naive(dout, cache):
     return dx, dw, db
 
 
-def max_pool_forward_naive(x, pool_param):
+def max_pool_forward_naive(x, pool_param, out=None):
     """
     A naive implementation of the forward pass for a max-pooling layer.
 
@@ -736,6 +919,7 @@ def max_pool_forward_naive(x, pool_param):
       - 'pool_height': The height of each pooling region
       - 'pool_width': The width of each pooling region
       - 'stride': The distance between adjacent pooling regions
+    - out: Optional preallocated output buffer of shape (N, C, H', W')
 
     No padding is necessary here. Output size is given by
 
@@ -745,7 +929,6 @@ def max_pool_forward_naive(x, pool_param):
       W' = 1 + (W - pool_width) / stride
     - cache: (x, pool_param)
     """
-    out = None
     ###########################################################################
     # TODO: Implement the max-pooling forward pass                            #
     ###########################################################################
@@ -757,7 +940,8 @@ def max_pool_forward_naive(x, pool_param):
     H_out = int(1 + (H - pool_height) / stride)
     W_out = int(1 + (W - pool_width) / stride)
 
-    out = np.zeros((N, C, H_out, W_out))
+    if out is None:
+        out = np.zeros((N, C, H_out, W_out))
 
     for sample_num in range(N):
         for channel_num in range(C):
@@ -776,13 +960,14 @@ def max_pool_forward_naive(x, pool_param):
     return out, cache
 
 
-def max_pool_backward_naive(dout, cache):
+def max_pool_backward_naive(dout, cache, dx_out=None):
     """
     A naive implementation of the backward pass for a max-pooling layer.
 
     Inputs:
     - dout: Upstream derivatives
     - cache: A tuple of (x, pool_param) as in the forward pass.
+    - dx_out: Optional preallocated buffer for dx
 
     Returns:
     - dx: Gradient with respect to x
@@ -801,7 +986,11 @@ def max_pool_backward_naive(dout, cache):
     H_out = int(1 + (H - pool_height) / stride)
     W_out = int(1 + (W - pool_width) / stride)
 
-    dx = np.zeros_like(x)
+    if dx_out is None:
+        dx = np.zeros_like(x)
+    else:
+        dx = dx_out
+        dx.fill(0)
 
     for sample_num in range(N):
         for channel_num in range(C):
@@ -823,7 +1012,7 @@ def max_pool_backward_naive(dout, cache):
     return dx
 
 
-def spatial_batchnorm_forward(x, gamma, beta, bn_param):
+def spatial_batchnorm_forward(x, gamma, beta, bn_param, out=None):
     """
     Computes the forward pass for spatial batch normalization.
 
@@ -840,12 +1029,13 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
         default of momentum=0.9 should work well in most situations.
       - running_mean: Array of shape (D,) giving running mean of features
       - running_var Array of shape (D,) giving running variance of features
+    - out: Optional preallocated output buffer of shape (N, C, H, W)
 
     Returns a tuple of:
     - out: Output data, of shape (N, C, H, W)
     - cache: Values needed for the backward pass
     """
-    out, cache = None, None
+    cache = None
 
     ###########################################################################
     # TODO: Implement the forward pass for spatial batch normalization.       #
@@ -860,8 +1050,8 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
     # to batchnorm
     N, C, H, W = x.shape
     x = np.swapaxes(x,0,1).reshape(C, -1).T   #Now of chape (C, H*W*N)
-    out, cache = batchnorm_forward(x, gamma, beta, bn_param)
-    out = np.swapaxes((out.T).reshape(C, N, H, W),0,1)
+    y, cache = batchnorm_forward(x, gamma, beta, bn_param)
+    out = _store(np.swapaxes((y.T).reshape(C, N, H, W),0,1), out)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
@@ -869,13 +1059,16 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
     return out, cache
 
 
-def spatial_batchnorm_backward(dout, cache):
+def spatial_batchnorm_backward(dout, cache, dx_out=None, dgamma_out=None,
+                               dbeta_out=None):
     """
     Computes the backward pass for spatial batch normalization.
 
     Inputs:
     - dout: Upstream derivatives, of shape (N, C, H, W)
     - cache: Values from the forward pass
+    - dx_out, dgamma_out, dbeta_out: Optional preallocated buffers for dx,
+      dgamma, dbeta
 
     Returns a tuple of:
     - dx: Gradient with respect to inputs, of shape (N, C, H, W)
@@ -893,8 +1086,9 @@ def spatial_batchnorm_backward(dout, cache):
     ###########################################################################
     N, C, H, W = dout.shape
     dout = np.swapaxes(dout,0,1).reshape(C, -1).T   #Now of chape (C, H*W*N)
-    dx, dgamma, dbeta = batchnorm_backward(dout, cache)
-    dx = np.swapaxes((dx.T).reshape(C, N, H, W),0,1)
+    dx, dgamma, dbeta = batchnorm_backward(dout, cache, dgamma_out=dgamma_out,
+                                           dbeta_out=dbeta_out)
+    dx = _store(np.swapaxes((dx.T).reshape(C, N, H, W),0,1), dx_out)
 
 
     ###########################################################################
@@ -904,7 +1098,7 @@ def spatial_batchnorm_backward(dout, cache):
     return dx, dgamma, dbeta
 
 
-def spatial_groupnorm_forward(x, gamma, beta, G, gn_param):
+def spatial_groupnorm_forward(x, gamma, beta, G, gn_param, out=None):
     """
     Computes the forward pass for spatial group normalization.
     In contrast to layer normalization, group normalization splits each entry
@@ -919,12 +1113,13 @@ def spatial_groupnorm_forward(x, gamma, beta, G, gn_param):
     - G: Integer mumber of groups to split into, should be a divisor of C
     - gn_param: Dictionary with the following keys:
       - eps: Constant for numeric stability
+    - out: Optional preallocated output buffer of shape (N, C, H, W)
 
     Returns a tuple of:
     - out: Output data, of shape (N, C, H, W)
     - cache: Values needed for the backward pass
     """
-    out, cache = None, None
+    cache = None
     eps = gn_param.get('eps',1e-5)
     ###########################################################################
     # TODO: Implement the forward pass for spatial group normalization.       #
@@ -964,10 +1159,11 @@ def spatial_groupnorm_forward(x, gamma, beta, G, gn_param):
     xhat = xhat.reshape(N,C,H, W)
 
     #step8: Nor the two transformation steps
-    gammax = gamma * xhat
+    gammax = np.multiply(gamma, xhat, out=out)
 
     #step9
-    out = gammax + beta
+    gammax += beta
+    out = gammax
 
     #store intermediate
     cache = (xhat,gamma,xmu,ivar,sqrtvar,var,eps)
@@ -978,13 +1174,16 @@ def spatial_groupnorm_forward(x, gamma, beta, G, gn_param):
     return out, cache
 
 
-def spatial_groupnorm_backward(dout, cache):
+def spatial_groupnorm_backward(dout, cache, dx_out=None, dgamma_out=None,
+                               dbeta_out=None):
     """
     Computes the backward pass for spatial group normalization.
 
     Inputs:
     - dout: Upstream derivatives, of shape (N, C, H, W)
     - cache: Values from the forward pass
+    - dx_out, dgamma_out, dbeta_out: Optional preallocated buffers for dx,
+      dgamma, dbeta
 
     Returns a tuple of:
     - dx: Gradient with respect to inputs, of shape (N, C, H, W)
@@ -1003,11 +1202,11 @@ def spatial_groupnorm_backward(dout, cache):
     N,G,group_size, H,W = xmu.shape
 
     #step9: out = gammax + beta
-    dbeta = np.sum(dout, axis=(0,2,3),keepdims=True)
+    dbeta = np.sum(dout, axis=(0,2,3),keepdims=True, out=dbeta_out)
     dgammax = dout
 
     #step8: gammax = gamma times x_hat
-    dgamma = np.sum(xhat*dgammax, axis=(0,2,3), keepdims=True)
+    dgamma = np.sum(xhat*dgammax, axis=(0,2,3), keepdims=True, out=dgamma_out)
     dxhat = gamma * dgammax
 
     #intermediate step (reshape)
@@ -1026,7 +1225,7 @@ def spatial_groupnorm_backward(dout, cache):
 
     #step4: var = (1/(group_size*H*W)) * np.sum(sq, axis=(2,3,4), keepdims=True)
     #dsq should be of shape (N, G, group_size, H, W)
-    dsq = (1/(group_size*H*W)) * np.ones((N, G, group_size, H, W)) * dvar
+    dsq = (1/(group_size*H*W)) * np.ones((N, G, group_size, H, W), dtype=dout.dtype) * dvar
 
     #step3: sq = xmu**2
     dxmu2 = 2*xmu*dsq
@@ -1039,21 +1238,21 @@ def spatial_groupnorm_backward(dout, cache):
 
 
     #step1: mu = mean of group
-    dx2 =  (1/(group_size*H*W)) * np.ones((N,G, group_size, H,W)) * dmu
+    dx2 =  (1/(group_size*H*W)) * np.ones((N,G, group_size, H,W), dtype=dout.dtype) * dmu
 
     #step0
     dx = dx1 + dx2
 
     # Reshape output
     C = group_size * G
-    dx = dx.reshape(N, C, H, W)
+    dx = _store(dx.reshape(N, C, H, W), dx_out)
     ###########################################################################
     #                             END OF YOUR CODE                            #
     ###########################################################################
     return dx, dgamma, dbeta
 
 
-def svm_loss(x, y):
+def svm_loss(x, y, dx_out=None):
     """
     Computes the loss and gradient using for multiclass SVM classification.
 
@@ -1062,6 +1261,7 @@ def svm_loss(x, y):
       class for the ith input.
     - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
       0 <= y[i] < C
+    - dx_out: Optional preallocated buffer of shape (N, C) for dx
 
     Returns a tuple of:
     - loss: Scalar giving the loss
@@ -1073,14 +1273,18 @@ def svm_loss(x, y):
     margins[np.arange(N), y] = 0
     loss = np.sum(margins) / N
     num_pos = np.sum(margins > 0, axis=1)
-    dx = np.zeros_like(x)
+    if dx_out is None:
+        dx = np.zeros_like(x)
+    else:
+        dx = dx_out
+        dx.fill(0)
     dx[margins > 0] = 1
     dx[np.arange(N), y] -= num_pos
     dx /= N
     return loss, dx
 
 
-def softmax_loss(x, y):
+def softmax_loss(x, y, dx_out=None):
     """
     Computes the loss and gradient for softmax classification.
 
@@ -1089,6 +1293,7 @@ def softmax_loss(x, y):
       class for the ith input.
     - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
       0 <= y[i] < C
+    - dx_out: Optional preallocated buffer of shape (N, C) for dx
 
     Returns a tuple of:
     - loss: Scalar giving the loss
@@ -1100,7 +1305,7 @@ def softmax_loss(x, y):
     probs = np.exp(log_probs)
     N = x.shape[0]
     loss = -np.sum(log_probs[np.arange(N), y]) / N
-    dx = probs.copy()
+    dx = _store(probs, dx_out)
     dx[np.arange(N), y] -= 1
     dx /= N
     return loss, dx
@@ -0,0 +1,283 @@
+from __future__ import division
+from builtins import range
+from builtins import object
+import time
+import numpy as np
+
+from cs231n.inference import Predictor
+from cs231n.solver import Solver
+from cs231n.classifiers.fc_net import FullyConnectedNet
+from cs231n.classifiers.cnn import ThreeLayerConvNet, DeepConvNet
+from cs231n.classifiers.sequential import (Sequential, Affine, Conv, Pool,
+                                           BatchNorm, ReLU, Dropout,
+                                           SoftmaxLoss)
+
+"""
+This file implements low-rank compression of the affine layers of a model.
+
+An affine layer with weights W of shape (D, M) costs D * M multiply-adds per
+example. Its truncated SVD W ~= U[:, :r] S[:r] V[:r] splits it into two thin
+affine layers, x -> x A -> (x A) B + b with A = U[:, :r] sqrt(S[:r]) of shape
+(D, r) and B = sqrt(S[:r]) V[:r] of shape (r, M), which cost r * (D + M)
+multiply-adds; for the hidden layer of a ThreeLayerConvNet (8192 x 100 at the
+defaults) rank 20 is about 4x cheaper. Splitting sqrt(S) between both factors
+keeps their scales balanced, which helps fine-tuning.
+
+compress_model(model, ['W2'], rank=20) converts a FullyConnectedNet,
+ThreeLayerConvNet or DeepConvNet into an equivalent Sequential model in which
+the selected affine layers are replaced by pairs of thin Affine layers (the
+first one with a zero bias). The result trains with the Solver, so the
+accuracy lost by the truncation can be won back with a few epochs of
+fine_tune(), and runs with the Predictor. LowRankReport compares accuracy,
+size and latency of the original and the compressed model.
+
+Note that the parameters of the Sequential model are numbered in layer order,
+so the names of the layers after a factorized one shift by one.
+"""
+
+
+def choose_rank(s, rank=None, energy=None):
+    """
+    Pick the rank of a truncated SVD.
+
+    Inputs:
+    - s: Array of singular values in decreasing order
+    - rank: If not None, the rank to use (clipped to len(s))
+    - energy: If rank is None, keep the smallest number of singular values
+      whose squares sum to at least this fraction of the total, e.g. 0.9
+
+    Returns:
+    - r: The rank
+    """
+    if rank is not None:
+        return max(1, min(int(rank), len(s)))
+    if energy is None:
+        raise ValueError('Either rank or energy must be given')
+    if not 0 < energy <= 1:
+        raise ValueError('Invalid energy %f' % energy)
+    kept = np.cumsum(s.astype(np.float64) ** 2)
+    if kept[-1] == 0:
+        return 1
+    return int(np.searchsorted(kept / kept[-1], energy - 1e-12)) + 1
+
+
+def factorize_affine(w, rank=None, energy=None):
+    """
+    Truncated SVD factorization of affine weights.
+
+    Inputs:
+    - w: Array of shape (D, M)
+    - rank, energy: See choose_rank
+
+    Returns a tuple of:
+    - a: Array of shape (D, r)
+    - b: Array of shape (r, M), with a.dot(b) ~= w
+    """
+    u, s, vt = np.linalg.svd(w.astype(np.float64), full_matrices=False)
+    r = choose_rank(s, rank, energy)
+    root = np.sqrt(s[:r])
+    a = (u[:, :r] * root).astype(w.dtype)
+    b = (root[:, None] * vt[:r]).astype(w.dtype)
+    return a, b
+
+
+def _fc_net_layers(model):
+    layers = []
+    for i in range(1, model.num_layers):
+        layers.append((Affine, 'W%d' % i, 'b%d' % i))
+        if model.normalization == 'batchnorm':
+            layers.append((BatchNorm, 'gamma%d' % i, 'beta%d' % i,
+                           model.bn_params[i - 1]))
+        elif model.normalization is not None:
+            raise ValueError('Cannot convert %s normalization'
+                             % model.normalization)
+        layers.append((ReLU,))
+        if model.use_dropout:
+            layers.append((Dropout, model.dropout_param['p']))
+    L = model.num_layers
+    layers.append((Affine, 'W%d' % L, 'b%d' % L))
+    return model.params['W1'].shape[0], layers
+
+
+def _three_layer_conv_net_layers(model):
+    filter_size = model.params['W1'].shape[2]
+    conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2}
+    layers = [(Conv, 'W1', 'b1', conv_param), (Pool, 2, 2),
+              (Affine, 'W2', 'b2'), (ReLU,), (Affine, 'W3', 'b3')]
+    return model.input_dim, layers
+
+
+def _deep_conv_net_layers(model):
+    layers = []
+    for (w_key, b_key, conv_param, gamma_key, beta_key, bn_param,
+         pool_forward, _, pool_param) in model._blocks:
+        layers.append((Conv, w_key, b_key, conv_param))
+        if bn_param is not None:
+            layers.append((BatchNorm, gamma_key, beta_key, bn_param))
+        layers.append((ReLU,))
+        if pool_forward is not None:
+            layers.append((Pool, pool_param['pool_height'],
+                           pool_param['stride']))
+    for w_key, b_key in model._affine_keys[:-1]:
+        layers.append((Affine, w_key, b_key))
+        layers.append((ReLU,))
+    layers.append((Affine,) + tuple(model._affine_keys[-1]))
+    return model.input_dim, layers
+
+
+_LAYER_BUILDERS = [
+  (FullyConnectedNet, _fc_net_layers),
+  (ThreeLayerConvNet, _three_layer_conv_net_layers),
+  (DeepConvNet, _deep_conv_net_layers),
+]
+
+
+def compress_model(model, layers, rank=None, energy=None):
+    """
+    Replace affine layers of a trained model by pairs of thin affine layers.
+
+    Inputs:
+    - model: A trained FullyConnectedNet (without layer normalization),
+      ThreeLayerConvNet or DeepConvNet
+    - layers: List of the weight names of the affine layers to factorize,
+      e.g. ['W2'] for the hidden layer of a ThreeLayerConvNet
+    - rank: Integer rank for all factorized layers, or a dictionary mapping
+      weight names to ranks
+    - energy: Fraction of the squared singular values to keep in every
+      factorized layer, used when no rank is given for it
+
+    Returns a tuple of:
+    - compressed: A Sequential model computing the same function up to the
+      truncation, with copies of the parameters and batchnorm statistics
+    - ranks: Dictionary mapping the factorized weight names to their ranks
+    """
+    build_layers = None
+    for cls, builder in _LAYER_BUILDERS:
+        if type(model) is cls:
+            build_layers = builder
+    if build_layers is None:
+        raise ValueError('Cannot compress %s' % type(model).__name__)
+    input_dim, specs = build_layers(model)
+
+    affine_keys = [spec[1] for spec in specs if spec[0] is Affine]
+    for key in layers:
+        if key not in affine_keys:
+            raise ValueError('%s is not the weight of an affine layer' % key)
+
+    # Build the layer list, remembering the arrays each layer starts from
+    seq_layers, sources, ranks = [], [], {}
+    for spec in specs:
+        kind = spec[0]
+        if kind is Affine and spec[1] in layers:
+            w, b = model.params[spec[1]], model.params[spec[2]]
+            layer_rank = rank.get(spec[1]) if isinstance(rank, dict) else rank
+            a, v = factorize_affine(w, layer_rank, energy)
+            ranks[spec[1]] = a.shape[1]
+            seq_layers += [Affine(a.shape[1]), Affine(w.shape[1])]
+            sources += [(a, np.zeros(a.shape[1])), (v, b)]
+        elif kind is Affine:
+            w, b = model.params[spec[1]], model.params[spec[2]]
+            seq_layers.append(Affine(w.shape[1]))
+            sources.append((w, b))
+        elif kind is Conv:
+            w, b = model.params[spec[1]], model.params[spec[2]]
+            seq_layers.append(Conv(w.shape[0], w.shape[2],
+                                   spec[3]['stride'], spec[3]['pad']))
+            sources.append((w, b))
+        elif kind is BatchNorm:
+            seq_layers.append(BatchNorm())
+            sources.append((model.params[spec[1]], model.params[spec[2]],
+                            spec[3]))
+        else:
+            seq_layers.append(kind(*spec[1:]))
+            sources.append(None)
+    seq_layers.append(SoftmaxLoss())
+
+    compressed = Sequential(seq_layers, input_dim=input_dim, reg=model.reg,
+                            dtype=model.dtype)
+    params = compressed.params
+    for layer, source in zip(seq_layers, sources):
+        if isinstance(layer, (Affine, Conv)):
+            params[layer.w_key] = source[0].astype(model.dtype)
+            params[layer.b_key] = source[1].astype(model.dtype)
+        elif isinstance(layer, BatchNorm):
+            params[layer.gamma_key] = source[0].astype(model.dtype)
+            params[layer.beta_key] = source[1].astype(model.dtype)
+            for k, v in source[2].items():
+                if k != 'mode':
+                    layer.param[k] = v.copy() if hasattr(v, 'copy') else v
+    return compressed, ranks
+
+
+def fine_tune(compressed, data, **kwargs):
+    """
+    Short fine-tuning of a compressed model with the Solver, to recover the
+    accuracy lost by the truncation.
+
+    Inputs:
+    - compressed: Model returned by compress_model
+    - data: Data dictionary as for the Solver
+    - kwargs: Solver options; num_epochs defaults to 1 and the optimizer
+      to sgd_momentum with a learning rate of 1e-3
+
+    Returns:
+    - solver: The Solver after training; the model keeps its best parameters
+    """
+    kwargs.setdefault('num_epochs', 1)
+    kwargs.setdefault('update_rule', 'sgd_momentum')
+    kwargs.setdefault('optim_config', {'learning_rate': 1e-3})
+    solver = Solver(compressed, data, **kwargs)
+    solver.train()
+    return solver
+
+
+class LowRankReport(object):
+    """
+    Accuracy, size and speed of a compressed model against the original.
+
+    Attributes:
+    - ranks: Dictionary mapping the factorized weight names to their ranks
+    - original_acc, compressed_acc: Accuracy of both models on the given data
+    - original_params, compressed_params: Number of parameters of both models
+    - original_time, compressed_time: Seconds to predict the given data
+    """
+
+    def __init__(self, model, compressed, ranks, X, y, batch_size=1000):
+        """
+        Inputs:
+        - model: The original model
+        - compressed, ranks: Output of compress_model for it
+        - X, y: Evaluation data and labels, usually X_val and y_val
+        - batch_size: Batch size of the Predictors
+        """
+        self.ranks = ranks
+        results = []
+        for m in (model, compressed):
+            predictor = Predictor(m, batch_size=batch_size)
+            predictor.predict(X[:batch_size])
+            tic = time.time()
+            y_pred = predictor.predict(X)
+            results.append((np.mean(y_pred == y), time.time() - tic,
+                            sum(v.size for v in m.params.values())))
+        self.original_acc, self.original_time, self.original_params = results[0]
+        (self.compressed_acc, self.compressed_time,
+         self.compressed_params) = results[1]
+
+
+    def report(self):
+        """
+        Returns a human readable summary.
+        """
+        lines = [
+          'Factorized layers: %s' % ', '.join(
+              '%s (rank %d)' % (k, self.ranks[k]) for k in sorted(self.ranks)),
+          '              accuracy    params   time (s)',
+          '  original    %8.4f  %8d  %9.3f' % (
+              self.original_acc, self.original_params, self.original_time),
+          '  compressed  %8.4f  %8d  %9.3f' % (
+              self.compressed_acc, self.compressed_params,
+              self.compressed_time),
+          '  speedup %.2fx' % (self.original_time /
+                               max(self.compressed_time, 1e-12)),
+        ]
+        return '\n'.join(lines)
@@ -0,0 +1,179 @@
+from __future__ import division
+from builtins import object
+import math
+
+"""
+This file implements learning rate schedules for the Solver.
+
+A schedule maps the iteration number to a learning rate. The Solver
+evaluates its schedule once per iteration, keeps the result in
+solver.learning_rate and hands that single value to the update rule of every
+parameter, so a schedule is never copied into the per-parameter configs.
+
+Every schedule has the same interface:
+
+- schedule(iteration, num_iterations, base_lr) returns the learning rate for
+  the update of the given (0-based) iteration of a run of num_iterations
+  iterations, where base_lr is the learning_rate of the optim_config;
+- schedule.observe(val_acc) is called by the Solver with the validation
+  accuracy after every accuracy check; only ReduceOnPlateau uses it;
+- schedule.state() returns a JSON serializable dictionary of the state the
+  schedule has accumulated, and schedule.set_state(state) restores it; the
+  Solver saves it in its checkpoints.
+
+Schedules can be combined with LinearWarmup, e.g.
+LinearWarmup(CosineDecay(), warmup_iters=500).
+"""
+
+
+class LRSchedule(object):
+    """
+    Base class of the learning rate schedules: a constant learning rate.
+    """
+
+    def __call__(self, iteration, num_iterations, base_lr):
+        return base_lr
+
+    def observe(self, val_acc):
+        pass
+
+    def state(self):
+        return {}
+
+    def set_state(self, state):
+        pass
+
+
+class StepDecay(LRSchedule):
+    """
+    Multiply the learning rate by gamma every step_size iterations. The
+    Solver's lr_decay option is StepDecay(iterations_per_epoch, lr_decay).
+    """
+
+    def __init__(self, step_size, gamma=0.1):
+        self.step_size = step_size
+        self.gamma = gamma
+
+    def __call__(self, iteration, num_iterations, base_lr):
+        return base_lr * self.gamma ** (iteration // self.step_size)
+
+
+class CosineDecay(LRSchedule):
+    """
+    Anneal the learning rate from base_lr to min_lr along half a cosine over
+    the whole run.
+    """
+
+    def __init__(self, min_lr=0.0):
+        self.min_lr = min_lr
+
+    def __call__(self, iteration, num_iterations, base_lr):
+        progress = iteration / max(num_iterations, 1)
+        cosine = 0.5 * (1 + math.cos(math.pi * progress))
+        return self.min_lr + (base_lr - self.min_lr) * cosine
+
+
+class OneCycle(LRSchedule):
+    """
+    One-cycle policy (Smith, 2018): the learning rate rises from
+    max_lr / div_factor to max_lr over the first pct_start of the run, then
+    falls to max_lr / (div_factor * final_div_factor) over the rest, both
+    along half a cosine. Short runs with a large max_lr often reach the
+    accuracy of much longer runs with a decaying learning rate.
+    """
+
+    def __init__(self, max_lr=None, pct_start=0.3, div_factor=25.0,
+                 final_div_factor=1e4):
+        """
+        Inputs:
+        - max_lr: Peak learning rate; default is the base learning rate
+        - pct_start: Fraction of the run spent increasing the learning rate
+        - div_factor: The run starts at max_lr / div_factor
+        - final_div_factor: The run ends at max_lr / div_factor divided by this
+        """
+        self.max_lr = max_lr
+        self.pct_start = pct_start
+        self.div_factor = div_factor
+        self.final_div_factor = final_div_factor
+
+    def __call__(self, iteration, num_iterations, base_lr):
+        max_lr = base_lr if self.max_lr is None else self.max_lr
+        start_lr = max_lr / self.div_factor
+        final_lr = start_lr / self.final_div_factor
+        peak = max(int(self.pct_start * num_iterations), 1)
+        if iteration < peak:
+            lo, hi, progress = start_lr, max_lr, iteration / peak
+        else:
+            progress = (iteration - peak) / max(num_iterations - 1 - peak, 1)
+            lo, hi, progress = max_lr, final_lr, min(progress, 1.0)
+        return hi + (lo - hi) * 0.5 * (1 + math.cos(math.pi * progress))
+
+
+class LinearWarmup(LRSchedule):
+    """
+    Scale the learning rate of another schedule linearly from
+    1 / warmup_iters to 1 over the first warmup_iters iterations.
+    """
+
+    def __init__(self, schedule=None, warmup_iters=1000):
+        """
+        Inputs:
+        - schedule: The schedule to warm up; default is a constant rate
+        - warmup_iters: Number of warmup iterations
+        """
+        self.schedule = LRSchedule() if schedule is None else schedule
+        self.warmup_iters = warmup_iters
+
+    def __call__(self, iteration, num_iterations, base_lr):
+        lr = self.schedule(iteration, num_iterations, base_lr)
+        if iteration < self.warmup_iters:
+            lr *= (iteration + 1) / self.warmup_iters
+        return lr
+
+    def observe(self, val_acc):
+        self.schedule.observe(val_acc)
+
+    def state(self):
+        return self.schedule.state()
+
+    def set_state(self, state):
+        self.schedule.set_state(state)
+
+
+class ReduceOnPlateau(LRSchedule):
+    """
+    Multiply the learning rate by factor whenever the validation accuracy
+    has not improved by more than threshold for patience accuracy checks.
+    """
+
+    def __init__(self, factor=0.1, patience=2, threshold=1e-4, min_lr=0.0):
+        self.factor = factor
+        self.patience = patience
+        self.threshold = threshold
+        self.min_lr = min_lr
+        self.scale = 1.0
+        self.best_val_acc = None
+        self.bad_checks = 0
+
+    def __call__(self, iteration, num_iterations, base_lr):
+        return max(base_lr * self.scale, self.min_lr)
+
+    def observe(self, val_acc):
+        if self.best_val_acc is None or \
+           val_acc > self.best_val_acc + self.threshold:
+            self.best_val_acc = float(val_acc)
+            self.bad_checks = 0
+            return
+        self.bad_checks += 1
+        if self.bad_checks > self.patience:
+            self.scale *= self.factor
+            self.bad_checks = 0
+
+    def state(self):
+        return {'scale': self.scale, 'best_val_acc': self.best_val_acc,
+                'bad_checks': self.bad_checks}
+
+    def set_state(self, state):
+        self.scale = state['scale']
+        self.best_val_acc = state['best_val_acc']
+        self.bad_checks = state['bad_checks']
@@ -0,0 +1,202 @@
+from builtins import object
+import numpy as np
+
+"""
+This file implements a liveness-based memory planner for training passes.
+
+A training step normally allocates a fresh array for every activation and
+every activation gradient, and keeps the activations alive in the caches
+until the backward pass is done. Most of these arrays are only needed for
+part of the step, so the same memory can be handed to several of them.
+
+Planning works in two phases:
+
+1. A model does a shape dry-run of its forward and backward pass on a
+   MemoryPlanner: it numbers the steps of the pass with tick(), declares each
+   tensor with define() at the step that writes it, and calls use() at every
+   later step that reads it (including the backward step that consumes a
+   cache referencing it). Arrays that the layer functions allocate internally
+   for their caches can be declared with planned=False; they are not given a
+   buffer but are counted in the memory report.
+
+2. plan() computes the lifetime [first step, last step] of every tensor and
+   assigns the planned tensors to a small pool of buffers so that no two
+   tensors with overlapping lifetimes share a buffer. The resulting
+   MemoryPlan allocates the pool once and hands out views of it, which the
+   model passes to the layer functions as out= / dx_out= buffers.
+
+Tensors written and read in the same step always overlap, so an output is
+never planned into the buffer of an input of the same layer; in-place layers
+simply use() the tensor they overwrite instead of defining a new one.
+"""
+
+
+class MemoryPlanner(object):
+    """
+    Records the tensors of a shape dry-run and their lifetimes.
+    """
+
+    def __init__(self, dtype=np.float32):
+        """
+        Inputs:
+        - dtype: dtype of the planned tensors
+        """
+        self.dtype = np.dtype(dtype)
+        self.step = 0
+        self._tensors = {}
+        self._order = []
+
+
+    def tick(self):
+        """
+        Start the next step of the pass.
+        """
+        self.step += 1
+
+
+    def define(self, name, shape, planned=True, dtype=None):
+        """
+        Declare a tensor written at the current step.
+
+        Inputs:
+        - name: Unique name of the tensor
+        - shape: Shape of the tensor
+        - planned: If False, the tensor is allocated by a layer function and
+          only counted in the report
+        - dtype: dtype of an unplanned tensor; planned tensors always use the
+          dtype of the planner
+        """
+        if name in self._tensors:
+            raise ValueError('Tensor "%s" is defined twice' % name)
+        if planned or dtype is None:
+            dtype = self.dtype
+        self._tensors[name] = [tuple(shape), np.dtype(dtype), planned,
+                               self.step, self.step]
+        self._order.append(name)
+
+
+    def use(self, *names):
+        """
+        Declare that the given tensors are read at the current step.
+        """
+        for name in names:
+            self._tensors[name][4] = self.step
+
+
+    def plan(self, batch_size):
+        """
+        Assign the planned tensors to buffers.
+
+        Inputs:
+        - batch_size: Batch size the dry-run was done for
+
+        Returns:
+        - plan: A MemoryPlan
+        """
+        tensors = [(name,) + tuple(self._tensors[name]) for name in self._order]
+        return MemoryPlan(tensors, batch_size, self.dtype)
+
+
+class MemoryPlan(object):
+    """
+    Buffer assignment computed by MemoryPlanner.plan().
+
+    Attributes:
+    - batch_size: Batch size the plan is valid for
+    - assignment: Dictionary mapping each planned tensor to a buffer index
+    - buffer_sizes: List giving the number of elements of each buffer
+    - buffers: Dictionary mapping each planned tensor to a view of its buffer
+    - naive_bytes: Bytes needed if every tensor had its own array
+    - min_bytes: Largest number of bytes live at any one step; no plan can
+      do better than this
+    - peak_bytes: Bytes needed with this plan, i.e. the buffer pool plus the
+      peak of the unplanned cache arrays
+    """
+
+    def __init__(self, tensors, batch_size, dtype):
+        """
+        Inputs:
+        - tensors: List of (name, shape, dtype, planned, start, end) tuples
+        - batch_size: Batch size the tensors were traced for
+        - dtype: dtype of the buffer pool
+        """
+        self.tensors = tensors
+        self.batch_size = batch_size
+        self.dtype = np.dtype(dtype)
+        self.assignment = {}
+        self.buffer_sizes = []
+
+        # Greedy interval assignment in order of first use: reuse the free
+        # buffer that fits best, growing the largest free one if none fits.
+        buffer_free_at = []
+        for name, shape, _, planned, start, end in tensors:
+            if not planned:
+                continue
+            size = int(np.prod(shape))
+            free = [j for j, t in enumerate(buffer_free_at) if t < start]
+            fitting = [j for j in free if self.buffer_sizes[j] >= size]
+            if fitting:
+                j = min(fitting, key=lambda j: self.buffer_sizes[j])
+            elif free:
+                j = max(free, key=lambda j: self.buffer_sizes[j])
+                self.buffer_sizes[j] = size
+            else:
+                j = len(self.buffer_sizes)
+                self.buffer_sizes.append(size)
+                buffer_free_at.append(end)
+            buffer_free_at[j] = end
+            self.assignment[name] = j
+
+        # Memory accounting
+        num_steps = max([t[5] for t in tensors] + [0]) + 1
+        live = np.zeros(num_steps, dtype=np.int64)
+        unplanned = np.zeros(num_steps, dtype=np.int64)
+        self.naive_bytes = 0
+        for name, shape, tensor_dtype, planned, start, end in tensors:
+            nbytes = int(np.prod(shape)) * tensor_dtype.itemsize
+            live[start:end + 1] += nbytes
+            self.naive_bytes += nbytes
+            if not planned:
+                unplanned[start:end + 1] += nbytes
+        self.min_bytes = int(live.max())
+        self.pool_bytes = sum(self.buffer_sizes) * self.dtype.itemsize
+        self.peak_bytes = self.pool_bytes + int(unplanned.max())
+
+        # Allocate the pool and precompute the view of every tensor
+        pool = [np.empty(size, dtype=self.dtype) for size in self.buffer_sizes]
+        self.buffers = {}
+        for name, shape, _, planned, _, _ in tensors:
+            if planned:
+                flat = pool[self.assignment[name]]
+                self.buffers[name] = flat[:int(np.prod(shape))].reshape(shape)
+
+
+    def buffers_for(self, batch_size):
+        """
+        Returns the buffer views for a pass with the given batch size, or an
+        empty dictionary if the plan was made for a different batch size.
+        """
+        if batch_size != self.batch_size:
+            return {}
+        return self.buffers
+
+
+    def report(self):
+        """
+        Returns a human readable summary of the plan.
+        """
+        mb = 1024.0 ** 2
+        lines = [
+          'Memory plan for batch size %d (%s)' % (self.batch_size, self.dtype),
+          '  %d planned tensors in %d buffers' % (len(self.assignment),
+                                                  len(self.buffer_sizes)),
+          '  without reuse:      %8.2f MB' % (self.naive_bytes / mb),
+          '  liveness minimum:   %8.2f MB' % (self.min_bytes / mb),
+          '  planned peak:       %8.2f MB' % (self.peak_bytes / mb),
+        ]
+        for j, size in enumerate(self.buffer_sizes):
+            names = [name for name in self.assignment
+                     if self.assignment[name] == j]
+            lines.append('  buffer %d (%.2f MB): %s' % (
+                         j, size * self.dtype.itemsize / mb, ', '.join(names)))
+        return '\n'.join(lines)
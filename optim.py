@@ -1,3 +1,4 @@
+import math
 import numpy as np
 
 """
@@ -27,6 +28,12 @@ work well for a variety of different problems.
 
 For efficiency, update rules may perform in-place updates, mutating w and
 setting next_w equal to w.
+
+The *_fused variants of sgd_momentum, rmsprop and adam do so: they update w
+and their state arrays in place with out= ufuncs and keep their temporaries
+in one shared scratch buffer, so after the first call a step allocates no
+arrays at all. Combined with the Solver's flat_params option they update all
+parameters of a model with a single call.
 """
 
 
@@ -173,3 +180,231 @@ def adam(w, dw, config=None):
     ###########################################################################
 
     return next_w, config
+
+
+# Scratch space of the fused update rules, one growing buffer per dtype
+_scratch_buffers = {}
+
+
+def _scratch(w):
+    """
+    Returns an uninitialized array shaped like w, backed by a buffer that is
+    shared by all calls of the fused update rules.
+    """
+    buf = _scratch_buffers.get(w.dtype)
+    if buf is None or buf.size < w.size:
+        buf = _scratch_buffers[w.dtype] = np.empty(w.size, dtype=w.dtype)
+    return buf[:w.size].reshape(w.shape)
+
+
+def sgd_momentum_fused(w, dw, config=None):
+    """
+    Same as sgd_momentum, but updates w and the velocity in place without
+    allocating any arrays after the first call.
+
+    config format: Same as sgd_momentum.
+    """
+    if config is None: config = {}
+    config.setdefault('learning_rate', 1e-2)
+    config.setdefault('momentum', 0.9)
+    v = config.get('velocity')
+    if v is None:
+        v = config['velocity'] = np.zeros_like(w)
+
+    tmp = _scratch(w)
+    v *= config['momentum']
+    np.multiply(dw, config['learning_rate'], out=tmp)
+    v -= tmp
+    w += v
+    return w, config
+
+
+def rmsprop_fused(w, dw, config=None):
+    """
+    Same as rmsprop, but updates w and the cache in place without allocating
+    any arrays after the first call.
+
+    config format: Same as rmsprop.
+    """
+    if config is None: config = {}
+    config.setdefault('learning_rate', 1e-2)
+    config.setdefault('decay_rate', 0.99)
+    config.setdefault('epsilon', 1e-8)
+    cache = config.get('cache')
+    if cache is None:
+        cache = config['cache'] = np.zeros_like(w)
+
+    decay_rate = config['decay_rate']
+    tmp = _scratch(w)
+    cache *= decay_rate
+    np.multiply(dw, dw, out=tmp)
+    tmp *= 1 - decay_rate
+    cache += tmp
+    np.sqrt(cache, out=tmp)
+    tmp += config['epsilon']
+    np.divide(dw, tmp, out=tmp)
+    tmp *= config['learning_rate']
+    w -= tmp
+    return w, config
+
+
+def adam_fused(w, dw, config=None):
+    """
+    Same as adam, but updates w, m and v in place without allocating any
+    arrays after the first call. The bias corrections are folded into the
+    scalars, using
+
+    lr * mt / (sqrt(vt) + eps) = lr_t * m / (sqrt(v) + eps_t)
+
+    with lr_t = lr * sqrt(1 - beta2**t) / (1 - beta1**t) and
+    eps_t = eps * sqrt(1 - beta2**t).
+
+    config format: Same as adam.
+    """
+    if config is None: config = {}
+    config.setdefault('learning_rate', 1e-3)
+    config.setdefault('beta1', 0.9)
+    config.setdefault('beta2', 0.999)
+    config.setdefault('epsilon', 1e-8)
+    config.setdefault('t', 0)
+    m, v = config.get('m'), config.get('v')
+    if m is None:
+        m = config['m'] = np.zeros_like(w)
+    if v is None:
+        v = config['v'] = np.zeros_like(w)
+
+    beta1, beta2 = config['beta1'], config['beta2']
+    config['t'] += 1
+    t = config['t']
+    correction2 = math.sqrt(1 - beta2 ** t)
+    lr_t = float(config['learning_rate']) * correction2 / (1 - beta1 ** t)
+    eps_t = config['epsilon'] * correction2
+
+    tmp = _scratch(w)
+    m *= beta1
+    np.multiply(dw, 1 - beta1, out=tmp)
+    m += tmp
+    v *= beta2
+    np.multiply(dw, dw, out=tmp)
+    tmp *= 1 - beta2
+    v += tmp
+    np.sqrt(v, out=tmp)
+    tmp += eps_t
+    np.divide(m, tmp, out=tmp)
+    tmp *= lr_t
+    w -= tmp
+    return w, config
+
+
+def _layer_norms(x, segments):
+    """
+    L2 norm of x, or of each segment of the 1-D array x starting at the
+    offsets in segments.
+    """
+    if segments is None:
+        flat = x.ravel()
+        return np.sqrt(np.dot(flat, flat))
+    return np.sqrt(np.add.reduceat(x * x, segments))
+
+
+def _trust_ratio(w_norm, update_norm, segments, size, eta=1.0):
+    """
+    eta times the ratio of the weight norm to the update norm of every layer,
+    or 1 (without eta) for layers where either norm is zero, such as
+    zero-initialized biases; broadcastable against the weights.
+    """
+    ratio = np.where((w_norm > 0) & (update_norm > 0),
+                     eta * w_norm / np.maximum(update_norm, 1e-30), 1.0)
+    if segments is None:
+        return float(ratio)
+    counts = np.diff(np.append(segments, size))
+    return np.repeat(ratio, counts)
+
+
+def lars(w, dw, config=None):
+    """
+    Layer-wise Adaptive Rate Scaling (You et al., 2017): SGD with momentum
+    where the step of every layer is scaled by a trust ratio
+    trust_coefficient * ||w|| / ||dw + weight_decay * w||, so that no layer
+    takes steps that are large relative to its weights. This keeps training
+    stable with very large batches and learning rates. Layers where either
+    norm is zero (e.g. zero-initialized biases) use a trust ratio of 1, so
+    they take plain SGD steps until their weights are nonzero.
+
+    config format:
+    - learning_rate: Scalar learning rate.
+    - momentum: Scalar between 0 and 1 giving the momentum value.
+    - weight_decay: Scalar L2 weight decay applied by the optimizer (in
+      addition to any regularization of the model).
+    - trust_coefficient: Scalar eta scaling the trust ratio.
+    - velocity: A numpy array of the same shape as w storing the momentum.
+    - segments: Optional array of the start offsets of the layers when w is
+      the 1-D buffer of several layers (the Solver sets it with
+      flat_params=True); the trust ratios of all layers are then computed
+      with one vectorized reduction.
+    """
+    if config is None: config = {}
+    config.setdefault('learning_rate', 1e-2)
+    config.setdefault('momentum', 0.9)
+    config.setdefault('weight_decay', 0.0)
+    config.setdefault('trust_coefficient', 1e-3)
+    v = config.get('velocity')
+    if v is None:
+        v = config['velocity'] = np.zeros_like(w)
+    segments = config.get('segments')
+
+    update = dw + config['weight_decay'] * w
+    trust = _trust_ratio(_layer_norms(w, segments),
+                         _layer_norms(update, segments), segments, w.size,
+                         config['trust_coefficient'])
+    update *= trust
+    update *= config['learning_rate']
+    v *= config['momentum']
+    v += update
+    w -= v
+    return w, config
+
+
+def lamb(w, dw, config=None):
+    """
+    Layer-wise Adaptive Moments (You et al., 2019): Adam whose step of every
+    layer, including the decoupled weight decay, is rescaled to have the norm
+    of the weights of the layer, ||w|| / ||adam step + weight_decay * w||.
+
+    config format:
+    - learning_rate, beta1, beta2, epsilon, m, v, t: Same as adam.
+    - weight_decay: Scalar decoupled weight decay.
+    - segments: Same as lars.
+    """
+    if config is None: config = {}
+    config.setdefault('learning_rate', 1e-3)
+    config.setdefault('beta1', 0.9)
+    config.setdefault('beta2', 0.999)
+    config.setdefault('epsilon', 1e-6)
+    config.setdefault('weight_decay', 0.0)
+    config.setdefault('t', 0)
+    m, v = config.get('m'), config.get('v')
+    if m is None:
+        m = config['m'] = np.zeros_like(w)
+    if v is None:
+        v = config['v'] = np.zeros_like(w)
+    segments = config.get('segments')
+
+    beta1, beta2 = config['beta1'], config['beta2']
+    config['t'] += 1
+    t = config['t']
+    m *= beta1
+    m += (1 - beta1) * dw
+    v *= beta2
+    v += (1 - beta2) * (dw * dw)
+    update = np.sqrt(v / (1 - beta2 ** t))
+    update += config['epsilon']
+    np.divide(m / (1 - beta1 ** t), update, out=update)
+    update += config['weight_decay'] * w
+
+    trust = _trust_ratio(_layer_norms(w, segments),
+                         _layer_norms(update, segments), segments, w.size)
+    update *= trust
+    update *= config['learning_rate']
+    w -= update
+    return w, config
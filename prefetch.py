@@ -0,0 +1,150 @@
+from __future__ import division
+from future import standard_library
+standard_library.install_aliases()
+from builtins import range
+from builtins import object
+import queue
+import threading
+import numpy as np
+
+"""
+This file implements a background minibatch prefetcher.
+
+Building a minibatch (sampling indices, gathering the rows of X_train,
+casting them to the model dtype and augmenting them) is cheap next to a
+training step, but on the training thread it still sits on the critical
+path of every step. A BatchPrefetcher builds the next batches in a worker
+thread while the training thread computes, into a small ring of
+preallocated slots: with depth=1 there are two slots, one that the current
+step reads and one that the worker fills (double buffering); with depth=k
+the worker can run up to k batches ahead. Gathers and casts write straight
+into the slots with out= arguments, and numpy releases the GIL while it
+copies, so batch construction overlaps with the forward and backward passes.
+
+The worker draws its indices from its own random generators (or from a
+sampler object, see sampler.py) so that it does not race with the training
+thread for the global numpy random state. The indices of batch b are drawn
+from a generator seeded with (seed, b), so a prefetcher can be restarted at
+any batch of a stream.
+
+A batch returned by next() is a view of a slot and stays valid until the
+following call of next(), when its slot is handed back to the worker.
+"""
+
+
+class BatchPrefetcher(object):
+    """
+    Builds minibatches of (X, y) in a background thread.
+    """
+
+    def __init__(self, X, y, batch_size, depth=1, dtype=None, augment_fn=None,
+                 sampler=None, seed=None, batch=0):
+        """
+        Inputs:
+        - X, y: Training data and labels
+        - batch_size: Number of examples per batch
+        - depth: Number of batches the worker may build ahead of the batch in
+          use; depth + 1 slots are allocated
+        - dtype: dtype of the X batches; default is the dtype of X
+        - augment_fn: Optional function augment_fn(X_batch, y_batch) that
+          modifies a batch in place, called in the worker thread
+        - sampler: Optional object whose next_indices() returns the indices
+          of the next batch, such as an EpochSampler; by default indices are
+          drawn with replacement like the Solver does
+        - seed: Integer seed of the default sampling; drawn from np.random if
+          None
+        - batch: Number of the first batch of the default sampling
+        """
+        if depth < 1:
+            raise ValueError('Invalid prefetch depth %d' % depth)
+        self.X = X
+        self.y = y
+        self.batch_size = batch_size
+        self.augment_fn = augment_fn
+        self.sampler = sampler
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        self.seed = seed
+        self.batch = batch
+        dtype = X.dtype if dtype is None else np.dtype(dtype)
+
+        num_slots = depth + 1
+        self._X_slots = [np.empty((batch_size,) + X.shape[1:], dtype=dtype)
+                         for _ in range(num_slots)]
+        self._y_slots = [np.empty(batch_size, dtype=y.dtype)
+                         for _ in range(num_slots)]
+        # Gathering into a slot of another dtype goes through a staging array
+        self._stage = None
+        if dtype != X.dtype:
+            self._stage = np.empty((batch_size,) + X.shape[1:], dtype=X.dtype)
+
+        self._free = queue.Queue()
+        self._ready = queue.Queue()
+        for slot in range(num_slots):
+            self._free.put(slot)
+        self._current = None
+        self._stopped = False
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def _indices(self):
+        if self.sampler is not None:
+            return self.sampler.next_indices()
+        rng = np.random.RandomState([self.seed, self.batch])
+        self.batch += 1
+        return rng.randint(self.X.shape[0], size=self.batch_size)
+
+
+    def _work(self):
+        """
+        Worker thread: fill free slots until close() is called.
+        """
+        while True:
+            slot = self._free.get()
+            if self._stopped:
+                return
+            try:
+                idx = self._indices()
+                X_batch = self._X_slots[slot][:len(idx)]
+                y_batch = self._y_slots[slot][:len(idx)]
+                if self._stage is None:
+                    np.take(self.X, idx, axis=0, out=X_batch, mode='clip')
+                else:
+                    stage = self._stage[:len(idx)]
+                    np.take(self.X, idx, axis=0, out=stage, mode='clip')
+                    np.copyto(X_batch, stage, casting='unsafe')
+                np.take(self.y, idx, out=y_batch, mode='clip')
+                if self.augment_fn is not None:
+                    self.augment_fn(X_batch, y_batch)
+            except Exception as e:
+                self._ready.put((None, e))
+                return
+            self._ready.put((slot, (X_batch, y_batch)))
+
+
+    def next(self):
+        """
+        Returns the next batch as a tuple (X_batch, y_batch) of views that
+        stay valid until the next call.
+        """
+        if self._current is not None:
+            self._free.put(self._current)
+            self._current = None
+        slot, batch = self._ready.get()
+        if slot is None:
+            raise batch
+        self._current = slot
+        return batch
+
+
+    def close(self):
+        """
+        Stop the worker thread.
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        self._free.put(None)
+        self._thread.join()
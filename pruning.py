@@ -0,0 +1,302 @@
+from __future__ import division
+from builtins import range
+from builtins import object
+import numpy as np
+
+from cs231n.classifiers.cnn import ThreeLayerConvNet, DeepConvNet
+
+"""
+This file implements structured pruning of the filters of conv layers.
+
+Pruning a filter of a conv layer removes its row of the conv weights, its
+bias, its batchnorm scale, shift and running statistics, and the input
+channel of the next conv layer it feeds (or, for the last conv layer, the
+rows of the next affine layer that read its flattened output). All arrays
+are replaced by physically smaller copies, so the pruned model is an
+ordinary model of the same class with fewer filters: its im2col matrices,
+GEMMs and activations shrink with the number of filters, and it trains,
+predicts and quantizes like any other model.
+
+Filters are ranked within each conv layer by one of two scores:
+- 'magnitude': the L1 norm of the filter, or |gamma| for conv layers
+  followed by batchnorm, whose normalization undoes the scale of the filter;
+- 'gradient': the first-order Taylor estimate of the change in the loss if
+  the filter were removed, (sum of w * dw over the parameters of the
+  filter)^2, averaged over a few training minibatches.
+
+prune_model() removes a fraction of the filters of every conv layer once. A
+PruneSchedule passed to the Solver with prune_schedule= prunes at the end of
+chosen epochs and leaves the epochs in between to fine-tune; the Solver
+prunes the optimizer state (momentum, Adam moments) along with the model.
+
+Every pruning step returns a list of slices (key, axis, index): the array
+stored under key is replaced by its entries at index along axis. Applying
+the slices in order with prune_arrays() keeps any other dictionary of arrays
+keyed like model.params in sync with the model.
+"""
+
+
+def _three_layer_conv_net_convs(model):
+    C, H, W = model.input_dim
+    return [('W1', 'b1', None, None, None, 'W2', H * W)]
+
+
+def _deep_conv_net_convs(model):
+    convs = []
+    next_keys = [block[0] for block in model._blocks[1:]]
+    next_keys.append(model._affine_keys[0][0])
+    C, H, W = model.input_dim
+    for (w_key, b_key, conv_param, gamma_key, beta_key, bn_param, pool_forward,
+         _, pool_param), next_key in zip(model._blocks, next_keys):
+        HH = model.params[w_key].shape[2]
+        stride, pad = conv_param['stride'], conv_param['pad']
+        H = (H + 2 * pad - HH) // stride + 1
+        W = (W + 2 * pad - HH) // stride + 1
+        convs.append((w_key, b_key, gamma_key, beta_key, bn_param, next_key,
+                      H * W))
+        if pool_forward is not None:
+            pool, pool_stride = pool_param['pool_height'], pool_param['stride']
+            H = (H - pool) // pool_stride + 1
+            W = (W - pool) // pool_stride + 1
+    return convs
+
+
+_CONV_BUILDERS = [
+  (ThreeLayerConvNet, _three_layer_conv_net_convs),
+  (DeepConvNet, _deep_conv_net_convs),
+]
+
+
+def _conv_layers(model):
+    """
+    Returns a list with one tuple (W key, b key, gamma key, beta key,
+    bn_param, key of the next weights, output pixels) per conv layer.
+    """
+    for cls, build_convs in _CONV_BUILDERS:
+        if type(model) is cls:
+            return build_convs(model)
+    raise ValueError('Cannot prune %s' % type(model).__name__)
+
+
+def conv_flops(model):
+    """
+    Returns a dictionary mapping the weight name of every conv layer to the
+    multiply-adds of its GEMM per example.
+    """
+    flops = {}
+    for w_key, _, _, _, _, _, out_size in _conv_layers(model):
+        F, C, HH, WW = model.params[w_key].shape
+        flops[w_key] = F * C * HH * WW * out_size
+    return flops
+
+
+def prune_arrays(arrays, slices):
+    """
+    Apply pruning slices to a dictionary of arrays keyed like model.params.
+    Keys that are missing from arrays are skipped.
+    """
+    for key, axis, index in slices:
+        if key in arrays:
+            arrays[key] = np.take(arrays[key], index, axis=axis)
+
+
+def prune_optim_configs(configs, slices):
+    """
+    Apply pruning slices to the optimizer state of a Solver: every array in
+    the config dictionary of a pruned parameter is sliced like the parameter.
+    """
+    for key, axis, index in slices:
+        config = configs.get(key, {})
+        for k, v in config.items():
+            if isinstance(v, np.ndarray) and v.ndim > axis:
+                config[k] = np.take(v, index, axis=axis)
+
+
+def prune_filters(model, w_key, keep):
+    """
+    Remove filters from a conv layer of a model.
+
+    Inputs:
+    - model: A ThreeLayerConvNet or DeepConvNet; modified in place
+    - w_key: Weight name of the conv layer, e.g. 'W1'
+    - keep: Indices of the filters to keep
+
+    Returns:
+    - slices: List of (key, axis, index) slices applied to model.params
+    """
+    convs = {conv[0]: conv for conv in _conv_layers(model)}
+    if w_key not in convs:
+        raise ValueError('%s is not the weight of a conv layer' % w_key)
+    _, b_key, gamma_key, beta_key, bn_param, next_key, _ = convs[w_key]
+    keep = np.sort(np.asarray(keep, dtype=np.int64))
+    if keep.size == 0:
+        raise ValueError('Cannot remove every filter of %s' % w_key)
+    F = model.params[w_key].shape[0]
+
+    slices = [(w_key, 0, keep), (b_key, 0, keep)]
+    if gamma_key is not None:
+        slices += [(gamma_key, 0, keep), (beta_key, 0, keep)]
+        for k in ('running_mean', 'running_var'):
+            if k in bn_param:
+                bn_param[k] = bn_param[k][keep]
+
+    w_next = model.params[next_key]
+    if w_next.ndim == 4:
+        slices.append((next_key, 1, keep))
+    else:
+        # The affine layer reads the flattened (F, H, W) output of the conv
+        # layer, so every filter owns H * W consecutive rows
+        pixels = w_next.shape[0] // F
+        rows = (keep[:, None] * pixels + np.arange(pixels)).ravel()
+        slices.append((next_key, 0, rows))
+
+    prune_arrays(model.params, slices)
+    return slices
+
+
+def filter_scores(model, method='magnitude', X=None, y=None, batch_size=100):
+    """
+    Score the filters of every conv layer of a model; low scores are pruned
+    first.
+
+    Inputs:
+    - model: A ThreeLayerConvNet or DeepConvNet
+    - method: 'magnitude' or 'gradient'
+    - X, y: Training data to estimate the 'gradient' scores on
+    - batch_size: Minibatch size for the 'gradient' scores
+
+    Returns:
+    - scores: Dictionary mapping the weight name of every conv layer to an
+      array of shape (F,) of filter scores
+    """
+    convs = _conv_layers(model)
+    params = model.params
+    if method == 'magnitude':
+        scores = {}
+        for w_key, _, gamma_key, _, _, _, _ in convs:
+            if gamma_key is not None:
+                scores[w_key] = np.abs(params[gamma_key]).astype(np.float64)
+            else:
+                w = params[w_key]
+                scores[w_key] = np.sum(np.abs(w.reshape(w.shape[0], -1)),
+                                       axis=1, dtype=np.float64)
+        return scores
+
+    if method != 'gradient':
+        raise ValueError('Invalid method "%s"' % method)
+    if X is None or y is None:
+        raise ValueError('Gradient scores need training data')
+
+    # Training passes must not update the batchnorm running averages
+    bn_params = getattr(model, 'bn_params', [])
+    running = [dict(p) for p in bn_params]
+    scores = {conv[0]: 0.0 for conv in convs}
+    num_batches = 0
+    for start in range(0, X.shape[0], batch_size):
+        _, grads = model.loss(X[start:start + batch_size],
+                              y[start:start + batch_size])
+        for conv in convs:
+            w_key = conv[0]
+            F = params[w_key].shape[0]
+            taylor = np.zeros(F)
+            for key in conv[:4]:
+                if key is not None:
+                    taylor += np.sum((params[key] * grads[key]).reshape(F, -1),
+                                     axis=1)
+            scores[w_key] = scores[w_key] + taylor ** 2
+        num_batches += 1
+    for p, saved in zip(bn_params, running):
+        p.clear()
+        p.update(saved)
+    return {k: v / num_batches for k, v in scores.items()}
+
+
+def prune_model(model, amount, method='magnitude', layers=None, X=None,
+                y=None, min_filters=1, batch_size=100):
+    """
+    Remove the lowest scoring fraction of the filters of conv layers.
+
+    Inputs:
+    - model: A ThreeLayerConvNet or DeepConvNet; modified in place
+    - amount: Fraction of the filters of each layer to remove
+    - method: Filter score, 'magnitude' or 'gradient' (see filter_scores)
+    - layers: Weight names of the conv layers to prune; default is all
+    - X, y: Training data for the 'gradient' scores
+    - min_filters: Never leave fewer filters than this in a layer
+    - batch_size: Minibatch size for the 'gradient' scores
+
+    Returns:
+    - slices: List of (key, axis, index) slices applied to model.params
+    """
+    scores = filter_scores(model, method, X, y, batch_size)
+    if layers is None:
+        layers = [conv[0] for conv in _conv_layers(model)]
+    slices = []
+    for w_key in layers:
+        F = model.params[w_key].shape[0]
+        num_pruned = min(int(round(amount * F)), F - max(min_filters, 1))
+        if num_pruned <= 0:
+            continue
+        keep = np.argsort(scores[w_key], kind='stable')[num_pruned:]
+        slices += prune_filters(model, w_key, keep)
+    return slices
+
+
+class PruneSchedule(object):
+    """
+    Iterative prune-and-finetune schedule for the Solver.
+
+    At the end of each pruning epoch the Solver calls step(), which removes
+    a fraction of the remaining filters of the conv layers; the epochs in
+    between fine-tune the smaller model.
+
+    Attributes:
+    - history: List of (epoch, filters, flops) tuples, one per pruning step,
+      where filters maps the weight names of the conv layers to their number
+      of filters and flops is the total conv GEMM multiply-adds per example
+    """
+
+    def __init__(self, amount, epochs=None, method='magnitude', layers=None,
+                 min_filters=1, num_samples=1000, batch_size=100):
+        """
+        Inputs:
+        - amount: Fraction of the remaining filters of each layer to remove
+          at every pruning step
+        - epochs: Epoch numbers (counted from 1) after which to prune;
+          default is every epoch
+        - method, layers, min_filters, batch_size: See prune_model
+        - num_samples: Number of training examples to compute 'gradient'
+          scores on
+        """
+        self.amount = amount
+        self.epochs = None if epochs is None else set(epochs)
+        self.method = method
+        self.layers = layers
+        self.min_filters = min_filters
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.history = []
+
+
+    def step(self, solver):
+        """
+        Prune solver.model if the epoch that just ended is a pruning epoch.
+
+        Returns:
+        - slices: The slices applied to the model parameters, which the
+          Solver applies to its own state
+        """
+        if self.epochs is not None and solver.epoch not in self.epochs:
+            return []
+        X = y = None
+        if self.method == 'gradient':
+            mask = np.random.choice(solver.X_train.shape[0], self.num_samples)
+            X, y = solver.X_train[mask], solver.y_train[mask]
+        model = solver.model
+        slices = prune_model(model, self.amount, self.method, self.layers,
+                             X, y, self.min_filters, self.batch_size)
+        filters = {conv[0]: model.params[conv[0]].shape[0]
+                   for conv in _conv_layers(model)}
+        self.history.append((solver.epoch, filters,
+                             sum(conv_flops(model).values())))
+        return slices
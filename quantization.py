@@ -0,0 +1,383 @@
+from __future__ import division
+from builtins import range
+from builtins import object
+import time
+import numpy as np
+
+from cs231n.layers import *
+from cs231n.fast_layers import *
+from cs231n.inference import Predictor
+from cs231n.classifiers.fc_net import FullyConnectedNet
+from cs231n.classifiers.cnn import ThreeLayerConvNet
+
+"""
+This file implements post-training int8 quantization for inference.
+
+quantize_model(model, X_val) turns a trained FullyConnectedNet or
+ThreeLayerConvNet into a QuantizedModel:
+
+- conv and affine weights are stored as int8 with one float scale per output
+  channel (symmetric, w ~= w_q * w_scale[c]); batchnorm layers are folded into
+  the affine layer before them first;
+- the input of every conv and affine layer is quantized to int8 with one
+  scale per layer, calibrated on a sample of X_val;
+- conv and affine layers multiply int8 matrices with int32 accumulation and
+  dequantize the result to float32 for the bias, ReLU, pooling and layer
+  normalization, which stay in floating point.
+
+The int8 weights take a quarter of the memory of float32 weights.
+
+numpy has no int8 matrix multiply of its own (np.dot on integer arrays does
+not use BLAS), so int8_matmul splits the inner dimension into blocks of at
+most 1024 and multiplies each block as float32. Every product of two int8
+values is at most 127 * 127 and 1024 of them sum to less than 2**24, so the
+float32 BLAS result of each block is exact and the blocks are summed in int32.
+"""
+
+
+# Largest block of the inner dimension whose float32 dot product of int8
+# values is exact: 1024 * 127 * 127 < 2 ** 24
+_EXACT_BLOCK = 1024
+
+
+def quantize_per_channel(w, axis):
+    """
+    Symmetric int8 quantization of w with one scale per index along axis.
+
+    Inputs:
+    - w: Float array of weights
+    - axis: Axis of the output channels (1 for affine weights of shape
+      (D, M), 0 for conv weights of shape (F, C, HH, WW))
+
+    Returns a tuple of:
+    - w_q: int8 array of the shape of w
+    - scale: float32 array of shape (w.shape[axis],)
+    """
+    other = tuple(i for i in range(w.ndim) if i != axis)
+    w_max = np.max(np.abs(w), axis=other)
+    scale = np.where(w_max > 0, w_max / 127.0, 1.0).astype(np.float32)
+    shape = [1] * w.ndim
+    shape[axis] = -1
+    w_q = np.rint(w / scale.reshape(shape)).astype(np.int8)
+    return w_q, scale
+
+
+def quantize_tensor(x, scale):
+    """
+    Symmetric int8 quantization of x with a single scale.
+    """
+    x_q = np.multiply(x, np.float32(1.0 / scale), dtype=np.float32)
+    np.rint(x_q, out=x_q)
+    np.clip(x_q, -127, 127, out=x_q)
+    return x_q.astype(np.int8)
+
+
+def int8_matmul(a_q, b_q):
+    """
+    Matrix product of int8 matrices with int32 accumulation.
+
+    Inputs:
+    - a_q: int8 array of shape (M, K)
+    - b_q: int8 array of shape (K, P)
+
+    Returns:
+    - out: int32 array of shape (M, P), exactly a_q.dot(b_q) in integers
+    """
+    K = a_q.shape[1]
+    if K <= _EXACT_BLOCK:
+        return np.dot(a_q.astype(np.float32), b_q.astype(np.float32)
+                      ).astype(np.int32)
+    out = np.zeros((a_q.shape[0], b_q.shape[1]), dtype=np.int32)
+    for k in range(0, K, _EXACT_BLOCK):
+        a = a_q[:, k:k + _EXACT_BLOCK].astype(np.float32)
+        b = b_q[k:k + _EXACT_BLOCK].astype(np.float32)
+        out += np.dot(a, b).astype(np.int32)
+    return out
+
+
+def affine_forward_int8(x, w_q, w_scale, b, x_scale):
+    """
+    Quantized forward pass for an affine layer.
+
+    Inputs:
+    - x: Float input of shape (N, d_1, ..., d_k)
+    - w_q, w_scale: Weights from quantize_per_channel(w, axis=1)
+    - b: Float biases of shape (M,)
+    - x_scale: Quantization scale of the input
+
+    Returns:
+    - out: float32 output of shape (N, M)
+    """
+    x_q = quantize_tensor(x.reshape(x.shape[0], -1), x_scale)
+    acc = int8_matmul(x_q, w_q)
+    out = np.multiply(acc, x_scale * w_scale, dtype=np.float32)
+    out += b
+    return out
+
+
+def conv_forward_int8(x, w_q, w_scale, b, conv_param, x_scale):
+    """
+    Quantized forward pass for a convolutional layer, using the same
+    stride-trick im2col as conv_forward_strides on the int8 input.
+
+    Inputs:
+    - x: Float input of shape (N, C, H, W)
+    - w_q, w_scale: Weights from quantize_per_channel(w, axis=0)
+    - b: Float biases of shape (F,)
+    - conv_param: Dictionary with the keys 'stride' and 'pad'
+    - x_scale: Quantization scale of the input
+
+    Returns:
+    - out: float32 output of shape (N, F, H', W')
+    """
+    N, C, H, W = x.shape
+    F, _, HH, WW = w_q.shape
+    stride, pad = conv_param['stride'], conv_param['pad']
+
+    x_q = quantize_tensor(x, x_scale)
+    p = pad
+    x_padded = np.pad(x_q, ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
+    H += 2 * pad
+    W += 2 * pad
+    out_h = (H - HH) // stride + 1
+    out_w = (W - WW) // stride + 1
+
+    shape = (C, HH, WW, N, out_h, out_w)
+    strides = (H * W, W, 1, C * H * W, stride * W, stride)
+    strides = x_padded.itemsize * np.array(strides)
+    x_stride = np.lib.stride_tricks.as_strided(x_padded, shape=shape,
+                                               strides=strides)
+    x_cols = np.ascontiguousarray(x_stride)
+    x_cols.shape = (C * HH * WW, N * out_h * out_w)
+
+    acc = int8_matmul(w_q.reshape(F, -1), x_cols)
+    res = np.multiply(acc, (x_scale * w_scale).reshape(-1, 1),
+                      dtype=np.float32)
+    res += b.reshape(-1, 1)
+    res.shape = (F, N, out_h, out_w)
+    return np.ascontiguousarray(res.transpose(1, 0, 2, 3))
+
+
+def _fold_batchnorm(w, b, gamma, beta, bn_param):
+    # Same arithmetic as the test-time branch of batchnorm_forward
+    eps = bn_param.get('eps', 1e-5)
+    D = gamma.shape[0]
+    running_mean = bn_param.get('running_mean', np.zeros(D))
+    running_var = bn_param.get('running_var', np.zeros(D))
+    scale = gamma / (np.sqrt(running_var) + eps)
+    return w * scale, b * scale + beta - running_mean * scale
+
+
+def _fc_net_layers(model):
+    params = model.params
+    layers = []
+    for i in range(1, model.num_layers):
+        w, b = params['W%d' % i], params['b%d' % i]
+        if model.normalization == 'batchnorm':
+            w, b = _fold_batchnorm(w, b, params['gamma%d' % i],
+                                   params['beta%d' % i], model.bn_params[i - 1])
+        layers.append(['affine', w, b])
+        if model.normalization == 'layernorm':
+            layers.append(['layernorm', params['gamma%d' % i],
+                           params['beta%d' % i], model.ln_params[i - 1]])
+        layers.append(['relu'])
+    L = model.num_layers
+    layers.append(['affine', params['W%d' % L], params['b%d' % L]])
+    return layers
+
+
+def _three_layer_conv_net_layers(model):
+    params = model.params
+    filter_size = params['W1'].shape[2]
+    conv_param = {'stride': 1, 'pad': (filter_size - 1) // 2}
+    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+    return [['conv', params['W1'], params['b1'], conv_param],
+            ['pool', pool_param],
+            ['affine', params['W2'], params['b2']], ['relu'],
+            ['affine', params['W3'], params['b3']]]
+
+
+_LAYER_BUILDERS = [
+  (FullyConnectedNet, _fc_net_layers),
+  (ThreeLayerConvNet, _three_layer_conv_net_layers),
+]
+
+
+def _float_forward(layer, x):
+    kind = layer[0]
+    if kind == 'affine':
+        return affine_forward(x, layer[1], layer[2])[0]
+    elif kind == 'conv':
+        return conv_forward_strides(x, layer[1], layer[2], layer[3])[0]
+    elif kind == 'relu':
+        return np.maximum(x, 0)
+    elif kind == 'pool':
+        return max_pool_forward_fast(x, layer[1])[0]
+    elif kind == 'layernorm':
+        return layernorm_forward(x, layer[1], layer[2], layer[3])[0]
+
+
+class QuantizedModel(object):
+    """
+    An int8 version of a trained model for inference; see quantize_model.
+
+    Attributes:
+    - layers: List of layers; quantized layers are tuples
+      ('qaffine', w_q, w_scale, b, x_scale) and
+      ('qconv', w_q, w_scale, b, conv_param, x_scale)
+    - batch_size: Number of examples run through the network at once
+    """
+
+    def __init__(self, layers, batch_size=1000):
+        self.layers = layers
+        self.batch_size = batch_size
+
+
+    @property
+    def nbytes(self):
+        """
+        Bytes taken by the weights, biases and scales.
+        """
+        total = 0
+        for layer in self.layers:
+            total += sum(v.nbytes for v in layer[1:]
+                         if isinstance(v, np.ndarray))
+        return total
+
+
+    def _forward(self, x):
+        for layer in self.layers:
+            kind = layer[0]
+            if kind == 'qaffine':
+                x = affine_forward_int8(x, *layer[1:])
+            elif kind == 'qconv':
+                x = conv_forward_int8(x, *layer[1:])
+            elif kind == 'relu':
+                np.maximum(x, 0, out=x)
+            else:
+                x = _float_forward(layer, x)
+        return x
+
+
+    def scores(self, X):
+        """
+        Compute classification scores for X.
+
+        Inputs:
+        - X: Array of input data of shape (N, d_1, ..., d_k)
+
+        Returns:
+        - scores: float32 array of shape (N, C)
+        """
+        scores = [self._forward(X[start:start + self.batch_size])
+                  for start in range(0, X.shape[0], self.batch_size)]
+        return np.concatenate(scores)
+
+
+    def predict(self, X):
+        """
+        Predict labels for X; returns an array of shape (N,).
+        """
+        return np.argmax(self.scores(X), axis=1)
+
+
+def quantize_model(model, X_calib, num_samples=1000, percentile=100.0,
+                   batch_size=1000):
+    """
+    Post-training int8 quantization of a trained model.
+
+    Inputs:
+    - model: A trained FullyConnectedNet or ThreeLayerConvNet
+    - X_calib: Calibration data, usually X_val
+    - num_samples: Number of examples of X_calib to calibrate on
+    - percentile: The input scale of each layer maps this percentile of the
+      absolute values of its input to 127; lower values than 100 clip
+      outliers for a finer resolution of the bulk of the values
+    - batch_size: Batch size for calibration and for the quantized model
+
+    Returns:
+    - qmodel: A QuantizedModel
+    """
+    build_layers = None
+    for cls, builder in _LAYER_BUILDERS:
+        if type(model) is cls:
+            build_layers = builder
+    if build_layers is None:
+        raise ValueError('Cannot quantize %s' % type(model).__name__)
+    layers = build_layers(model)
+
+    # Run the float network over the calibration sample and record the
+    # range of the input of every conv and affine layer
+    X_calib = X_calib[:num_samples]
+    ranges = [0.0] * len(layers)
+    for start in range(0, X_calib.shape[0], batch_size):
+        x = X_calib[start:start + batch_size].astype(np.float32)
+        for i, layer in enumerate(layers):
+            if layer[0] in ('affine', 'conv'):
+                x_range = np.percentile(np.abs(x), percentile)
+                ranges[i] = max(ranges[i], x_range)
+            x = _float_forward(layer, x)
+
+    qlayers = []
+    for layer, x_range in zip(layers, ranges):
+        x_scale = x_range / 127.0 if x_range > 0 else 1.0
+        if layer[0] == 'affine':
+            w_q, w_scale = quantize_per_channel(layer[1], axis=1)
+            qlayers.append(('qaffine', w_q, w_scale,
+                            layer[2].astype(np.float32), x_scale))
+        elif layer[0] == 'conv':
+            w_q, w_scale = quantize_per_channel(layer[1], axis=0)
+            qlayers.append(('qconv', w_q, w_scale,
+                            layer[2].astype(np.float32), layer[3], x_scale))
+        else:
+            qlayers.append(tuple(layer))
+    return QuantizedModel(qlayers, batch_size=batch_size)
+
+
+class QuantizationReport(object):
+    """
+    Accuracy, size and speed of a quantized model against its float model.
+
+    Attributes:
+    - float_acc, int8_acc: Accuracy of both models on the given data
+    - agreement: Fraction of examples both models give the same label
+    - float_bytes, int8_bytes: Bytes of the parameters of both models
+    - float_time, int8_time: Seconds to predict the given data
+    """
+
+    def __init__(self, model, qmodel, X, y):
+        """
+        Inputs:
+        - model: The float model
+        - qmodel: The QuantizedModel made from it
+        - X, y: Evaluation data and labels, usually X_val and y_val
+        """
+        predictor = Predictor(model, batch_size=qmodel.batch_size)
+        tic = time.time()
+        float_pred = predictor.predict(X)
+        self.float_time = time.time() - tic
+        tic = time.time()
+        int8_pred = qmodel.predict(X)
+        self.int8_time = time.time() - tic
+
+        self.float_acc = np.mean(float_pred == y)
+        self.int8_acc = np.mean(int8_pred == y)
+        self.agreement = np.mean(float_pred == int8_pred)
+        self.float_bytes = sum(v.nbytes for v in model.params.values())
+        self.int8_bytes = qmodel.nbytes
+
+
+    def report(self):
+        """
+        Returns a human readable summary.
+        """
+        lines = [
+          '         accuracy    size (MB)   time (s)',
+          '  float  %8.4f  %10.3f  %9.3f' % (
+              self.float_acc, self.float_bytes / 1024.0 ** 2, self.float_time),
+          '  int8   %8.4f  %10.3f  %9.3f' % (
+              self.int8_acc, self.int8_bytes / 1024.0 ** 2, self.int8_time),
+          '  predictions agree on %.2f%% of the examples' % (
+              100 * self.agreement),
+        ]
+        return '\n'.join(lines)
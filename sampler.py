@@ -0,0 +1,139 @@
+from __future__ import division
+from builtins import object
+import numpy as np
+
+"""
+This file implements epoch-based sampling of training minibatches.
+
+By default the Solver draws every minibatch with replacement, so an epoch
+does not visit every example exactly once and every batch is a random
+gather from X_train. An EpochSampler instead permutes the training set once
+per epoch and serves consecutive batches of the permutation, so each epoch
+sees every example once (except the last num_train % batch_size examples of
+the permutation, which change from epoch to epoch).
+
+The mode says where the permutation is applied:
+- 'indices': X is left alone and every batch gathers its rows through the
+  permuted indices;
+- 'copy': at the start of every epoch X and y are gathered once into a
+  shuffled copy, and every batch is a contiguous slice (a view) of the copy;
+  this doubles the memory of the training set;
+- 'inplace': X and y themselves are shuffled in place at the start of every
+  epoch, and every batch is a contiguous slice of them; this needs no extra
+  memory but reorders the caller's arrays.
+
+The permutation of epoch e is drawn from a generator seeded with
+(seed, e), so the state of a sampler is just its seed and the number of
+batches it has served (plus the current order of X in 'inplace' mode), which
+makes it cheap to save and restore.
+"""
+
+
+class EpochSampler(object):
+    """
+    Serves the minibatches of a training set one epoch at a time.
+
+    Attributes:
+    - epoch: Number of epochs started so far
+    - batch: Number of batches served so far
+    - perm: Permutation of the current epoch ('indices' and 'copy' modes)
+    - order: Indices into the original X of the current rows of X
+      ('inplace' mode only)
+    """
+
+    def __init__(self, X, y, batch_size, mode='copy', seed=None, batch=0,
+                 order=None):
+        """
+        Inputs:
+        - X, y: Training data and labels
+        - batch_size: Number of examples per batch
+        - mode: 'indices', 'copy' or 'inplace'
+        - seed: Integer seed of the permutations; drawn from np.random if None
+        - batch, order: State to resume from; order is only used in 'inplace'
+          mode, where X and y must be given in their original order and are
+          reordered to it
+        """
+        if mode not in ('indices', 'copy', 'inplace'):
+            raise ValueError('Invalid sampler mode "%s"' % mode)
+        if batch_size > X.shape[0]:
+            raise ValueError('Batch size %d is larger than the training set'
+                             % batch_size)
+        self.X = X
+        self.y = y
+        self.batch_size = batch_size
+        self.mode = mode
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        self.seed = seed
+        self.batches_per_epoch = X.shape[0] // batch_size
+        self.batch = batch
+        self.epoch = 0
+        self.perm = None
+        self.order = None
+        self._X_src, self._y_src = X, y
+        if mode == 'copy':
+            self.X = np.empty_like(X)
+            self.y = np.empty_like(y)
+        if mode == 'inplace':
+            self.order = np.arange(X.shape[0])
+            if order is not None and batch > 0:
+                self.order = np.asarray(order)
+                self.X[...] = self.X[self.order]
+                self.y[...] = self.y[self.order]
+                self.epoch = (batch - 1) // self.batches_per_epoch + 1
+
+
+    def _start_epoch(self, epoch):
+        """
+        Shuffle for the epoch with the given (0-based) number.
+        """
+        n = self._X_src.shape[0]
+        rng = np.random.RandomState([self.seed, epoch])
+        if self.mode == 'inplace':
+            # Shuffling the rows of X and an index array with the same random
+            # state gives both the same permutation
+            state = rng.get_state()
+            rng.shuffle(self.X)
+            perm = np.arange(n)
+            rng.set_state(state)
+            rng.shuffle(perm)
+            self.y[...] = self.y[perm]
+            self.order = self.order[perm]
+        else:
+            self.perm = rng.permutation(n)
+            if self.mode == 'copy':
+                np.take(self._X_src, self.perm, axis=0, out=self.X, mode='clip')
+                np.take(self._y_src, self.perm, out=self.y, mode='clip')
+        self.epoch = epoch + 1
+
+
+    def _next_start(self):
+        epoch, position = divmod(self.batch, self.batches_per_epoch)
+        if self.epoch != epoch + 1:
+            self._start_epoch(epoch)
+        self.batch += 1
+        return position * self.batch_size
+
+
+    def next_indices(self):
+        """
+        Returns the indices into the original X of the next batch ('indices'
+        mode only, for use by a BatchPrefetcher).
+        """
+        if self.mode != 'indices':
+            raise ValueError('next_indices needs mode "indices"')
+        start = self._next_start()
+        return self.perm[start:start + self.batch_size]
+
+
+    def next_batch(self):
+        """
+        Returns the next batch as a tuple (X_batch, y_batch). In the 'copy'
+        and 'inplace' modes both are views of self.X and self.y.
+        """
+        start = self._next_start()
+        end = start + self.batch_size
+        if self.mode == 'indices':
+            idx = self.perm[start:end]
+            return self.X[idx], self.y[idx]
+        return self.X[start:end], self.y[start:end]
@@ -3,12 +3,23 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import range
 from builtins import object
-import os
-import pickle as pickle
-
 import numpy as np
 
 from cs231n import optim
+from cs231n.inference import can_predict
+from cs231n.flat_params import flatten_params
+from cs231n.pruning import prune_arrays, prune_optim_configs
+from cs231n.lr_schedules import StepDecay, LinearWarmup
+from cs231n.prefetch import BatchPrefetcher
+from cs231n.sampler import EpochSampler
+from cs231n.checkpoint import CheckpointWriter, load_checkpoint, ArrayHistory
+from cs231n.evaluation import Evaluator
+from cs231n.data_parallel import DataParallel
+
+
+def _json_scalar(v):
+    # numpy scalars are not JSON serializable
+    return v.item() if isinstance(v, np.generic) else v
 
 
 class Solver(object):
@@ -32,6 +43,8 @@ class Solver(object):
     of all losses encountered during training and the instance variables
     solver.train_acc_history and solver.val_acc_history will be lists of the
     accuracies of the model on the training and validation set at each epoch.
+    solver.train_loss_history holds the mean training loss of the steps
+    between consecutive accuracy checks.
 
     Example usage might look something like this:
 
@@ -77,6 +90,10 @@ class Solver(object):
       - loss: Scalar giving the loss
       - grads: Dictionary with the same keys as self.params mapping parameter
         names to gradients of the loss with respect to those parameters.
+
+    - Optionally, model.train_predictions is set by every training call of
+      model.loss(X, y) to an array of shape (N,) with the predicted labels of
+      X, for the running_train_acc option. All models in classifiers/ do so.
     """
 
     def __init__(self, model, data, **kwargs):
@@ -100,6 +117,17 @@ class Solver(object):
           'learning_rate' parameter so that should always be present.
         - lr_decay: A scalar for learning rate decay; after each epoch the
           learning rate is multiplied by this value.
+        - lr_warmup_iters: Number of iterations over which the learning rate
+          ramps up linearly from learning_rate / lr_warmup_iters to
+          learning_rate. Large-batch training with lars or lamb usually needs
+          a few epochs of warmup. The warmup applies on top of lr_decay or
+          lr_schedule. Default is 0 (no warmup).
+        - lr_schedule: If not None, an LRSchedule from lr_schedules.py that
+          gives the learning rate of every iteration, such as OneCycle() or
+          CosineDecay(); cannot be combined with lr_decay. The learning rate
+          of the optim_config is its base learning rate. The rate of the
+          current iteration is kept in self.learning_rate and passed to the
+          update rule of every parameter.
         - batch_size: Size of minibatches used to compute loss and gradient
           during training.
         - num_epochs: The number of epochs to run for during training.
@@ -109,10 +137,93 @@ class Solver(object):
           during training.
         - num_train_samples: Number of training samples used to check training
           accuracy; default is 1000; set to None to use entire training set.
+        - running_train_acc: Boolean; if True, the training accuracy of an
+          accuracy check is the accuracy of the training steps since the
+          previous check, counted from the predictions the model makes in its
+          training forward passes (see model.train_predictions above), instead
+          of the accuracy of a separate pass over num_train_samples training
+          examples. It is then measured on the training batches (augmented, in
+          training mode) while the parameters change. Default is False.
         - num_val_samples: Number of validation samples to use to check val
           accuracy; default is None, which uses the entire validation set.
-        - checkpoint_name: If not None, then save model checkpoints here every
+        - checkpoint_name: If not None, a path prefix to save checkpoints of
+          the parameters, the optimizer state and the histories to every
+          epoch (see checkpoint.py). Checkpoints are written in a background
+          thread; train() waits for the last one before it returns.
+        - checkpoint_every: If not None, also save a checkpoint every this
+          many iterations, so that resume() can restart in the middle of an
           epoch.
+        - checkpoint_keep: Number of checkpoints to keep; default is 3, None
+          keeps all.
+        - checkpoint_compress: If True, store the arrays of a checkpoint in
+          one compressed .npz file instead of one .npy file each, which
+          cannot be memory-mapped when resuming. Default is False.
+        - grad_accum_steps: Split every minibatch into this many micro-batches,
+          run the model on one micro-batch at a time and accumulate the
+          gradients before making a single update. Peak activation memory is
+          that of one micro-batch. Batchnorm layers normalize each micro-batch
+          with its own statistics, but their running averages are updated as
+          if the whole minibatch had been seen at once. Default is 1.
+        - flat_params: Boolean; if True, move model.params into one flat
+          buffer (see flat_params.py) and apply the update rule once to the
+          whole buffer instead of once per parameter. The optimizer state is
+          then kept in the single entry optim_configs['__flat__']. With one of
+          the fused update rules of optim.py, such as 'adam_fused', the
+          parameter update then allocates no arrays. The start offsets of the
+          parameters in the buffer are passed to the update rule as
+          config['segments'], which lars and lamb use to compute their
+          per-layer trust ratios.
+        - mixed_precision: Boolean; if True, train with dynamic loss scaling.
+          The model must have a loss_scale attribute and return gradients
+          multiplied by it (FullyConnectedNet does; combine it with
+          activation_dtype=np.float16). Steps whose gradients overflow are
+          skipped and halve the scale; the scale doubles after
+          loss_scale_window steps without overflow. Parameters stored in a
+          lower precision than float32 are updated through float32 master
+          copies.
+        - loss_scale: Initial loss scale for mixed precision; default 2**15.
+        - loss_scale_window: See mixed_precision; default 1000.
+        - prune_schedule: If not None, a PruneSchedule (see pruning.py) that
+          removes conv filters from the model at the end of chosen epochs.
+          The optimizer state is pruned along with the model, and the best
+          parameters are tracked again from the pruned model on. Cannot be
+          combined with flat_params.
+        - prefetch: If positive, build minibatches in a background thread
+          (see prefetch.py), up to this many batches ahead of the training
+          step, already cast to model.dtype. The batch indices then come from
+          a random generator of the prefetcher seeded from np.random.
+          Default is 0 (build each batch in the step).
+        - augment_fn: Optional function augment_fn(X_batch, y_batch) that
+          augments a minibatch in place; runs in the prefetch thread when
+          prefetch is on.
+        - shuffle: If None (the default), every minibatch is sampled with
+          replacement. Otherwise every epoch visits a new permutation of the
+          training set (see sampler.py): 'indices' gathers every batch
+          through the permuted indices, 'copy' serves contiguous views of a
+          shuffled copy of X_train and 'inplace' shuffles X_train and y_train
+          themselves and serves contiguous views of them. Only 'indices' can
+          be combined with prefetch.
+        - eval_batch_size: Number of examples run through the model at once
+          when checking accuracy. Default is 1000 for models the inference
+          engine of inference.py can compile and 100 for other models, which
+          are evaluated with model.loss(X).
+        - eval_workers: If positive, check accuracies in this many worker
+          processes (see evaluation.py), which read X_val from shared memory.
+          Default is 0 (evaluate in the training process).
+        - eval_background: Boolean; if True, the accuracy checks of train()
+          run in the background (in a thread, or in the eval_workers
+          processes) on a snapshot of the parameters while training goes on.
+          Their results are recorded, printed and used to track the best
+          parameters when the next check starts or training ends, and before
+          a checkpoint is saved. Default is False.
+        - data_parallel: If greater than 1, train with this many model
+          replicas in as many processes (see data_parallel.py): train() forks
+          data_parallel - 1 worker processes, every replica computes the
+          gradient of an equal share of each minibatch, and the gradients
+          are summed through shared memory before a single update. The
+          parameters are kept in a flat buffer in shared memory, as with
+          flat_params. Needs the fork start method; cannot be combined with
+          grad_accum_steps or prune_schedule. Default is 1.
         """
         self.model = model
         self.X_train = data['X_train']
@@ -124,14 +235,33 @@ class Solver(object):
         self.update_rule = kwargs.pop('update_rule', 'sgd')
         self.optim_config = kwargs.pop('optim_config', {})
         self.lr_decay = kwargs.pop('lr_decay', 1.0)
+        self.lr_warmup_iters = kwargs.pop('lr_warmup_iters', 0)
+        self.lr_schedule = kwargs.pop('lr_schedule', None)
         self.batch_size = kwargs.pop('batch_size', 100)
         self.num_epochs = kwargs.pop('num_epochs', 10)
         self.num_train_samples = kwargs.pop('num_train_samples', 1000)
         self.num_val_samples = kwargs.pop('num_val_samples', None)
+        self.running_train_acc = kwargs.pop('running_train_acc', False)
 
         self.checkpoint_name = kwargs.pop('checkpoint_name', None)
+        self.checkpoint_every = kwargs.pop('checkpoint_every', None)
+        self.checkpoint_keep = kwargs.pop('checkpoint_keep', 3)
+        self.checkpoint_compress = kwargs.pop('checkpoint_compress', False)
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
+        self.grad_accum_steps = kwargs.pop('grad_accum_steps', 1)
+        flat_params = kwargs.pop('flat_params', False)
+        self.mixed_precision = kwargs.pop('mixed_precision', False)
+        self.loss_scale = kwargs.pop('loss_scale', 2.0 ** 15)
+        self.loss_scale_window = kwargs.pop('loss_scale_window', 1000)
+        self.prune_schedule = kwargs.pop('prune_schedule', None)
+        self.prefetch = kwargs.pop('prefetch', 0)
+        self.augment_fn = kwargs.pop('augment_fn', None)
+        self.shuffle = kwargs.pop('shuffle', None)
+        self.eval_batch_size = kwargs.pop('eval_batch_size', None)
+        self.eval_workers = kwargs.pop('eval_workers', 0)
+        self.eval_background = kwargs.pop('eval_background', False)
+        self.data_parallel = kwargs.pop('data_parallel', 1)
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
@@ -144,6 +274,79 @@ class Solver(object):
             raise ValueError('Invalid update_rule "%s"' % self.update_rule)
         self.update_rule = getattr(optim, self.update_rule)
 
+        # One learning rate for all parameters, evaluated every iteration.
+        # Without a learning_rate in the optim_config, the default of the
+        # update rule is the base rate.
+        self.base_lr = self.optim_config.get('learning_rate')
+        if self.base_lr is None:
+            _, config = self.update_rule(np.zeros(1), np.zeros(1), {})
+            self.base_lr = config['learning_rate']
+        self.learning_rate = self.base_lr
+        num_train = self.X_train.shape[0]
+        self.iterations_per_epoch = max(num_train // self.batch_size, 1)
+        self.num_iterations = self.num_epochs * self.iterations_per_epoch
+        if self.lr_schedule is not None and self.lr_decay != 1.0:
+            raise ValueError('lr_decay cannot be used with lr_schedule')
+        if self.lr_schedule is None and self.lr_decay != 1.0:
+            self.lr_schedule = StepDecay(self.iterations_per_epoch,
+                                         self.lr_decay)
+        if self.lr_warmup_iters > 0:
+            self.lr_schedule = LinearWarmup(self.lr_schedule,
+                                            self.lr_warmup_iters)
+
+        if self.grad_accum_steps < 1 or self.grad_accum_steps > self.batch_size:
+            raise ValueError('Invalid grad_accum_steps %d' % self.grad_accum_steps)
+
+        if self.mixed_precision and not hasattr(self.model, 'loss_scale'):
+            raise ValueError('mixed_precision needs a model with a loss_scale')
+
+        if self.running_train_acc and \
+           not hasattr(self.model, 'train_predictions'):
+            raise ValueError('running_train_acc needs a model with '
+                             'train_predictions')
+
+        if self.prefetch > 0 and self.shuffle not in (None, 'indices'):
+            raise ValueError('prefetch needs shuffle=None or "indices"')
+
+        if self.prune_schedule is not None and flat_params:
+            raise ValueError('prune_schedule cannot be used with flat_params')
+
+        if self.data_parallel > 1 and (self.grad_accum_steps > 1 or
+                                       self.prune_schedule is not None):
+            raise ValueError('data_parallel cannot be used with '
+                             'grad_accum_steps or prune_schedule')
+
+        self.flat = None
+        self.parallel = None
+        if self.data_parallel > 1:
+            self.parallel = DataParallel(self.model, self.data_parallel,
+                                         self.batch_size, self.X_train,
+                                         self.y_train)
+            self.flat = self.parallel.flat
+        elif flat_params:
+            self.flat = flatten_params(self.model)
+
+        # float32 master weights for low precision parameters, keyed like
+        # optim_configs
+        self.master_params = None
+        if self.mixed_precision:
+            self.master_params = {}
+            params = self.model.params
+            if self.flat is not None:
+                params = {'__flat__': self.flat.data}
+            for p, w in params.items():
+                if w.dtype.itemsize < 4:
+                    self.master_params[p] = w.astype(np.float32)
+
+        # Models the inference engine knows are evaluated without building
+        # backward caches; any other model goes through model.loss(X)
+        if self.eval_batch_size is None:
+            self.eval_batch_size = 1000 if can_predict(self.model) else 100
+        self.evaluator = Evaluator(self.model, batch_size=self.eval_batch_size,
+                                   num_workers=self.eval_workers,
+                                   background=self.eval_background,
+                                   shared=[self.X_val])
+
         self._reset()
 
 
@@ -159,9 +362,32 @@ class Solver(object):
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
-
-        # Make a deep copy of the optim_config for each parameter
+        self.train_loss_history = []
+        # Streaming sums over the steps since the last accuracy check: loss,
+        # number of steps, correct predictions and examples
+        self._train_stats = [0.0, 0, 0, 0]
+        self._grad_buffers = None
+        self._prefetcher = None
+        self._checkpoint_writer = None
+        self._pending_eval = None
+        self.sampler = None
+        # Minibatch stream state: seed of the sampler and the prefetcher,
+        # number of batches drawn, and the row order of X_train for
+        # shuffle='inplace' when resuming
+        self._data_seed = None
+        self._num_batches = 0
+        self._sampler_order = None
+        self._start_iteration = 0
+        self._good_steps = 0
+        self.skipped_steps = 0
+
+        # Make a deep copy of the optim_config for each parameter, or a single
+        # copy for the whole flat buffer
         self.optim_configs = {}
+        if self.flat is not None:
+            self.optim_configs['__flat__'] = dict(self.optim_config)
+            self.optim_configs['__flat__']['segments'] = self.flat.offsets[:-1]
+            return
         for p in self.model.params:
             d = {k: v for k, v in self.optim_config.items()}
             self.optim_configs[p] = d
@@ -173,47 +399,431 @@ class Solver(object):
         be called manually.
         """
         # Make a minibatch of training data
-        num_train = self.X_train.shape[0]
-        batch_mask = np.random.choice(num_train, self.batch_size)
-        X_batch = self.X_train[batch_mask]
-        y_batch = self.y_train[batch_mask]
+        X_batch, y_batch = self._next_batch()
 
         # Compute loss and gradient
-        loss, grads = self.model.loss(X_batch, y_batch)
+        if self.mixed_precision:
+            # Overflows are expected and handled by skipping the step
+            self.model.loss_scale = self.loss_scale
+            with np.errstate(over='ignore', invalid='ignore'):
+                loss, grads = self._loss(X_batch, y_batch)
+        else:
+            loss, grads = self._loss(X_batch, y_batch)
         self.loss_history.append(loss)
+        self._train_stats[0] += loss
+        self._train_stats[1] += 1
+
+        if self.lr_schedule is not None:
+            self.learning_rate = self.lr_schedule(len(self.loss_history) - 1,
+                                                  self.num_iterations,
+                                                  self.base_lr)
 
         # Perform a parameter update
+        if self.flat is not None:
+            grads = {'__flat__': self.flat.gather_grads(grads)}
+            if self.mixed_precision and not self._unscale_grads(grads):
+                return
+            dw = grads['__flat__']
+            config = self.optim_configs['__flat__']
+            w = self.flat.data
+            if self.master_params:
+                w = self.master_params['__flat__']
+            next_w, next_config = self._update(w, dw, config)
+            if self.master_params:
+                self.master_params['__flat__'] = next_w
+            # Write back into the buffer so model.params stays a set of views
+            if next_w is not self.flat.data:
+                np.copyto(self.flat.data, next_w)
+            self.optim_configs['__flat__'] = next_config
+            return
+
+        if self.mixed_precision and not self._unscale_grads(grads):
+            return
+
         for p, w in self.model.params.items():
             dw = grads[p]
             config = self.optim_configs[p]
-            next_w, next_config = self.update_rule(w, dw, config)
-            self.model.params[p] = next_w
+            if self.master_params is not None and p in self.master_params:
+                next_w, next_config = self._update(self.master_params[p], dw,
+                                                   config)
+                self.master_params[p] = next_w
+                self.model.params[p] = next_w.astype(w.dtype)
+            else:
+                next_w, next_config = self._update(w, dw, config)
+                self.model.params[p] = next_w
             self.optim_configs[p] = next_config
 
 
-    def _save_checkpoint(self):
-        if self.checkpoint_name is None: return
-        checkpoint = {
-          'model': self.model,
-          'update_rule': self.update_rule,
+    def _next_batch(self):
+        """
+        Returns the next minibatch (X_batch, y_batch). Don't call this
+        manually.
+        """
+        if self._data_seed is None and (self.shuffle or self.prefetch or
+                                        self.parallel):
+            self._data_seed = np.random.randint(2 ** 31)
+        if self.shuffle is not None and self.sampler is None:
+            self.sampler = EpochSampler(self.X_train, self.y_train,
+                                        self.batch_size, mode=self.shuffle,
+                                        seed=self._data_seed,
+                                        batch=self._num_batches,
+                                        order=self._sampler_order)
+        self._num_batches += 1
+
+        if self.prefetch > 0:
+            if self._prefetcher is None:
+                self._prefetcher = BatchPrefetcher(
+                    self.X_train, self.y_train, self.batch_size,
+                    depth=self.prefetch, dtype=getattr(self.model, 'dtype', None),
+                    augment_fn=self.augment_fn, sampler=self.sampler,
+                    seed=self._data_seed, batch=self._num_batches - 1)
+            return self._prefetcher.next()
+
+        if self.sampler is not None:
+            X_batch, y_batch = self.sampler.next_batch()
+            if self.augment_fn is not None and self.shuffle != 'indices':
+                # Never augment the training set itself
+                X_batch, y_batch = X_batch.copy(), y_batch.copy()
+            if self.augment_fn is not None:
+                self.augment_fn(X_batch, y_batch)
+            return X_batch, y_batch
+
+        num_train = self.X_train.shape[0]
+        batch_mask = np.random.choice(num_train, self.batch_size)
+        X_batch = self.X_train[batch_mask]
+        y_batch = self.y_train[batch_mask]
+        if self.augment_fn is not None:
+            self.augment_fn(X_batch, y_batch)
+        return X_batch, y_batch
+
+
+    def _update(self, w, dw, config):
+        """
+        Apply the update rule with the learning rate of the current iteration.
+        Don't call this manually.
+        """
+        config['learning_rate'] = self.learning_rate
+        return self.update_rule(w, dw, config)
+
+
+    def _unscale_grads(self, grads):
+        """
+        Divide the loss-scaled gradients by the loss scale in place and adjust
+        the scale. Returns False (and halves the scale) if any gradient
+        overflowed, in which case the step must be skipped.
+        """
+        for dw in grads.values():
+            if not np.isfinite(dw).all():
+                self.loss_scale /= 2
+                self._good_steps = 0
+                self.skipped_steps += 1
+                if self.verbose:
+                    print('Gradient overflow, reducing loss scale to %g' %
+                          self.loss_scale)
+                return False
+
+        for p, dw in grads.items():
+            if dw.dtype.itemsize < 4:
+                dw = grads[p] = dw.astype(np.float32)
+            dw *= 1.0 / self.loss_scale
+
+        self._good_steps += 1
+        if self._good_steps >= self.loss_scale_window:
+            self.loss_scale *= 2
+            self._good_steps = 0
+        return True
+
+
+    def _prune(self):
+        """
+        Run the pruning schedule and prune the optimizer state with the model.
+        Don't call this manually.
+        """
+        # A pending accuracy check belongs to the model before pruning
+        self._finish_check()
+        slices = self.prune_schedule.step(self)
+        if not slices:
+            return
+        prune_optim_configs(self.optim_configs, slices)
+        if self.master_params is not None:
+            prune_arrays(self.master_params, slices)
+        self._grad_buffers = None
+        # Earlier parameters no longer fit the model
+        self.best_val_acc = 0
+        self.best_params = {}
+
+
+    def _loss(self, X_batch, y_batch):
+        """
+        Loss and gradient of a minibatch, accumulated over micro-batches if
+        requested. This is called by _step() and should not be called
+        manually.
+        """
+        if self.parallel is not None:
+            loss, grads = self.parallel.loss(X_batch, y_batch,
+                                             len(self.loss_history),
+                                             self._data_seed)
+            self._count_correct(y_batch)
+            return loss, grads
+        if self.grad_accum_steps == 1:
+            loss, grads = self.model.loss(X_batch, y_batch)
+            self._count_correct(y_batch)
+            return loss, grads
+        return self._accumulate_grads(X_batch, y_batch)
+
+
+    def _count_correct(self, y_batch):
+        """
+        Add the predictions of the last training pass to the running training
+        accuracy. Don't call this manually.
+        """
+        if self.running_train_acc:
+            y_pred = self.model.train_predictions
+            self._train_stats[2] += int(np.count_nonzero(y_pred == y_batch))
+            self._train_stats[3] += y_batch.shape[0]
+
+
+    def _accumulate_grads(self, X_batch, y_batch):
+        """
+        Compute the loss and gradient of a minibatch as the weighted average
+        over grad_accum_steps micro-batches. This is called by _step() and
+        should not be called manually.
+        """
+        if self._grad_buffers is None:
+            if self.flat is not None:
+                self._grad_buffers = self.flat.grads
+            else:
+                self._grad_buffers = {p: np.empty_like(w) for p, w
+                                      in self.model.params.items()}
+        accum = self._grad_buffers
+
+        # Every micro-batch starts from the same running averages; their
+        # per micro-batch updates are undone and combined at the end
+        bn_params = getattr(self.model, 'bn_params', [])
+        saved = [(p.get('running_mean'), p.get('running_var'))
+                 for p in bn_params]
+        batch_stats = [[] for p in bn_params]
+
+        N = X_batch.shape[0]
+        bounds = np.linspace(0, N, self.grad_accum_steps + 1).astype(int)
+        weights = (np.diff(bounds) / N).tolist()
+        loss = 0.0
+        for i in range(self.grad_accum_steps):
+            for p, (mean, var) in zip(bn_params, saved):
+                if mean is None:
+                    p.pop('running_mean', None)
+                    p.pop('running_var', None)
+                else:
+                    p['running_mean'], p['running_var'] = mean, var
+
+            start, end = bounds[i], bounds[i + 1]
+            micro_loss, grads = self.model.loss(X_batch[start:end],
+                                                y_batch[start:end])
+            self._count_correct(y_batch[start:end])
+            loss += weights[i] * micro_loss
+            for p, dw in grads.items():
+                if i == 0:
+                    np.multiply(dw, weights[i], out=accum[p])
+                else:
+                    dw *= weights[i]
+                    accum[p] += dw
+
+            # Recover the micro-batch mean and variance from the update
+            # running = momentum * old + (1 - momentum) * batch statistic
+            for p, (mean, var), stats in zip(bn_params, saved, batch_stats):
+                momentum = p.get('momentum', 0.9)
+                old_mean = 0 if mean is None else mean
+                old_var = 0 if var is None else var
+                stats.append(((p['running_mean'] - momentum * old_mean) /
+                              (1 - momentum),
+                              (p['running_var'] - momentum * old_var) /
+                              (1 - momentum)))
+
+        # Mean and (biased) variance of the whole minibatch
+        for p, (mean, var), stats in zip(bn_params, saved, batch_stats):
+            momentum = p.get('momentum', 0.9)
+            batch_mean = sum(w * mu for w, (mu, _) in zip(weights, stats))
+            batch_var = sum(w * (v + (mu - batch_mean) ** 2)
+                            for w, (mu, v) in zip(weights, stats))
+            old_mean = 0 if mean is None else mean
+            old_var = 0 if var is None else var
+            p['running_mean'] = momentum * old_mean + (1 - momentum) * batch_mean
+            p['running_var'] = momentum * old_var + (1 - momentum) * batch_var
+
+        return loss, accum
+
+
+    def _checkpoint_state(self):
+        """
+        Returns the arrays and the JSON metadata of a checkpoint of the
+        current state. Don't call this manually.
+        """
+        arrays, optim_scalars = {}, {}
+        for k, v in self.model.params.items():
+            arrays['params.' + k] = v
+        for k, v in self.best_params.items():
+            arrays['best.' + k] = v
+        for p, config in self.optim_configs.items():
+            optim_scalars[p] = {}
+            for k, v in config.items():
+                if isinstance(v, np.ndarray):
+                    arrays['optim.%s.%s' % (p, k)] = v
+                else:
+                    optim_scalars[p][k] = _json_scalar(v)
+        for p, w in (self.master_params or {}).items():
+            arrays['master.' + p] = w
+        for i, bn_param in enumerate(getattr(self.model, 'bn_params', [])):
+            for k in ('running_mean', 'running_var'):
+                if k in bn_param:
+                    arrays['bn%d.%s' % (i, k)] = bn_param[k]
+        arrays['loss_history'] = np.asarray(self.loss_history, dtype=np.float64)
+        arrays['train_acc_history'] = np.asarray(self.train_acc_history,
+                                                 dtype=np.float64)
+        arrays['val_acc_history'] = np.asarray(self.val_acc_history,
+                                               dtype=np.float64)
+        arrays['train_loss_history'] = np.asarray(self.train_loss_history,
+                                                  dtype=np.float64)
+        rng_state = np.random.get_state()
+        arrays['rng.keys'] = rng_state[1]
+        if self.sampler is not None and self.sampler.order is not None:
+            arrays['sampler.order'] = self.sampler.order
+        dropout_counters = [p['stream'].counter for p in
+                            getattr(self.model, 'dropout_params', [])
+                            if p.get('stream') is not None]
+
+        meta = {
+          'update_rule': self.update_rule.__name__,
+          'optim_config': {k: _json_scalar(v)
+                           for k, v in self.optim_config.items()},
+          'optim_scalars': optim_scalars,
           'lr_decay': self.lr_decay,
-          'optim_config': self.optim_config,
           'batch_size': self.batch_size,
           'num_train_samples': self.num_train_samples,
           'num_val_samples': self.num_val_samples,
           'epoch': self.epoch,
-          'loss_history': self.loss_history,
-          'train_acc_history': self.train_acc_history,
-          'val_acc_history': self.val_acc_history,
+          'iteration': len(self.loss_history),
+          'best_val_acc': _json_scalar(self.best_val_acc),
+          'learning_rate': _json_scalar(self.learning_rate),
+          'loss_scale': self.loss_scale,
+          'good_steps': self._good_steps,
+          'skipped_steps': self.skipped_steps,
+          'train_stats': [_json_scalar(v) for v in self._train_stats],
+          'rng': [_json_scalar(v) for v in rng_state[2:]],
+          'dropout_counters': dropout_counters,
+          'data_seed': _json_scalar(self._data_seed),
+          'num_batches': self._num_batches,
+          'lr_schedule': (None if self.lr_schedule is None
+                          else self.lr_schedule.state()),
         }
-        filename = '%s_epoch_%d.pkl' % (self.checkpoint_name, self.epoch)
+        return arrays, meta
+
+
+    def resume(self, path):
+        """
+        Restore a training run from a checkpoint directory written with
+        checkpoint_name, so that train() continues exactly where that run
+        stopped: the parameters, best parameters, optimizer state, batchnorm
+        statistics, histories, iteration and epoch counters, learning rate
+        schedule and loss scale are restored, as well as the global numpy
+        random state, the counters of the dropout streams and the position in
+        the minibatch stream.
+
+        The Solver must have been constructed like the one that wrote the
+        checkpoint, with a model of the same architecture and the same data;
+        with shuffle='inplace', X_train must be given in its original order.
+        The arrays are memory-mapped, and the loss history is not read until
+        it is used, so resuming is fast even after a long run.
+
+        Inputs:
+        - path: Checkpoint directory, such as
+          checkpoint.latest_checkpoint(checkpoint_name)
+        """
+        arrays, meta = load_checkpoint(path)
+        groups = {}
+        for name, a in arrays.items():
+            group, _, key = name.partition('.')
+            groups.setdefault(group, {})[key] = a
+
+        for k, a in groups.get('params', {}).items():
+            if self.flat is not None:
+                self.model.params[k][...] = a
+            else:
+                self.model.params[k] = np.array(a)
+
+        self.optim_configs = {}
+        for p, scalars in meta['optim_scalars'].items():
+            self.optim_configs[p] = dict(scalars)
+        for key, a in groups.get('optim', {}).items():
+            p, k = key.rsplit('.', 1)
+            self.optim_configs[p][k] = np.array(a)
+        if self.master_params is not None:
+            for p, a in groups.get('master', {}).items():
+                self.master_params[p] = np.array(a)
+
+        best = groups.get('best', {})
+        self.best_params = {}
+        if best and self.flat is not None:
+            self.best_params = self.flat.views(np.empty_like(self.flat.data))
+            for k, a in best.items():
+                self.best_params[k][...] = a
+        elif best:
+            self.best_params = {k: np.array(a) for k, a in best.items()}
+
+        for i, bn_param in enumerate(getattr(self.model, 'bn_params', [])):
+            for k, a in groups.get('bn%d' % i, {}).items():
+                bn_param[k] = np.array(a)
+        streams = [p['stream'] for p in getattr(self.model, 'dropout_params', [])
+                   if p.get('stream') is not None]
+        for stream, counter in zip(streams, meta['dropout_counters']):
+            stream.counter = counter
+
+        self.loss_history = ArrayHistory(arrays['loss_history'])
+        self.train_acc_history = list(arrays['train_acc_history'])
+        self.val_acc_history = list(arrays['val_acc_history'])
+        self.train_loss_history = list(arrays['train_loss_history'])
+        self._train_stats = list(meta['train_stats'])
+        self.epoch = meta['epoch']
+        self.best_val_acc = meta['best_val_acc']
+        self.learning_rate = meta['learning_rate']
+        self.loss_scale = meta['loss_scale']
+        self._good_steps = meta['good_steps']
+        self.skipped_steps = meta['skipped_steps']
+        if self.lr_schedule is not None and meta['lr_schedule'] is not None:
+            self.lr_schedule.set_state(meta['lr_schedule'])
+
+        np.random.set_state(('MT19937', np.array(arrays['rng.keys']))
+                            + tuple(meta['rng']))
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+        self.sampler = None
+        self._data_seed = meta['data_seed']
+        self._num_batches = meta['num_batches']
+        order = groups.get('sampler', {}).get('order')
+        self._sampler_order = None if order is None else np.array(order)
+        self._grad_buffers = None
+        if self.parallel is not None:
+            # The workers copied the model state they were forked with
+            self.parallel.stop()
+        self.evaluator.wait()
+        self._pending_eval = None
+        self._start_iteration = meta['iteration']
+
+
+    def _save_checkpoint(self):
+        if self.checkpoint_name is None: return
+        self._finish_check()
+        if self._checkpoint_writer is None:
+            self._checkpoint_writer = CheckpointWriter(
+                self.checkpoint_name, keep=self.checkpoint_keep,
+                compress=self.checkpoint_compress)
+        arrays, meta = self._checkpoint_state()
+        path = self._checkpoint_writer.save(meta['iteration'], arrays, meta)
         if self.verbose:
-            print('Saving checkpoint to "%s"' % filename)
-        with open(filename, 'wb') as f:
-            pickle.dump(checkpoint, f)
+            print('Saving checkpoint to "%s"' % path)
 
 
-    def check_accuracy(self, X, y, num_samples=None, batch_size=100):
+    def check_accuracy(self, X, y, num_samples=None, batch_size=None):
         """
         Check accuracy of the model on the provided data.
 
@@ -223,45 +833,121 @@ class Solver(object):
         - num_samples: If not None, subsample the data and only test the model
           on num_samples datapoints.
         - batch_size: Split X and y into batches of this size to avoid using
-          too much memory.
+          too much memory; default is eval_batch_size.
 
         Returns:
         - acc: Scalar giving the fraction of instances that were correctly
           classified by the model.
         """
+        index = self._sample_index(X, num_samples)
+        evaluation = self.evaluator.submit([(X, y, index)],
+                                           batch_size=batch_size)
+        return evaluation.result()[0]
+
 
-        # Maybe subsample the data
+    def _sample_index(self, X, num_samples):
+        """
+        Returns the indices of a random subsample of num_samples rows of X,
+        or None to use all of X. Don't call this manually.
+        """
         N = X.shape[0]
         if num_samples is not None and N > num_samples:
-            mask = np.random.choice(N, num_samples)
-            N = num_samples
-            X = X[mask]
-            y = y[mask]
-
-        # Compute predictions in batches
-        num_batches = N // batch_size
-        if N % batch_size != 0:
-            num_batches += 1
-        y_pred = []
-        for i in range(num_batches):
-            start = i * batch_size
-            end = (i + 1) * batch_size
-            scores = self.model.loss(X[start:end])
-            y_pred.append(np.argmax(scores, axis=1))
-        y_pred = np.hstack(y_pred)
-        acc = np.mean(y_pred == y)
-
-        return acc
+            return np.random.choice(N, num_samples)
+        return None
+
+
+    def _snapshot_params(self):
+        """
+        Returns a copy of model.params. Don't call this manually.
+        """
+        if self.flat is not None:
+            return self.flat.views(self.flat.data.copy())
+        return {k: v.copy() for k, v in self.model.params.items()}
+
+
+    def _check(self):
+        """
+        Check train and val accuracy, or start checking them in the
+        background. This is called by train() and should not be called
+        manually.
+        """
+        # Running training loss and accuracy of the steps since the last check
+        loss_sum, steps, correct, seen = self._train_stats
+        self._train_stats = [0.0, 0, 0, 0]
+        train_loss = loss_sum / max(steps, 1)
+        train_acc = None
+        datasets = []
+        if self.running_train_acc:
+            train_acc = correct / max(seen, 1)
+        else:
+            datasets.append((self.X_train, self.y_train,
+                self._sample_index(self.X_train, self.num_train_samples)))
+        datasets.append((self.X_val, self.y_val,
+                         self._sample_index(self.X_val, self.num_val_samples)))
+
+        check = (train_acc, train_loss, self.epoch)
+        if not self.eval_background:
+            accs = self.evaluator.submit(datasets).result()
+            self._record_check(accs, check, None)
+            return
+        self._finish_check()
+        params = self._snapshot_params()
+        evaluation = self.evaluator.submit(datasets, params=params)
+        self._pending_eval = (evaluation, check, params)
+
+
+    def _finish_check(self):
+        """
+        Wait for the accuracy check running in the background, if any, and
+        record its result. Don't call this manually.
+        """
+        if self._pending_eval is None:
+            return
+        evaluation, check, params = self._pending_eval
+        self._pending_eval = None
+        self._record_check(evaluation.result(), check, params)
+
+
+    def _record_check(self, accs, check, params):
+        """
+        Record the result of an accuracy check of the parameters params (None
+        for the current model.params): accs holds the evaluated accuracies and
+        check is the tuple (running train accuracy or None, running train
+        loss, epoch). Don't call this manually.
+        """
+        train_acc, train_loss, epoch = check
+        if train_acc is None:
+            train_acc, val_acc = accs
+        else:
+            val_acc, = accs
+        self.train_acc_history.append(train_acc)
+        self.val_acc_history.append(val_acc)
+        self.train_loss_history.append(train_loss)
+        if self.lr_schedule is not None:
+            self.lr_schedule.observe(val_acc)
+
+        if self.verbose:
+            print('(Epoch %d / %d) train acc: %f; val_acc: %f' % (
+                   epoch, self.num_epochs, train_acc, val_acc))
+
+        # Keep track of the best model
+        if val_acc > self.best_val_acc:
+            self.best_val_acc = val_acc
+            if params is None:
+                params = self._snapshot_params()
+            self.best_params = params
 
 
     def train(self):
         """
         Run optimization to train the model.
         """
-        num_train = self.X_train.shape[0]
-        iterations_per_epoch = max(num_train // self.batch_size, 1)
-        num_iterations = self.num_epochs * iterations_per_epoch
-        for t in range(num_iterations):
+        iterations_per_epoch = self.iterations_per_epoch
+        num_iterations = self.num_iterations
+        start, self._start_iteration = self._start_iteration, 0
+        if self.parallel is not None:
+            self.parallel.start()
+        for t in range(start, num_iterations):
             self._step()
 
             # Maybe print training loss
@@ -269,37 +955,38 @@ class Solver(object):
                 print('(Iteration %d / %d) loss: %f' % (
                        t + 1, num_iterations, self.loss_history[-1]))
 
-            # At the end of every epoch, increment the epoch counter and decay
-            # the learning rate.
+            # At the end of every epoch, increment the epoch counter
             epoch_end = (t + 1) % iterations_per_epoch == 0
             if epoch_end:
                 self.epoch += 1
-                for k in self.optim_configs:
-                    self.optim_configs[k]['learning_rate'] *= self.lr_decay
+                if self.prune_schedule is not None:
+                    self._prune()
 
             # Check train and val accuracy on the first iteration, the last
             # iteration, and at the end of each epoch.
             first_it = (t == 0)
             last_it = (t == num_iterations - 1)
             if first_it or last_it or epoch_end:
-                train_acc = self.check_accuracy(self.X_train, self.y_train,
-                    num_samples=self.num_train_samples)
-                val_acc = self.check_accuracy(self.X_val, self.y_val,
-                    num_samples=self.num_val_samples)
-                self.train_acc_history.append(train_acc)
-                self.val_acc_history.append(val_acc)
+                self._check()
+                self._save_checkpoint()
+            elif self.checkpoint_every and (t + 1) % self.checkpoint_every == 0:
                 self._save_checkpoint()
 
-                if self.verbose:
-                    print('(Epoch %d / %d) train acc: %f; val_acc: %f' % (
-                           self.epoch, self.num_epochs, train_acc, val_acc))
-
-                # Keep track of the best model
-                if val_acc > self.best_val_acc:
-                    self.best_val_acc = val_acc
-                    self.best_params = {}
-                    for k, v in self.model.params.items():
-                        self.best_params[k] = v.copy()
+        self._finish_check()
+        self.evaluator.close()
+        if self.parallel is not None:
+            self.parallel.stop()
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+            self._prefetcher = None
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.close()
+            self._checkpoint_writer = None
 
         # At the end of training swap the best params into the model
-        self.model.params = self.best_params
+        # (copied into the flat buffer so that the views stay valid)
+        if self.flat is not None:
+            for k, v in self.best_params.items():
+                self.model.params[k][...] = v
+        else:
+            self.model.params = self.best_params